@@ -0,0 +1,100 @@
+import hashlib
+import io
+import os
+import posixpath
+import tarfile
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import BinaryIO, Callable, Iterator
+
+from app.core import imaging
+
+# Bulk upload of an archive of images (POST /image/bulk).
+# Entries are read one after another, a tar in stream mode without seeking, and each one is handed
+# to a pool of writer threads while the next is read, so reading and writing overlap.
+# Files are content addressed like single uploads (see core/storage.py).
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".gif", ".webp"}
+
+
+def _entries(file:BinaryIO) -> Iterator[tuple[str, Callable[[], bytes]|None]]:
+    # (name, read) of every entry in archive order, read is None for anything but regular files
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                yield info.filename, None if info.is_dir() else (lambda info=info: archive.read(info))
+        return
+    file.seek(0)
+    with tarfile.open(fileobj=file, mode="r|*") as archive:
+        for info in archive:
+            yield info.name, (lambda info=info: archive.extractfile(info).read()) if info.isfile() else None
+
+def _write(directory:str, extension:str, data:bytes) -> dict:
+    # stored under its content name, an existing file of that name already has the content.
+    # Nothing is written for images over the pixel limit
+    metadata = imaging.read_metadata(io.BytesIO(data))
+    sha256 = hashlib.sha256(data).hexdigest()
+    file_name = sha256 + extension
+    path = os.path.join(directory, file_name)
+    if os.path.exists(path):
+        return {"file_name": file_name, "sha256": sha256, "metadata": metadata, "created": False}
+    part = os.path.join(directory, f".{uuid.uuid4()}.part")
+    try:
+        with open(part, "wb") as out:
+            out.write(data)
+        os.replace(part, path)
+    except OSError:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return {"file_name": file_name, "sha256": sha256, "metadata": metadata, "created": True}
+
+def extract_images(file:BinaryIO, directory:str, workers:int) -> list[dict]:
+    # every file entry -> {"name", "file_name", "sha256", "metadata", "created"} once written to directory under its content name
+    # (created False if the file was there already), {"name", "detail"} if it is not an image or could not be written.
+    # ValueError if file is not a zip or tar
+    results, pending = [], {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, read in _entries(file):
+                if read is None:
+                    continue
+                base = posixpath.basename(name)
+                extension = posixpath.splitext(base)[1].lower()
+                # macOS resource forks, ._name and __MACOSX/
+                if extension not in IMAGE_EXTENSIONS or base.startswith(".") or name.startswith("__MACOSX/"):
+                    results.append({"name": name, "detail": "not an image"})
+                    continue
+                result = {"name": name}
+                results.append(result)
+                pending[pool.submit(_write, directory, extension, read())] = result
+                # bounds the entries held in memory
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _check(future, pending.pop(future))
+            for future in list(pending):
+                _check(future, pending.pop(future))
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+        remove(directory, results)
+        raise ValueError(f"cannot read archive: {e}") from e
+    return results
+
+def _check(future, result:dict):
+    if isinstance(error := future.exception(), imaging.ImageTooLargeError):
+        result["detail"] = str(error)
+    elif error:
+        result["detail"] = f"cannot write: {error}"
+    else:
+        result.update(future.result())
+
+def remove(directory:str, results:list[dict]):
+    # drops the files created by extract_images, e.g. when registering them failed
+    for result in results:
+        if result.get("created"):
+            try:
+                os.remove(os.path.join(directory, result["file_name"]))
+            except OSError:
+                pass
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import SessionLocal
+from app.settings import image_domain, import_workers
+
+# Columns read from the files of images stored before they existed (python -m app.core.storage, python -m app.core.metadata).
+# Images still without the column come in batches in id order, so every image is read once,
+# their files are read in parallel by a thread pool.
+
+# read result of an image without a file
+MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+def _read(read:Callable[[str], Any], path:str):
+    try:
+        return read(path)
+    except FileNotFoundError:
+        return MISSING
+
+async def read_files(get_images:Callable, read:Callable[[str], Any], batch_size:int, workers:int=import_workers) -> AsyncIterator[tuple[AsyncSession, list, list]]:
+    # (session, images, read(file path) of each image or MISSING) per batch of get_images(db=, after_id=, limit=)
+    after_id = 0
+    loop = asyncio.get_running_loop()
+    async with SessionLocal() as db:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while images := await get_images(db=db, after_id=after_id, limit=batch_size):
+                after_id = images[-1].id
+                results = await asyncio.gather(*[loop.run_in_executor(pool, _read, read, image_domain + i.path) for i in images])
+                for image, result in zip(images, results):
+                    if result is MISSING:
+                        logger.warning("image %d: no file at %s", image.id, image.path)
+                yield db, images, results
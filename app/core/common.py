@@ -1,16 +1,23 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
-from app.core.database import TaskStatus, TaskType
+from app.core.database import BboxAnnotation, PolyAnnotation, TaskStatus, TaskType
 from app.routes.exception import *
+from app.schemas import AnnotationPatch
+from contextlib import contextmanager
 from typing import Literal
 
-_TYPES = Literal["bbox", "poly"]
-def check_task(db:Session, user_id:int,task_id:int,type:_TYPES="bbox"):
-    task = crud.get_task_by_id(db=db, id=task_id)
-    if not task:
-        raise TaskNotFoundException
+# annotation kinds, the task types of each kind, kind -> (model, not found exception)
+AnnotationType = Literal["bbox", "poly"]
+BBOX_TASK_TYPES = [TaskType.bbox_annotation.value, TaskType.bbox_verification.value, TaskType.nn_bbox_annotation.value]
+POLY_TASK_TYPES = [TaskType.poly_annotation.value, TaskType.poly_verification.value, TaskType.nn_poly_annotation.value]
+ANNOTATIONS = {"bbox": (BboxAnnotation, BboxNotFoundException), "poly": (PolyAnnotation, PolygonNotFoundException)}
 
+def annotation_type(task_type:TaskType) -> AnnotationType:
+    return "poly" if task_type.value in POLY_TASK_TYPES else "bbox"
+
+def _check_task_state(task, user_id:int, type:AnnotationType|None):
+    # task: anything with status, task_type and accepted_user_id. type None skips the task type check
     if task.status.value == TaskStatus.pending.value:
         raise AddAnnotationToPendingTaskException
 
@@ -18,18 +25,89 @@ def check_task(db:Session, user_id:int,task_id:int,type:_TYPES="bbox"):
         raise AddAnnotationToFinishedTaskException
     
     if type == "poly":
-        if task.task_type.value in [TaskType.bbox_annotation.value,TaskType.bbox_verification.value, TaskType.nn_bbox_annotation.value]:
+        if task.task_type.value in BBOX_TASK_TYPES:
             raise AddPolygonToBboxTaskTypeException
     elif type == "bbox":
-        if task.task_type.value in [TaskType.poly_annotation.value,TaskType.poly_verification.value, TaskType.nn_poly_annotation.value]:
+        if task.task_type.value in POLY_TASK_TYPES:
             raise AddBboxToPolygonTaskTypeException
         
     if task.accepted_user_id != user_id:
         raise AddAnnotationFromNotAcceptedUser
-    return task
 
-def check_user(db:Session, user_id:int):
-    user = crud.get_user_by_id(db=db,user_id=user_id)
+def within_image(bounds:tuple, width:int|None, height:int|None) -> bool:
+    # (x_min, y_min, x_max, y_max) on the image, images whose size is not known yet are not checked
+    if width is None or height is None:
+        return True
+    return bounds[0] >= 0 and bounds[1] >= 0 and bounds[2] <= width and bounds[3] <= height
+
+def _check_bounds(annotation, task):
+    # annotation: bbox or polygon data, task: anything with the image width and height
+    if hasattr(annotation, "points"):
+        xs, ys = zip(*annotation.points)
+        bounds = min(xs), min(ys), max(xs), max(ys)
+    else:
+        bounds = annotation.x_min, annotation.y_min, annotation.x_max, annotation.y_max
+    if not within_image(bounds, task.width, task.height):
+        raise AnnotationOutOfImageException
+
+# Annotation writes check the user and every referenced task in one query (see crud.get_task_states)
+async def check_write(db:AsyncSession, user_id:int, task_ids:list[int], type:AnnotationType|None="bbox", annotations:list=()):
+    # user exists, every task exists and is open for the user, new annotations (with task_id) lie within its image
+    tasks = await crud.get_task_states(db=db, user_id=user_id, task_ids=task_ids)
+    if tasks is None:
+        raise UserNotFoundException
+    for task_id in dict.fromkeys(task_ids):
+        if task_id not in tasks:
+            raise TaskNotFoundException
+        _check_task_state(tasks[task_id], user_id, type)
+    for annotation in annotations:
+        _check_bounds(annotation, tasks[annotation.task_id])
+    return tasks
+
+async def check_annotations(db:AsyncSession, user_id:int, ids:list[int], type:AnnotationType="bbox", updates:list=()):
+    # user exists, every annotation exists and its task is open for the user, updates (with id) lie within its image
+    model, not_found = ANNOTATIONS[type]
+    annotations = await crud.get_annotation_states(db=db, user_id=user_id, model=model, ids=ids)
+    if annotations is None:
+        raise UserNotFoundException
+    if len(annotations) != len(set(ids)):
+        raise not_found
+    for task in {i.task_id: i for i in annotations.values()}.values():
+        _check_task_state(task, user_id, type)
+    for update in updates:
+        _check_bounds(update, annotations[update.id])
+
+async def check_patch(db:AsyncSession, user_id:int, task_id:int, patch:AnnotationPatch):
+    # user exists, task open for the user, updated and deleted annotations belong to it and are not used after delete.
+    # Returns the annotation model of the task
+    task = (await check_write(db=db, user_id=user_id, task_ids=[task_id], type=patch.type))[task_id]
+    for operation in patch.operations:
+        if operation.op != "delete":
+            _check_bounds(operation.bbox or operation.polygon, task)
+    model, not_found = ANNOTATIONS[annotation_type(task.task_type)]
+    task_ids = await crud.get_task_ids(db=db, model=model, ids=[i.id for i in patch.operations if i.id is not None])
+    deleted = set()
+    for operation in patch.operations:
+        if operation.id is None:
+            continue
+        if task_ids.get(operation.id) != task_id or operation.id in deleted:
+            raise not_found
+        if operation.op == "delete":
+            deleted.add(operation.id)
+    return model
+
+async def check_user(db:AsyncSession, user_id:int):
+    user = await crud.get_user_by_id(db=db,user_id=user_id)
     if not user:
         raise UserNotFoundException
-    return user
\ No newline at end of file
+    return user
+
+@contextmanager
+def stored_image():
+    # reading the stored file of an image: 404 if it is gone from disk, 415 if Pillow cannot read it
+    try:
+        yield
+    except FileNotFoundError:
+        raise ImageFileNotFoundException
+    except OSError:
+        raise UnreadableImageException
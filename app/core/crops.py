@@ -0,0 +1,87 @@
+import asyncio
+import io
+import os
+import zipfile
+from collections import OrderedDict
+from functools import partial
+from typing import Callable
+
+from PIL import Image as PILImage
+
+from app.core import imaging, tiles, workers
+from app.settings import crop_cache_max_bytes, image_domain
+
+# Crops of image regions for verification tasks (GET /image/{id}/crop, GET /task/{id}/crops).
+# Pillow decodes jpeg and png files whole, so an image is decoded once in a thread and kept in memory,
+# keyed by content hash: reviewing a task with hundreds of boxes decodes its image once.
+# Least recently used images are dropped once they take more than crop_cache_max_bytes, each app worker keeps its own.
+# Images too large for the cache are cropped from the full resolution level of their tile pyramid (see core/tiles.py)
+# instead, decoding only the tiles a crop covers.
+
+class DecodedCache:
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        # key -> image, least recently used first
+        self._images:OrderedDict[str, PILImage.Image] = OrderedDict()
+        self._total = 0
+        self._decoding:dict[str, asyncio.Future] = {}
+
+    def _add(self, key:str, image:PILImage.Image):
+        if _size(image) > self.max_bytes:
+            return
+        self._images[key] = image
+        self._total += _size(image)
+        while self._total > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self._total -= _size(evicted)
+
+    async def _decode(self, key:str, path:str) -> PILImage.Image:
+        image = await asyncio.to_thread(imaging.decode, path)
+        self._add(key, image)
+        return image
+
+    async def get(self, key:str, path:str) -> PILImage.Image:
+        if key in self._images:
+            self._images.move_to_end(key)
+            return self._images[key]
+        return await workers.shared(self._decoding, key, lambda: self._decode(key, path))
+
+def _size(image:PILImage.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+cache = DecodedCache(crop_cache_max_bytes)
+
+
+async def _reader(image) -> tuple[tuple[int, int], Callable]:
+    # (width, height) and a function box -> region of the image
+    path = image_domain + image.path
+    size = (image.width, image.height) if image.width is not None else await asyncio.to_thread(imaging.image_size, path)
+    # decoded as RGB
+    if size[0] * size[1] * 3 <= cache.max_bytes:
+        decoded = await cache.get(imaging.cache_key(image), path)
+        return decoded.size, decoded.crop
+    directory = await tiles.cache.pyramid(imaging.cache_key(image), path)
+    return size, partial(imaging.read_region, os.path.join(directory, str(imaging.max_level(*size))))
+
+async def crop(image, x0:float, y0:float, x1:float, y1:float, pad:int=0) -> bytes|None:
+    # jpeg of the region grown by pad, None if it does not overlap the image
+    size, read = await _reader(image)
+    box = imaging.crop_box(size, x0, y0, x1, y1, pad)
+    if box is None:
+        return None
+    return await asyncio.to_thread(lambda: imaging.encode_crop(read(box)))
+
+def _zip(size:tuple[int, int], read:Callable, annotations:list, pad:int) -> bytes:
+    buffer = io.BytesIO()
+    # jpeg does not compress further
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for annotation in annotations:
+            box = imaging.crop_box(size, annotation.x_min, annotation.y_min, annotation.x_max, annotation.y_max, pad)
+            if box is not None:
+                archive.writestr(f"{annotation.id}.jpg", imaging.encode_crop(read(box)))
+    return buffer.getvalue()
+
+async def crops(image, annotations:list, pad:int=0) -> bytes:
+    # zip of <annotation id>.jpg for the bounds of every annotation, from one decode of the image
+    size, read = await _reader(image)
+    return await asyncio.to_thread(_zip, size, read, annotations, pad)
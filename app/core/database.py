@@ -1,10 +1,21 @@
-from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column, relationship, Session
-from sqlalchemy import ForeignKey, create_engine, func, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import DateTime, ForeignKey, Index, event, func, text
 import enum
-from datetime import datetime, timezone
+import numpy as np
+from datetime import date, datetime, timezone
+from app.settings import database_url
+from app.core.geometry import unpack_vertices
+from app.core import spatial
 
 
+# Relationships are lazy="raise": nothing is loaded implicitly,
+# every query picks its own loader options (see crud.py)
 class Base(DeclarativeBase):
+    # asyncpg refuses aware datetimes for TIMESTAMP WITHOUT TIME ZONE
+    type_annotation_map = {datetime: DateTime(timezone=True)}
+
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__}: {*[(i.name, self.__getattribute__(i.name)) for i in self.__table__.columns],}>"
 
@@ -12,36 +23,50 @@ class Species(Base):
     __tablename__ = "species"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(unique=True)
+    # default priority of tasks on images of this species
+    priority: Mapped[int] = mapped_column(default=0, server_default="0")
 
 
 class User(Base):
     __tablename__ = "user"
     id: Mapped[int] = mapped_column(primary_key=True)
-    username: Mapped[str]
+    username: Mapped[str] = mapped_column(index=True)
     email: Mapped[str] = mapped_column(unique=True)
     hashed_password: Mapped[str]
     
-    uploaded_images: Mapped[list["Image"]] = relationship(back_populates="uploaded_user", lazy="selectin")
+    uploaded_images: Mapped[list["Image"]] = relationship(back_populates="uploaded_user", lazy="raise")
     
-    created_tasks: Mapped[list["Task"]] = relationship(back_populates="created_user", primaryjoin="user.c.id==task.c.created_user_id", lazy="selectin")
+    created_tasks: Mapped[list["Task"]] = relationship(back_populates="created_user", primaryjoin="user.c.id==task.c.created_user_id", lazy="raise")
     
-    accepted_tasks: Mapped[list["Task"]] = relationship(back_populates="accepted_user", primaryjoin="user.c.id==task.c.accepted_user_id", lazy="selectin")
+    accepted_tasks: Mapped[list["Task"]] = relationship(back_populates="accepted_user", primaryjoin="user.c.id==task.c.accepted_user_id", lazy="raise")
 
 
 class Image(Base):
     __tablename__ = "image"
     id: Mapped[int] = mapped_column(primary_key=True)
     path: Mapped[str] = mapped_column(unique=True)
+    # of the file content, unique: the same file is stored once (see core/storage.py)
+    sha256: Mapped[str|None]
+    # read from the file header at upload, None until python -m app.core.metadata for older images
+    width: Mapped[int|None]
+    height: Mapped[int|None]
+    channels: Mapped[int|None]
+    format: Mapped[str|None]
 
     species_id: Mapped[int] = mapped_column(ForeignKey("species.id"))
-    species: Mapped["Species"] = relationship()
+    species: Mapped["Species"] = relationship(lazy="raise")
     
     uploaded_user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
-    uploaded_user: Mapped["User"] = relationship(back_populates="uploaded_images")
+    uploaded_user: Mapped["User"] = relationship(back_populates="uploaded_images", lazy="raise")
     uploaded_at: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now(timezone.utc))
     
 
-    tasks: Mapped[list["Task"]] = relationship(back_populates="image",lazy="selectin")
+    tasks: Mapped[list["Task"]] = relationship(back_populates="image",lazy="raise")
+
+    __table_args__ = (
+        Index("ix_image_species_id_id", "species_id", "id"),
+        Index("ix_image_sha256", "sha256", unique=True),
+    )
 
 class TaskStatus(enum.Enum):
     pending = "pending"
@@ -62,31 +87,65 @@ class Task(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     task_type: Mapped[TaskType]
     image_id: Mapped[int] = mapped_column(ForeignKey("image.id"))
-    image: Mapped["Image"] = relationship(back_populates="tasks", foreign_keys=[image_id])
+    image: Mapped["Image"] = relationship(back_populates="tasks", foreign_keys=[image_id], lazy="raise")
 
     status: Mapped[TaskStatus] = mapped_column(default=TaskStatus.pending)
 
     created_user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
-    created_user : Mapped["User"] = relationship(back_populates="created_tasks", foreign_keys=[created_user_id])
+    created_user : Mapped["User"] = relationship(back_populates="created_tasks", foreign_keys=[created_user_id], lazy="raise")
     created_at: Mapped[datetime] = mapped_column(nullable=False,default=datetime.now(timezone.utc)) # , server_default=func.CURRENT_TIMESTAMP()
     
     accepted_user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=True)
-    accepted_user: Mapped["User"] = relationship(back_populates="accepted_tasks", foreign_keys=[accepted_user_id])
+    accepted_user: Mapped["User"] = relationship(back_populates="accepted_tasks", foreign_keys=[accepted_user_id], lazy="raise")
     accepted_at: Mapped[None|datetime] = mapped_column(nullable=True)
 
     finished_at: Mapped[None|datetime] = mapped_column(nullable=True)
+
+    # dispatch order: higher first, then older first
+    priority: Mapped[int] = mapped_column(default=0, server_default="0")
+
+    # lease of an accepted task, see core/leases.py
+    expires_at: Mapped[None|datetime] = mapped_column(nullable=True)
+
+    # bumped by every PATCH /task/{id}/annotations
+    revision: Mapped[int] = mapped_column(default=0, server_default="0")
     
-    bboxes: Mapped[list["BboxAnnotation"]] = relationship(back_populates="task", primaryjoin="task.c.id==bbox_annotation.c.task_id", lazy="selectin")
-    polygons: Mapped[list["PolyAnnotation"]] = relationship(back_populates="task", primaryjoin="task.c.id==poly_annotation.c.task_id", lazy="selectin")
+    bboxes: Mapped[list["BboxAnnotation"]] = relationship(back_populates="task", primaryjoin="task.c.id==bbox_annotation.c.task_id", lazy="raise")
+    polygons: Mapped[list["PolyAnnotation"]] = relationship(back_populates="task", primaryjoin="task.c.id==poly_annotation.c.task_id", lazy="raise")
+
+    __table_args__ = (
+        # in dispatch order for every combination of the GET /task/ filters
+        Index("ix_task_status_task_type_priority_id", "status", "task_type", text("priority DESC"), "id"),
+        Index("ix_task_status_priority_id", "status", text("priority DESC"), "id"),
+        Index("ix_task_task_type_priority_id", "task_type", text("priority DESC"), "id"),
+        Index("ix_task_priority_id", text("priority DESC"), "id"),
+        Index("ix_task_image_id", "image_id"),
+        Index("ix_task_status_expires_at", "status", "expires_at"),
+    )
 
 
 class BboxAnnotation(Base):
     __tablename__ = "bbox_annotation"
     id: Mapped[int]=mapped_column(primary_key=True)
-    bbox:Mapped[str] = mapped_column(nullable=False)
+    # pixel coordinates, x_min < x_max and y_min < y_max
+    x_min: Mapped[float]
+    y_min: Mapped[float]
+    x_max: Mapped[float]
+    y_max: Mapped[float]
+    label: Mapped[str|None]
+    score: Mapped[float|None]
 
     task_id: Mapped[int] = mapped_column(ForeignKey("task.id"))
-    task:Mapped[Task] = relationship(back_populates="bboxes")
+    task:Mapped[Task] = relationship(back_populates="bboxes", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_bbox_annotation_task_id_id", "task_id", "id"),
+    )
+
+    # works both on instances and in queries, e.g. filter(BboxAnnotation.area > 100)
+    @hybrid_property
+    def area(self) -> float:
+        return (self.x_max - self.x_min) * (self.y_max - self.y_min)
     # image_id: Mapped[int]=mapped_column(ForeignKey("image.id"))
     # image: Mapped["Image"] = relationship(back_populates="bbox_annotations")
 
@@ -97,10 +156,28 @@ class BboxAnnotation(Base):
 class PolyAnnotation(Base):
     __tablename__ = "poly_annotation"
     id: Mapped[int]=mapped_column(primary_key=True)
-    polygon:Mapped[str] = mapped_column(nullable=False)
+    # packed float32 vertices and their bounds, see core/geometry.py
+    vertices: Mapped[bytes]
+    vertex_count: Mapped[int]
+    x_min: Mapped[float]
+    y_min: Mapped[float]
+    x_max: Mapped[float]
+    y_max: Mapped[float]
 
     task_id: Mapped[int] = mapped_column(ForeignKey("task.id"))
-    task:Mapped[Task] = relationship(back_populates="polygons")
+    task:Mapped[Task] = relationship(back_populates="polygons", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_poly_annotation_task_id_id", "task_id", "id"),
+    )
+
+    @property
+    def vertex_array(self) -> np.ndarray:
+        return unpack_vertices(self.vertices)
+
+    @property
+    def points(self) -> list[list[float]]:
+        return self.vertex_array.tolist()
     # image_id:Mapped[int]=mapped_column(ForeignKey("image.id"))
     # image: Mapped["Image"] = relationship(back_populates="poly_annotations")
 
@@ -109,79 +186,39 @@ class PolyAnnotation(Base):
     # user: Mapped[list["User"]] = relationship(back_populates="polygons")
 
 
-engine = create_engine("sqlite+pysqlite:///database.db", echo=False, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
+# Counters for /stats, kept up to date by crud within the writing transaction (see core/stats.py)
+class TaskCount(Base):
+    __tablename__ = "task_count"
+    # TaskStatus and TaskType names
+    status: Mapped[str] = mapped_column(primary_key=True)
+    task_type: Mapped[str] = mapped_column(primary_key=True)
+    count: Mapped[int]
+
+class AnnotationCount(Base):
+    __tablename__ = "annotation_count"
+    species_id: Mapped[int] = mapped_column(primary_key=True)
+    # "bbox" or "poly"
+    kind: Mapped[str] = mapped_column(primary_key=True)
+    count: Mapped[int]
+
+class FinishedTaskCount(Base):
+    __tablename__ = "finished_task_count"
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    # UTC day of finished_at
+    day: Mapped[date] = mapped_column(primary_key=True)
+    count: Mapped[int]
+
+
+# spatial index is not a plain table, create it along with the annotation tables
+for table in [BboxAnnotation.__table__, PolyAnnotation.__table__]:
+    event.listen(table, "after_create", lambda target, connection, **kw: spatial.install(connection, target.name))
+
+
+engine = create_async_engine(database_url, echo=False)
+# expire_on_commit=False: expired attributes would need a lazy load, which AsyncSession cannot do implicitly
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-
-if __name__ == "__main__":
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
-    from sqlalchemy_schemadisplay import create_schema_graph
-    from sqlalchemy import MetaData
-    import os
-    os.environ["PATH"] += os.pathsep + r"C:\Users\m.v.selickij\Downloads\windows_10_cmake_Release_Graphviz-10.0.1-win64\Graphviz-10.0.1-win64\bin"
-    graph = create_schema_graph(metadata=Base.metadata, engine=engine)
-    graph.write_png("entity_relationship_diagram.png")
-
-
-    with Session(engine) as session:
-        admin = User(username="admin",email="admin@gmail.com",hashed_password="admin")
-        
-        img1 = Image(path="/data/storage_1/images/cell1.jpg", species="gallus gallus", uploaded_user=admin)
-        
-        img2 = Image(path="/data/storage_1/images/cell2.jpg", species="gallus gallus", uploaded_user=admin)
-
-        task1 = Task(task_type=TaskType.bbox_annotation, image=img1, created_user=admin)
-        task2 = Task(task_type=TaskType.poly_annotation, image=img1, created_user=admin)
-        task3 = Task(task_type=TaskType.bbox_verification, image=img1, created_user=admin)
-        
-        task4 = Task(task_type=TaskType.bbox_annotation, image=img2, created_user=admin)
-
-        user1 = User(username="Max", email="makc.sel@gmail.com", hashed_password="1234")
-        user2 = User(username="Anon", email="anon@gmail.com", hashed_password="1234")
-
-        task1.accepted_user = user2
-        task1.accepted_at = datetime.now(timezone.utc)
-        session.add_all([admin,user1,user2])
-        session.commit()
-
-        print(admin)
-
-        print(img1, img1.created_at)
-        print(task1, task1.accepted_user, task1.created_at, task1.accepted_at, task1.finished_at)
-        print(user1)
-        print(user2, user2.accepted_tasks)
-
-    # user2 accepted task insert result in db
-    # we should ensure that user who insert annotations is the same user that accept task
-    with Session(engine) as session:
-        bbox1 = BboxAnnotation(bbox="(12.3, 34.3), (23,56.3)", task=task1)
-        bbox2 = BboxAnnotation(bbox="(0.3, 0.3), (13,13)", task=task1)
-
-        task1.finished_at = datetime.now(timezone.utc)
-        img1.bbox_annotated = True
-
-        session.add_all([bbox1,bbox2])
-        session.commit()
-
-
-        print(img1)
-        print(bbox1)
-        print(bbox2)
-        print(task1)
-        print(task1.bboxes)
-
-    with Session(engine) as session:
-        res = session.execute(select(Task).where(Task.finished_at != None)).scalars()
-        for i in res:
-            print(i)
-            for bbox in i.bboxes:
-                print("\t",bbox)
\ No newline at end of file
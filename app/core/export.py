@@ -0,0 +1,220 @@
+import asyncio
+import io
+import json
+import posixpath
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import BboxAnnotation, Image, PolyAnnotation, SessionLocal, Species, Task, TaskStatus, TaskType
+from app.core.geometry import polygon_area, unpack_vertices
+from app.core.imaging import image_size
+from app.settings import image_domain
+
+# Dataset export of finished annotations, streamed while it is read.
+# Rows come from server-side cursors (AsyncSession.stream) and leave as chunks of about CHUNK_SIZE bytes,
+# so memory does not grow with the size of the export.
+# Generators open their own session: the request one is closed before the response body is sent.
+# Images whose size is neither stored nor readable from their file are left out with their annotations
+# and listed at the end (COCO "skipped_images", YOLO skipped.txt), the response has started by then.
+
+CHUNK_SIZE = 64 * 1024
+YIELD_PER = 1000
+# images per YOLO batch, their annotations are read in one query
+IMAGE_BATCH = 500
+
+
+@dataclass
+class ExportFilter:
+    species_id: int|None = None
+    task_type: TaskType|None = None
+    finished_from: datetime|None = None
+    finished_to: datetime|None = None
+    # YOLO: only tasks of one annotation kind
+    task_types: list[TaskType]|None = None
+
+    def tasks(self) -> list:
+        # conditions on Task and Image of the exported tasks
+        conditions = [Task.status == TaskStatus.finished]
+        if self.species_id is not None:
+            conditions.append(Image.species_id == self.species_id)
+        if self.task_type is not None:
+            conditions.append(Task.task_type == self.task_type)
+        if self.finished_from is not None:
+            conditions.append(Task.finished_at >= self.finished_from)
+        if self.finished_to is not None:
+            conditions.append(Task.finished_at < self.finished_to)
+        if self.task_types is not None:
+            conditions.append(Task.task_type.in_(self.task_types))
+        return conditions
+
+    def images(self):
+        # images with at least one exported task
+        return select(Image.id, Image.path, Image.species_id, Image.width, Image.height).where(
+            exists().where(Task.image_id == Image.id, *self.tasks())
+        )
+
+
+async def _size(image) -> tuple[int, int]|None:
+    # stored at upload, read from the file for images not backfilled yet, None without a readable file
+    if image.width is not None and image.height is not None:
+        return image.width, image.height
+    try:
+        return await asyncio.to_thread(image_size, image_domain + image.path)
+    except OSError:
+        return None
+
+async def _rows(db:AsyncSession, stmt) -> AsyncIterator:
+    result = await db.stream(stmt.execution_options(yield_per=YIELD_PER))
+    async for row in result:
+        yield row
+
+def _annotations(model, filter:ExportFilter):
+    return (
+        select(model, Task.image_id, Image.species_id)
+        .join(Task, model.task_id == Task.id)
+        .join(Image, Task.image_id == Image.id)
+        .where(*filter.tasks())
+    )
+
+async def _chunked(parts:AsyncIterator[str]) -> AsyncIterator[bytes]:
+    # the first part goes out at once, the rest in CHUNK_SIZE pieces
+    buffer, size, first = [], 0, True
+    async for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if first or size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer, size, first = [], 0, False
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+async def _coco_parts(filter:ExportFilter) -> AsyncIterator[str]:
+    async with SessionLocal() as db:
+        info = {"description": "exported finished annotations", "date_created": datetime.now(timezone.utc).isoformat()}
+        yield '{"info": ' + json.dumps(info) + ', "images": ['
+
+        separator, skipped = "", []
+        async for image in _rows(db, filter.images().order_by(Image.id)):
+            size = await _size(image)
+            if size is None:
+                skipped.append(image.id)
+                continue
+            yield separator + json.dumps({"id": image.id, "file_name": image.path.lstrip("/"), "width": size[0], "height": size[1]})
+            separator = ", "
+        excluded = set(skipped)
+
+        yield '], "annotations": ['
+        separator, id = "", 0
+        async for bbox, image_id, species_id in _rows(db, _annotations(BboxAnnotation, filter).order_by(BboxAnnotation.id)):
+            if image_id in excluded:
+                continue
+            id += 1
+            width, height = bbox.x_max - bbox.x_min, bbox.y_max - bbox.y_min
+            annotation = {
+                "id": id, "image_id": image_id, "category_id": species_id,
+                "bbox": [bbox.x_min, bbox.y_min, width, height], "area": width * height, "iscrowd": 0,
+            }
+            if bbox.label is not None:
+                annotation["label"] = bbox.label
+            if bbox.score is not None:
+                annotation["score"] = bbox.score
+            yield separator + json.dumps(annotation)
+            separator = ", "
+        async for polygon, image_id, species_id in _rows(db, _annotations(PolyAnnotation, filter).order_by(PolyAnnotation.id)):
+            if image_id in excluded:
+                continue
+            id += 1
+            vertices = unpack_vertices(polygon.vertices)
+            yield separator + json.dumps({
+                "id": id, "image_id": image_id, "category_id": species_id,
+                "segmentation": [vertices.ravel().tolist()],
+                "bbox": [polygon.x_min, polygon.y_min, polygon.x_max - polygon.x_min, polygon.y_max - polygon.y_min],
+                "area": polygon_area(vertices), "iscrowd": 0,
+            })
+            separator = ", "
+
+        yield '], "categories": '
+        species = await db.execute(select(Species.id, Species.name).order_by(Species.id))
+        yield json.dumps([{"id": id, "name": name} for id, name in species])
+        yield ', "skipped_images": ' + json.dumps(skipped) + "}"
+
+def coco(filter:ExportFilter) -> AsyncIterator[bytes]:
+    # one COCO json, annotation ids are numbered in the order they are written,
+    # skipped_images: ids of images left out
+    return _chunked(_coco_parts(filter))
+
+
+class _ZipStream(io.RawIOBase):
+    # write-only sink for zipfile, not seekable so entries are written with data descriptors
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _yolo_lines(model, rows, width:int, height:int) -> list[str]:
+    lines = []
+    for annotation, class_id in rows:
+        if model is BboxAnnotation:
+            x_center, y_center = (annotation.x_min + annotation.x_max) / 2 / width, (annotation.y_min + annotation.y_max) / 2 / height
+            w, h = (annotation.x_max - annotation.x_min) / width, (annotation.y_max - annotation.y_min) / height
+            values = [x_center, y_center, w, h]
+        else:
+            values = (unpack_vertices(annotation.vertices) / (width, height)).ravel().tolist()
+        lines.append(" ".join([str(class_id), *(f"{i:.6f}" for i in values)]))
+    return lines
+
+async def yolo(filter:ExportFilter, model) -> AsyncIterator[bytes]:
+    # zip of classes.txt and labels/<image file stem>.txt,
+    # one "class x_center y_center width height" line per bbox or "class x1 y1 x2 y2 ..." per polygon, normalized to the image size,
+    # and skipped.txt with the paths of images left out if there are any
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED)
+    async with SessionLocal() as db:
+        species = (await db.execute(select(Species.id, Species.name).order_by(Species.id))).all()
+        classes = {id: i for i, (id, name) in enumerate(species)}
+        archive.writestr("classes.txt", "".join(f"{name}\n" for id, name in species))
+        yield stream.take()
+
+        after_id, skipped = 0, []
+        while True:
+            images = (await db.execute(
+                filter.images().where(Image.id > after_id).order_by(Image.id).limit(IMAGE_BATCH)
+            )).all()
+            if not images:
+                break
+            after_id = images[-1].id
+            sizes = await asyncio.gather(*[_size(image) for image in images])
+
+            labels = {image.id: [] for image in images}
+            stmt = _annotations(model, filter).where(Task.image_id.in_(labels)).order_by(model.id)
+            async for annotation, image_id, species_id in _rows(db, stmt):
+                labels[image_id].append((annotation, classes[species_id]))
+
+            for image, size in zip(images, sizes):
+                if size is None:
+                    skipped.append(image.path)
+                    continue
+                width, height = size
+                stem = posixpath.splitext(posixpath.basename(image.path))[0]
+                archive.writestr(f"labels/{stem}.txt", "".join(f"{i}\n" for i in _yolo_lines(model, labels[image.id], width, height)))
+            yield stream.take()
+
+    if skipped:
+        archive.writestr("skipped.txt", "".join(f"{i}\n" for i in skipped))
+    archive.close()
+    yield stream.take()
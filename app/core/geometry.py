@@ -0,0 +1,33 @@
+import numpy as np
+
+# Polygon vertices are stored as one buffer of little-endian float32 (x, y) pairs,
+# 8 bytes per vertex, so reading a polygon is a single np.frombuffer without parsing.
+VERTEX_DTYPE = np.dtype("<f4")
+
+
+def pack_polygon(points) -> dict:
+    # columns of database.PolyAnnotation for the given [(x, y), ...]
+    # values beyond float32 become infinity
+    with np.errstate(over="ignore"):
+        vertices = np.asarray(points, dtype=VERTEX_DTYPE)
+    if vertices.ndim != 2 or vertices.shape[1] != 2:
+        raise ValueError("polygon points must be (x, y) pairs")
+    x_min, y_min = vertices.min(axis=0).tolist()
+    x_max, y_max = vertices.max(axis=0).tolist()
+    return {
+        "vertices": vertices.tobytes(),
+        "vertex_count": len(vertices),
+        "x_min": x_min,
+        "y_min": y_min,
+        "x_max": x_max,
+        "y_max": y_max,
+    }
+
+def unpack_vertices(vertices:bytes) -> np.ndarray:
+    # zero-copy read-only (n, 2) view over the stored buffer
+    return np.frombuffer(vertices, dtype=VERTEX_DTYPE).reshape(-1, 2)
+
+def polygon_area(vertices:np.ndarray) -> float:
+    # shoelace formula, in float64 to keep float32 vertices from losing precision
+    x, y = vertices.astype(np.float64).T
+    return abs(float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))) / 2
@@ -0,0 +1,39 @@
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+# Conditional GET for files. FileResponse answers Range and If-Range requests itself,
+# a matching If-None-Match (or If-Modified-Since without it) gets an empty 304 here.
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def _etag(stat:os.stat_result) -> str:
+    # same as FileResponse's own, for files without a content hash
+    return '"' + hashlib.md5(f"{stat.st_mtime}-{stat.st_size}".encode(), usedforsecurity=False).hexdigest() + '"'
+
+def _not_modified(request:Request, etag:str, stat:os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [i.strip().removeprefix("W/") for i in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def file_response(request:Request, path:str, sha256:str|None=None, cache_control:str=REVALIDATE, media_type:str|None=None, headers:dict|None=None) -> Response:
+    # strong ETag from the content hash when there is one, else from mtime and size
+    stat = os.stat(path)
+    etag = f'"{sha256}"' if sha256 else _etag(stat)
+    headers = {**(headers or {}), "ETag": etag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True), "Cache-Control": cache_control}
+    if _not_modified(request, etag, stat):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path=path, media_type=media_type, headers=headers, stat_result=stat)
@@ -0,0 +1,137 @@
+import io
+import math
+import os
+from typing import BinaryIO
+import numpy as np
+from PIL import Image as PILImage
+
+from app.settings import image_max_pixels
+
+# Image decoding helpers. Kept free of database imports: build_pyramid and make_thumbnail run in
+# spawned worker processes that import this module (see core/workers.py).
+
+# files come from known users and are checked against image_max_pixels when stored (read_metadata),
+# set here so worker processes decode large frames as well
+PILImage.MAX_IMAGE_PIXELS = None
+
+TILE_SIZE = 256
+TILE_QUALITY = 90
+THUMBNAIL_SIZE = 128
+THUMBNAIL_QUALITY = 85
+CROP_QUALITY = 90
+
+
+def cache_key(image) -> str:
+    # name of files derived from an image (tiles, thumbnails), shared by images of the same content
+    return image.sha256 or f"image-{image.id}"
+
+def image_size(path:str) -> tuple[int, int]:
+    # (width, height) from the file header, pixels are not decoded
+    with PILImage.open(path) as image:
+        return image.size
+
+class ImageTooLargeError(Exception):
+    pass
+
+def read_metadata(file:str|BinaryIO) -> dict|None:
+    # {"width", "height", "channels", "format"} from the header, None if it is not an image Pillow reads.
+    # ImageTooLargeError above image_max_pixels
+    try:
+        with PILImage.open(file) as image:
+            metadata = {"width": image.width, "height": image.height, "channels": len(image.getbands()), "format": image.format}
+    except (PILImage.UnidentifiedImageError, ValueError):
+        return None
+    if metadata["width"] * metadata["height"] > image_max_pixels:
+        raise ImageTooLargeError(f"image of {metadata['width']}x{metadata['height']} pixels is over the limit of {image_max_pixels}")
+    return metadata
+
+def to_rgb(image:PILImage.Image) -> PILImage.Image:
+    # 16 bit and float microscopy frames are stretched to their own min..max, everything else converted as is
+    if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+        pixels = np.asarray(image, dtype=np.float32)
+        low, high = float(pixels.min()), float(pixels.max())
+        pixels = (pixels - low) * (255 / (high - low)) if high > low else np.zeros_like(pixels)
+        image = PILImage.fromarray(pixels.astype(np.uint8))
+    return image.convert("RGB")
+
+
+# DeepZoom pyramid: level max_level is the full image, every level below halves it, level 0 is 1x1.
+# Tiles are TILE_SIZE squares without overlap, cut from the top left, the last row and column smaller
+def max_level(width:int, height:int) -> int:
+    return math.ceil(math.log2(max(width, height, 1)))
+
+def level_size(width:int, height:int, level:int) -> tuple[int, int]:
+    scale = 2 ** (max_level(width, height) - level)
+    return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
+
+def build_pyramid(source:str, directory:str) -> int:
+    # writes directory/<level>/<x>_<y>.jpg for every level, returns the total size in bytes.
+    # Each level is resized from the one above, the original is decoded once
+    with PILImage.open(source) as file:
+        image = to_rgb(file)
+    width, height = image.size
+    total = 0
+    for level in range(max_level(width, height), -1, -1):
+        size = level_size(width, height, level)
+        if image.size != size:
+            image = image.resize(size, PILImage.Resampling.LANCZOS)
+        os.makedirs(os.path.join(directory, str(level)))
+        for x in range(math.ceil(size[0] / TILE_SIZE)):
+            for y in range(math.ceil(size[1] / TILE_SIZE)):
+                path = os.path.join(directory, str(level), f"{x}_{y}.jpg")
+                image.crop((x * TILE_SIZE, y * TILE_SIZE, min(size[0], (x + 1) * TILE_SIZE), min(size[1], (y + 1) * TILE_SIZE))).save(path, quality=TILE_QUALITY)
+                total += os.path.getsize(path)
+    return total
+
+
+def make_thumbnail(source:str, destination:str, size:int=THUMBNAIL_SIZE):
+    # fits the image into size x size, jpeg sources are decoded at a reduced scale (draft)
+    with PILImage.open(source) as file:
+        file.draft("RGB", (size, size))
+        image = to_rgb(file)
+    image.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+    part = f"{destination}.{os.getpid()}.part"
+    image.save(part, format="JPEG", quality=THUMBNAIL_QUALITY)
+    os.replace(part, destination)
+
+def sprite(paths:list[str|None], columns:int, size:int=THUMBNAIL_SIZE) -> bytes:
+    # jpeg grid of size x size cells in paths order, left to right then top to bottom,
+    # each thumbnail centered in its cell, cells of None left blank
+    rows = math.ceil(len(paths) / columns)
+    sheet = PILImage.new("RGB", (min(len(paths), columns) * size, rows * size), (255, 255, 255))
+    for i, path in enumerate(paths):
+        if path is None:
+            continue
+        with PILImage.open(path) as thumbnail:
+            x, y = i % columns * size, i // columns * size
+            sheet.paste(thumbnail, (x + (size - thumbnail.width) // 2, y + (size - thumbnail.height) // 2))
+    buffer = io.BytesIO()
+    sheet.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+
+def decode(path:str) -> PILImage.Image:
+    # whole image in memory, for repeated crops (see core/crops.py)
+    with PILImage.open(path) as file:
+        image = to_rgb(file)
+    image.load()
+    return image
+
+def crop_box(size:tuple[int, int], x0:float, y0:float, x1:float, y1:float, pad:int=0) -> tuple[int, int, int, int]|None:
+    # pixels covering the region grown by pad, cut to the image, None if nothing is left
+    box = (max(0, math.floor(x0) - pad), max(0, math.floor(y0) - pad), min(size[0], math.ceil(x1) + pad), min(size[1], math.ceil(y1) + pad))
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+def read_region(level:str, box:tuple[int, int, int, int]) -> PILImage.Image:
+    # box from the tiles in level, a directory of build_pyramid, decoding only the tiles it covers
+    region = PILImage.new("RGB", (box[2] - box[0], box[3] - box[1]))
+    for x in range(box[0] // TILE_SIZE, (box[2] - 1) // TILE_SIZE + 1):
+        for y in range(box[1] // TILE_SIZE, (box[3] - 1) // TILE_SIZE + 1):
+            with PILImage.open(os.path.join(level, f"{x}_{y}.jpg")) as tile:
+                region.paste(tile, (x * TILE_SIZE - box[0], y * TILE_SIZE - box[1]))
+    return region
+
+def encode_crop(region:PILImage.Image) -> bytes:
+    buffer = io.BytesIO()
+    region.save(buffer, format="JPEG", quality=CROP_QUALITY)
+    return buffer.getvalue()
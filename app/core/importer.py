@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import posixpath
+import re
+import tarfile
+import threading
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import BinaryIO
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud
+from app.core import imaging, stats, storage
+from app.core.common import within_image
+from app.core.database import BboxAnnotation, Image, PolyAnnotation, SessionLocal, Species, Task, TaskStatus, TaskType, engine
+from app.core.geometry import pack_polygon
+from app.schemas import SPECIES_NAME_PATTERN, ImageMetadata, ImportResult
+from app.settings import image_domain, import_workers
+
+# COCO dataset import: images, species (one per category), finished tasks and their annotations.
+# Files are copied into image_domain by a thread pool, rows are written with bulk inserts,
+# one transaction per batch of images.
+# Files are content addressed like uploads (see core/storage.py): /<species>/<sha256>.<ext>.
+# Resumable: an image whose content is already stored under its species is skipped, so running the same
+# import again continues where it stopped, reading the files done before again but not registering them twice.
+# Images with the content of an image stored elsewhere (Image.sha256) are left out with their annotations.
+
+BATCH_SIZE = 1000
+
+
+# Image sources, open(name) -> binary file or None. Names are COCO file_name, matched by path, then by base name
+class _Directory:
+    def __init__(self, root:str):
+        self.root = root
+
+    def open(self, name:str) -> BinaryIO|None:
+        for path in [os.path.join(self.root, name), os.path.join(self.root, posixpath.basename(name))]:
+            if os.path.isfile(path):
+                return open(path, "rb")
+        return None
+
+    def close(self):
+        pass
+
+def _index(members:dict) -> dict:
+    # path -> member, plus base name -> member for unambiguous base names
+    names = Counter(posixpath.basename(i) for i in members)
+    index = {posixpath.basename(name): member for name, member in members.items() if names[posixpath.basename(name)] == 1}
+    index.update(members)
+    return index
+
+class _Zip:
+    def __init__(self, file):
+        self.zip = zipfile.ZipFile(file)
+        self.members = _index({i.filename: i for i in self.zip.infolist() if not i.is_dir()})
+
+    def open(self, name:str) -> BinaryIO|None:
+        # zipfile reads members from several threads through its own lock, inflating runs in parallel
+        member = self.members.get(name) or self.members.get(posixpath.basename(name))
+        return self.zip.open(member) if member else None
+
+    def close(self):
+        self.zip.close()
+
+class _Tar:
+    def __init__(self, file):
+        self.tar = tarfile.open(fileobj=file) if hasattr(file, "read") else tarfile.open(file)
+        self.members = _index({i.name: i for i in self.tar.getmembers() if i.isfile()})
+        # tarfile is not thread safe
+        self.lock = threading.Lock()
+
+    def open(self, name:str) -> BinaryIO|None:
+        member = self.members.get(name) or self.members.get(posixpath.basename(name))
+        if not member:
+            return None
+        with self.lock:
+            file = self.tar.extractfile(member)
+            # read whole under the lock, copied to disk outside of it
+            return file and io.BytesIO(file.read())
+
+    def close(self):
+        self.tar.close()
+
+def open_source(source:str|BinaryIO):
+    # directory path, or path or seekable file of a zip or tar (any compression)
+    if isinstance(source, str) and os.path.isdir(source):
+        return _Directory(source)
+    if zipfile.is_zipfile(source):
+        if not isinstance(source, str):
+            source.seek(0)
+        return _Zip(source)
+    if not isinstance(source, str):
+        source.seek(0)
+    try:
+        return _Tar(source)
+    except tarfile.TarError as e:
+        raise ValueError("images must be a directory, zip or tar archive") from e
+
+
+def check_species_name(name:str):
+    # ValueError if the name would leave its directory under image_domain (see schemas.SpeciesCreate)
+    if not re.match(SPECIES_NAME_PATTERN, name):
+        raise ValueError(f"invalid species name {name!r}")
+
+def parse_coco(data:bytes) -> dict:
+    # ValueError if it is not a COCO dataset
+    try:
+        dataset = json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"invalid json: {e}") from e
+    if not isinstance(dataset, dict) or not all(isinstance(dataset.get(i, []), list) for i in ["images", "annotations", "categories"]):
+        raise ValueError("images, annotations and categories must be lists")
+    try:
+        for image in dataset.get("images", []):
+            int(image["id"]), str(image["file_name"])
+        for category in dataset.get("categories", []):
+            int(category["id"])
+            check_species_name(str(category["name"]))
+        categories = {i["id"] for i in dataset.get("categories", [])}
+        for annotation in dataset.get("annotations", []):
+            int(annotation["image_id"])
+            if annotation["category_id"] not in categories:
+                raise ValueError(f"annotation {annotation.get('id')}: unknown category {annotation['category_id']}")
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"missing or invalid field {e}") from e
+    return dataset
+
+def _finite(row:dict) -> bool:
+    # json reads NaN and Infinity, float32 polygon vertices overflow to infinity
+    return all(math.isfinite(row[i]) for i in ["x_min", "y_min", "x_max", "y_max"])
+
+def _bbox(annotation:dict) -> dict|None:
+    try:
+        x, y, w, h = map(float, annotation.get("bbox"))
+    except (TypeError, ValueError):
+        return None
+    if w <= 0 or h <= 0:
+        return None
+    row = {"x_min": x, "y_min": y, "x_max": x + w, "y_max": y + h}
+    return row if _finite(row) else None
+
+def _polygons(annotation:dict) -> list[dict]:
+    # one polygon per part of a polygon segmentation, RLE masks have none
+    segmentation = annotation.get("segmentation")
+    if not isinstance(segmentation, list):
+        return []
+    return [
+        pack_polygon(list(zip(part[::2], part[1::2])))
+        for part in segmentation if isinstance(part, list) and len(part) >= 6 and len(part) % 2 == 0
+    ]
+
+def _split(annotations:list[dict], metadata:dict|None, result:ImportResult) -> tuple[list[dict], list[dict]]:
+    # (bbox rows, polygon rows): polygons of a segmentation if it has any, else the bbox.
+    # Annotations outside the image (metadata from its header) are invalid, as they are for the API
+    size = (metadata or {}).get("width"), (metadata or {}).get("height")
+    inside = lambda row: _finite(row) and within_image((row["x_min"], row["y_min"], row["x_max"], row["y_max"]), *size)
+    bboxes, polygons = [], []
+    for annotation in annotations:
+        try:
+            parts = _polygons(annotation)
+        except (TypeError, ValueError):
+            parts = []
+        if parts and not all(map(inside, parts)):
+            result.invalid += 1
+        elif parts:
+            polygons.extend(parts)
+        elif (bbox := _bbox(annotation)) and inside(bbox):
+            bboxes.append(bbox)
+        else:
+            result.invalid += 1
+    return bboxes, polygons
+
+
+def _copy(source, name:str, directory:str) -> tuple[str, str, dict|None]|None:
+    # runs in the pool, (file name, sha256, metadata) of the file stored in directory under its content name,
+    # None if the source has no such file. ImageTooLargeError over the pixel limit, nothing is stored then
+    file = source.open(name)
+    if file is None:
+        return None
+    sha256, metadata = storage.save_file(file, directory, name, imaging.read_metadata)
+    return storage.content_name(sha256, name), sha256, metadata
+
+async def _get_species(db:AsyncSession, names:set[str]) -> dict[str, Species]:
+    existing = await db.execute(select(Species).filter(Species.name.in_(names)))
+    species = {i.name: i for i in existing.scalars()}
+    for name in names - species.keys():
+        species[name] = Species(name=name)
+        db.add(species[name])
+    await db.commit()
+    for i in species.values():
+        os.makedirs(image_domain + f"/{i.name}", exist_ok=True)
+    return species
+
+async def _write_batch(db:AsyncSession, user_id:int, images:list[dict], empty_task_type:TaskType|None, result:ImportResult):
+    # images: {"path", "sha256", "metadata", "species", "bboxes", "polygons"}, one transaction
+    now = datetime.now(timezone.utc)
+    created = await crud.insert_many(db, Image, [
+        {"path": i["path"], "sha256": i["sha256"], **ImageMetadata(**(i["metadata"] or {})).model_dump(), "species_id": i["species"].id, "uploaded_user_id": user_id, "uploaded_at": now} for i in images
+    ])
+    image_ids = {i.path: i.id for i in created}
+
+    task_rows, task_annotations = [], []
+    for image in images:
+        task = {"image_id": image_ids[image["path"]], "created_user_id": user_id, "created_at": now, "priority": image["species"].priority}
+        for task_type, annotations in [(TaskType.bbox_annotation, image["bboxes"]), (TaskType.poly_annotation, image["polygons"])]:
+            if annotations:
+                task_rows.append({**task, "task_type": task_type, "status": TaskStatus.finished, "accepted_user_id": user_id, "accepted_at": now, "finished_at": now})
+                task_annotations.append(annotations)
+        if not (image["bboxes"] or image["polygons"]) and empty_task_type is not None:
+            task_rows.append({**task, "task_type": empty_task_type, "status": TaskStatus.pending})
+            task_annotations.append([])
+    # tasks come back in insert order
+    tasks = await crud.insert_many(db, Task, task_rows)
+
+    rows = {BboxAnnotation: [], PolyAnnotation: []}
+    species_counts = {BboxAnnotation: Counter(), PolyAnnotation: Counter()}
+    species_ids = {i.id: i.species_id for i in created}
+    for task, annotations in zip(tasks, task_annotations):
+        model = PolyAnnotation if task.task_type == TaskType.poly_annotation else BboxAnnotation
+        rows[model].extend({**i, "task_id": task.id} for i in annotations)
+        species_counts[model][species_ids[task.image_id]] += len(annotations)
+    for model, values in rows.items():
+        if values:
+            await db.execute(insert(model), values)
+        await stats.count_species_annotations(db, model, species_counts[model])
+
+    await stats.count_tasks(db, Counter((i.status, i.task_type) for i in tasks))
+    finished = sum(i.status == TaskStatus.finished for i in tasks)
+    if finished:
+        await stats.count_finished(db, user_id, now.date(), finished)
+    await db.commit()
+    # keep the identity map from growing with the import
+    db.expunge_all()
+
+    result.images += len(images)
+    result.tasks += len(tasks)
+    result.bboxes += len(rows[BboxAnnotation])
+    result.polygons += len(rows[PolyAnnotation])
+
+async def import_coco(
+    dataset:dict,
+    source,
+    user_id:int,
+    species:str|None=None,
+    empty_task_type:TaskType|None=None,
+    batch_size:int=BATCH_SIZE,
+    workers:int=import_workers,
+) -> ImportResult:
+    # dataset from parse_coco, source from open_source.
+    # Each image gets a finished bbox_annotation task with its bboxes and a finished poly_annotation task
+    # with its polygons, images without annotations a pending task of empty_task_type (none if None).
+    # species: name of the species of all images, by default the category of the first annotation of an image,
+    # ValueError if it is not a valid species name
+    if species is not None:
+        check_species_name(species)
+    result = ImportResult()
+    categories = {i["id"]: i["name"] for i in dataset.get("categories", [])}
+    annotations = defaultdict(list)
+    for annotation in dataset.get("annotations", []):
+        annotations[annotation["image_id"]].append(annotation)
+
+    async with SessionLocal() as db:
+        names = {species} if species else {categories[i["category_id"]] for i in dataset.get("annotations", [])}
+        species_by_name = await _get_species(db, names)
+
+        images = dataset.get("images", [])
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(images), batch_size):
+                batch = []
+                for image in images[start:start + batch_size]:
+                    image_annotations = annotations.get(image["id"], [])
+                    if species:
+                        image_species = species_by_name[species]
+                    elif image_annotations:
+                        image_species = species_by_name[categories[image_annotations[0]["category_id"]]]
+                    else:
+                        result.unassigned += 1
+                        continue
+                    batch.append({"coco": image, "species": image_species, "annotations": image_annotations})
+
+                copied = await asyncio.gather(*[
+                    loop.run_in_executor(pool, _copy, source, i["coco"]["file_name"], image_domain + f"/{i['species'].name}") for i in batch
+                ], return_exceptions=True)
+                for i, file in enumerate(copied):
+                    if isinstance(file, imaging.ImageTooLargeError):
+                        result.too_large += 1
+                        copied[i] = False
+                    elif isinstance(file, BaseException):
+                        raise file
+                result.missing += copied.count(None)
+                stored = {sha256: i.path for sha256, i in (await crud.get_images_by_sha256(db=db, hashes=[i[1] for i in copied if i])).items()}
+                # sha256 -> path of the first image of the batch with that content
+                new, seen = [], {}
+                for image, file in zip(batch, copied):
+                    if not file:
+                        continue
+                    file_name, sha256, metadata = file
+                    path = f"/{image['species'].name}/{file_name}"
+                    if stored.get(sha256) == path:
+                        # by an earlier run
+                        result.skipped += 1
+                    elif sha256 in stored:
+                        # under another species or name, keep one copy
+                        result.duplicates += 1
+                        await storage.discard(image_domain + path)
+                    elif sha256 in seen:
+                        # an earlier image of the batch, the same file unless species or extension differ
+                        result.duplicates += 1
+                        if seen[sha256] != path:
+                            await storage.discard(image_domain + path)
+                    else:
+                        seen[sha256] = path
+                        new.append({**image, "path": path, "sha256": sha256, "metadata": metadata})
+                batch = new
+                if not batch:
+                    continue
+
+                for image in batch:
+                    image["bboxes"], image["polygons"] = _split(image.pop("annotations"), image["metadata"], result)
+                await _write_batch(db, user_id, batch, empty_task_type, result)
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog="python -m app.core.importer", description="import a COCO dataset")
+    parser.add_argument("coco", help="COCO json")
+    parser.add_argument("images", help="image directory, zip or tar")
+    parser.add_argument("--user-id", type=int, required=True, help="uploader and annotator of the imported data")
+    parser.add_argument("--species", help="species of all images, by default one per COCO category")
+    parser.add_argument("--empty-task-type", choices=[i.value for i in TaskType], help="task created for images without annotations")
+    parser.add_argument("--workers", type=int, default=import_workers)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    with open(args.coco, "rb") as file:
+        dataset = parse_coco(file.read())
+    async with SessionLocal() as db:
+        if not await crud.get_user_by_id(db=db, user_id=args.user_id):
+            parser.error(f"user {args.user_id} does not exist")
+    source = open_source(args.images)
+    try:
+        result = await import_coco(
+            dataset, source, args.user_id, species=args.species,
+            empty_task_type=args.empty_task_type and TaskType(args.empty_task_type),
+            batch_size=args.batch_size, workers=args.workers,
+        )
+    finally:
+        source.close()
+        await engine.dispose()
+    print(result.model_dump_json())
+
+
+if __name__ == "__main__":
+    # python -m app.core.importer dataset.json images/ --user-id 1
+    asyncio.run(main())
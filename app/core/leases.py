@@ -0,0 +1,30 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from app import crud
+from app.core.database import SessionLocal
+from app.settings import lease_sweep_interval_seconds
+
+# Accepted tasks hold a lease (Task.expires_at), set on accept and extended by PUT /task/{id}/heartbeat.
+# The sweeper returns tasks with an expired lease to pending so abandoned tasks do not starve the pool.
+# Every worker runs one, concurrent sweeps are harmless since releasing is a conditional UPDATE.
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep() -> int:
+    async with SessionLocal() as db:
+        return await crud.release_expired_tasks(db=db, now=datetime.now(timezone.utc))
+
+async def sweep_forever(interval:float=lease_sweep_interval_seconds):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            released = await sweep()
+        except Exception:
+            # keep sweeping after a failed round, e.g. a locked database
+            logger.exception("lease sweep failed")
+            continue
+        if released:
+            logger.info("released %d expired tasks", released)
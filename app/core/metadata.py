@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+from app import crud
+from app.core import backfills, imaging
+from app.core.database import engine
+from app.settings import import_workers
+
+# Image width, height, channels and format are read from the file header at upload (see imaging.read_metadata).
+# Images stored before that get them from backfill() (python -m app.core.metadata).
+
+BACKFILL_BATCH = 1000
+
+logger = logging.getLogger(__name__)
+
+
+async def backfill(batch_size:int=BACKFILL_BATCH, workers:int=import_workers) -> dict:
+    # reads headers of images without metadata (see core/backfills.py)
+    counts = {"read": 0, "missing": 0, "unreadable": 0}
+    async for db, images, results in backfills.read_files(crud.get_images_without_metadata, imaging.read_metadata, batch_size, workers):
+        rows = []
+        for image, metadata in zip(images, results):
+            if metadata is backfills.MISSING:
+                counts["missing"] += 1
+            elif metadata is None:
+                counts["unreadable"] += 1
+                logger.warning("image %d: %s is not an image", image.id, image.path)
+            else:
+                rows.append({"id": image.id, **metadata})
+        await crud.set_image_metadata(db=db, rows=rows)
+        counts["read"] += len(rows)
+    return counts
+
+
+async def main():
+    counts = await backfill()
+    await engine.dispose()
+    print(counts)
+
+
+if __name__ == "__main__":
+    # python -m app.core.metadata
+    asyncio.run(main())
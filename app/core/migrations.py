@@ -0,0 +1,265 @@
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import Callable
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import Column, Connection, DateTime, Integer, LargeBinary, MetaData, Table, bindparam, inspect, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app.core.database import Base, engine
+from app.core.geometry import pack_polygon
+from app.core import spatial, stats
+from app.settings import task_lease_seconds
+
+# Versioned schema migrations.
+# A new database is created from the models in database.py and stamped with the latest version,
+# an existing one gets every migration newer than its stored version applied in order.
+# When changing the models append a migration that brings an existing database to the same state,
+# never edit an applied one.
+
+version_table = Table("schema_version", MetaData(), Column("version", Integer, nullable=False))
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+def _sql(*statements:str) -> Callable[[Connection], None]:
+    # plain SQL keeps applied migrations independent from later model changes
+    def upgrade(conn:Connection):
+        for statement in statements:
+            conn.execute(text(statement))
+    return upgrade
+
+def _add_column(table:str, column:str, definition:str) -> Callable[[Connection], None]:
+    def upgrade(conn:Connection):
+        if column not in {i["name"] for i in inspect(conn).get_columns(table)}:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+    return upgrade
+
+
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def parse_bbox(bbox:str) -> tuple[float, float, float, float]:
+    # legacy text bbox "(x1, y1), (x2, y2)" -> (x_min, y_min, x_max, y_max)
+    numbers = [float(i) for i in _NUMBER.findall(bbox)]
+    if len(numbers) != 4:
+        raise ValueError(f"cannot parse bbox {bbox!r}")
+    x1, y1, x2, y2 = numbers
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+def _bbox_columns(conn:Connection):
+    if "bbox" not in {i["name"] for i in inspect(conn).get_columns("bbox_annotation")}:
+        return
+    for column in ["x_min", "y_min", "x_max", "y_max"]:
+        # sqlite cannot add a NOT NULL column without a default
+        conn.execute(text(f"ALTER TABLE bbox_annotation ADD COLUMN {column} FLOAT NOT NULL DEFAULT 0"))
+    conn.execute(text("ALTER TABLE bbox_annotation ADD COLUMN label VARCHAR"))
+    conn.execute(text("ALTER TABLE bbox_annotation ADD COLUMN score FLOAT"))
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, bbox FROM bbox_annotation WHERE id > :last_id ORDER BY id LIMIT 10000"),
+            {"last_id": last_id}
+        ).all()
+        if not rows:
+            break
+        values = []
+        for id, bbox in rows:
+            try:
+                x_min, y_min, x_max, y_max = parse_bbox(bbox)
+            except ValueError as e:
+                raise ValueError(f"bbox_annotation {id}: {e}") from e
+            values.append({"id": id, "x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max})
+        conn.execute(
+            text("UPDATE bbox_annotation SET x_min=:x_min, y_min=:y_min, x_max=:x_max, y_max=:y_max WHERE id=:id"),
+            values
+        )
+        last_id = rows[-1].id
+    conn.execute(text("ALTER TABLE bbox_annotation DROP COLUMN bbox"))
+
+def parse_polygon(polygon:str) -> list[tuple[float, float]]:
+    # legacy text polygon "(x1, y1), (x2, y2), ..."
+    numbers = [float(i) for i in _NUMBER.findall(polygon)]
+    if not numbers or len(numbers) % 2:
+        raise ValueError(f"cannot parse polygon {polygon!r}")
+    return list(zip(numbers[::2], numbers[1::2]))
+
+def _polygon_vertices(conn:Connection):
+    if "polygon" not in {i["name"] for i in inspect(conn).get_columns("poly_annotation")}:
+        return
+    blob = conn.dialect.type_compiler_instance.process(LargeBinary())
+    conn.execute(text(f"ALTER TABLE poly_annotation ADD COLUMN vertices {blob} NOT NULL DEFAULT ''"))
+    conn.execute(text("ALTER TABLE poly_annotation ADD COLUMN vertex_count INTEGER NOT NULL DEFAULT 0"))
+    for column in ["x_min", "y_min", "x_max", "y_max"]:
+        conn.execute(text(f"ALTER TABLE poly_annotation ADD COLUMN {column} FLOAT NOT NULL DEFAULT 0"))
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, polygon FROM poly_annotation WHERE id > :last_id ORDER BY id LIMIT 10000"),
+            {"last_id": last_id}
+        ).all()
+        if not rows:
+            break
+        values = []
+        for id, polygon in rows:
+            try:
+                values.append({"id": id, **pack_polygon(parse_polygon(polygon))})
+            except ValueError as e:
+                raise ValueError(f"poly_annotation {id}: {e}") from e
+        conn.execute(
+            text("UPDATE poly_annotation SET vertices=:vertices, vertex_count=:vertex_count, x_min=:x_min, y_min=:y_min, x_max=:x_max, y_max=:y_max WHERE id=:id"),
+            values
+        )
+        last_id = rows[-1].id
+    conn.execute(text("ALTER TABLE poly_annotation DROP COLUMN polygon"))
+
+def _spatial_index(conn:Connection):
+    for table in spatial.ANNOTATION_TABLES:
+        spatial.install(conn, table)
+        spatial.rebuild(conn, table)
+
+def _spatial_image_key(conn:Connection):
+    # sqlite R*Trees hold the image id since migration 5
+    if conn.dialect.name == "postgresql":
+        _spatial_index(conn)
+
+def _task_lease(conn:Connection):
+    timestamp = conn.dialect.type_compiler_instance.process(DateTime(timezone=True))
+    _add_column("task", "expires_at", timestamp)(conn)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_task_status_expires_at ON task (status, expires_at)"))
+    # tasks accepted before leases get one from now
+    conn.execute(
+        text("UPDATE task SET expires_at = :expires_at WHERE status = 'accepted' AND expires_at IS NULL")
+        .bindparams(bindparam("expires_at", type_=DateTime(timezone=True))),
+        {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=task_lease_seconds)}
+    )
+
+def _task_priority(conn:Connection):
+    _add_column("task", "priority", "INTEGER NOT NULL DEFAULT 0")(conn)
+    _add_column("species", "priority", "INTEGER NOT NULL DEFAULT 0")(conn)
+    _sql(
+        # id ordered indexes replaced by dispatch ordered ones
+        'DROP INDEX IF EXISTS ix_task_status_task_type_id',
+        'DROP INDEX IF EXISTS ix_task_status_id',
+        'DROP INDEX IF EXISTS ix_task_task_type_id',
+        'CREATE INDEX IF NOT EXISTS ix_task_status_task_type_priority_id ON task (status, task_type, priority DESC, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_status_priority_id ON task (status, priority DESC, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_task_type_priority_id ON task (task_type, priority DESC, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_priority_id ON task (priority DESC, id)',
+    )(conn)
+
+def _stats(conn:Connection):
+    _sql(
+        'CREATE TABLE IF NOT EXISTS task_count (status VARCHAR NOT NULL, task_type VARCHAR NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (status, task_type))',
+        'CREATE TABLE IF NOT EXISTS annotation_count (species_id INTEGER NOT NULL, kind VARCHAR NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (species_id, kind))',
+        'CREATE TABLE IF NOT EXISTS finished_task_count (user_id INTEGER NOT NULL, day DATE NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (user_id, day))',
+    )(conn)
+    stats.recompute(conn)
+
+def _image_sha256(conn:Connection):
+    # filled by python -m app.core.storage
+    _add_column("image", "sha256", "VARCHAR")(conn)
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_image_sha256 ON image (sha256)"))
+
+def _image_metadata(conn:Connection):
+    # filled by python -m app.core.metadata
+    for column, definition in [("width", "INTEGER"), ("height", "INTEGER"), ("channels", "INTEGER"), ("format", "VARCHAR")]:
+        _add_column("image", column, definition)(conn)
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "indexes for hot filter columns", _sql(
+        'CREATE INDEX IF NOT EXISTS ix_task_status_task_type_id ON task (status, task_type, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_image_id ON task (image_id)',
+        'CREATE INDEX IF NOT EXISTS ix_image_species_id_id ON image (species_id, id)',
+        'CREATE INDEX IF NOT EXISTS ix_bbox_annotation_task_id_id ON bbox_annotation (task_id, id)',
+        'CREATE INDEX IF NOT EXISTS ix_poly_annotation_task_id_id ON poly_annotation (task_id, id)',
+        'CREATE INDEX IF NOT EXISTS ix_user_username ON "user" (username)',
+    )),
+    Migration(2, "keyset pagination indexes for single task filters", _sql(
+        'CREATE INDEX IF NOT EXISTS ix_task_status_id ON task (status, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_task_type_id ON task (task_type, id)',
+    )),
+    Migration(3, "numeric bbox columns instead of text", _bbox_columns),
+    Migration(4, "packed float32 polygon vertices instead of text", _polygon_vertices),
+    Migration(5, "spatial index over annotation bounds", _spatial_index),
+    Migration(6, "task annotation revision", _add_column("task", "revision", "INTEGER NOT NULL DEFAULT 0")),
+    Migration(7, "accepted task lease", _task_lease),
+    Migration(8, "task priority", _task_priority),
+    Migration(9, "counters for stats", _stats),
+    Migration(10, "image content hash", _image_sha256),
+    Migration(11, "image size and format", _image_metadata),
+    Migration(12, "image id in the postgresql spatial index", _spatial_image_key),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_version(conn:Connection) -> int|None:
+    # None - database without schema_version table
+    if not inspect(conn).has_table(version_table.name):
+        return None
+    return conn.execute(select(version_table.c.version)).scalar()
+
+def _set_version(conn:Connection, version:int):
+    if conn.execute(update(version_table).values(version=version)).rowcount == 0:
+        conn.execute(insert(version_table).values(version=version))
+
+def upgrade(conn:Connection) -> int:
+    # sync, call through AsyncConnection.run_sync inside one transaction
+    version = get_version(conn)
+    if version is None:
+        empty = not inspect(conn).get_table_names()
+        version_table.create(conn)
+        if empty:
+            Base.metadata.create_all(conn)
+            _set_version(conn, LATEST_VERSION)
+            return LATEST_VERSION
+        # tables created by create_all before migrations existed
+        version = 0
+
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            migration.upgrade(conn)
+            _set_version(conn, migration.version)
+    return max(version, LATEST_VERSION)
+
+
+_LOCK_KEY = 4_517_001  # any constant shared by all workers
+
+async def _lock(conn:AsyncConnection):
+    # serializes workers starting at the same time, released on commit
+    if conn.dialect.name == "sqlite":
+        await conn.exec_driver_sql("PRAGMA busy_timeout = 60000")
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql":
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+
+async def migrate(engine:AsyncEngine) -> int:
+    # startup path: no lock and no DDL when the schema is current
+    async with engine.connect() as conn:
+        if await conn.run_sync(get_version) == LATEST_VERSION:
+            return LATEST_VERSION
+
+    async with engine.connect() as conn:
+        await _lock(conn)
+        # another worker may have finished while we waited for the lock
+        version = await conn.run_sync(upgrade)
+        await conn.commit()
+    return version
+
+
+async def main():
+    version = await migrate(engine)
+    await engine.dispose()
+    print(f"schema version {version}")
+
+
+if __name__ == "__main__":
+    # python -m app.core.migrations
+    asyncio.run(main())
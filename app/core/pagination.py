@@ -0,0 +1,46 @@
+import base64
+import binascii
+import json
+from typing import Annotated, Sequence
+from fastapi import Query
+
+from app.routes.exception import InvalidCursorException
+
+# Keyset pagination: a page is "rows after the last seen key", so every page costs the same
+# and rows inserted meanwhile do not shift the following pages.
+# The cursor is opaque for clients, it is the key of the last row of the previous page.
+
+PageLimit = Annotated[int, Query(ge=1, le=1000)]
+
+
+def encode_cursor(key:dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode()
+
+def decode_cursor(cursor:str|None) -> dict:
+    if cursor is None:
+        return {}
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise InvalidCursorException
+    if not isinstance(key, dict) or not isinstance(key.get("id"), int):
+        raise InvalidCursorException
+    return key
+
+def after_id(cursor:str|None) -> int|None:
+    return decode_cursor(cursor).get("id")
+
+def after_key(cursor:str|None, *names:str) -> tuple|None:
+    # key of several columns, e.g. after_key(cursor, "priority", "id") -> (priority, id)
+    key = decode_cursor(cursor)
+    if not key:
+        return None
+    if not all(isinstance(key.get(i), int) for i in names):
+        raise InvalidCursorException
+    return tuple(key[i] for i in names)
+
+def paginate(rows:Sequence, limit:int, key:tuple[str, ...]=("id",)) -> dict:
+    # rows were fetched with limit+1, the extra row only tells that there is a next page
+    items = list(rows[:limit])
+    next_cursor = encode_cursor({i: getattr(items[-1], i) for i in key}) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
\ No newline at end of file
@@ -0,0 +1,102 @@
+from sqlalchemy import Column, Connection, Float, Integer, MetaData, Select, Table, and_, func, literal_column, select, text
+
+# Spatial index over annotation bounds for region queries.
+# sqlite: an R*Tree virtual table per annotation table with the image id as a third dimension,
+#   so "annotations of image X intersecting a region" is a single R*Tree search.
+#   Triggers keep it in sync with every insert, update and delete.
+# postgresql: an image_id column on the annotation table, copied from the task by a trigger (not mapped by the models),
+#   and a GiST index over (image_id, box(point(x_min, y_min), point(x_max, y_max))) through btree_gist,
+#   so the same search is a single index scan as well.
+# Installed with the tables on a new database and by migrations 5 and 12 on an existing one.
+
+ANNOTATION_TABLES = ["bbox_annotation", "poly_annotation"]
+# dialects whose index holds the image id, others filter by image in the caller
+IMAGE_KEYED_DIALECTS = {"sqlite", "postgresql"}
+
+_rtree_metadata = MetaData()
+
+def _rtree(table:str) -> Table:
+    return Table(
+        f"{table}_rtree", _rtree_metadata,
+        Column("id", Integer, primary_key=True),
+        Column("image_min", Float), Column("image_max", Float),
+        Column("x_min", Float), Column("x_max", Float),
+        Column("y_min", Float), Column("y_max", Float),
+    )
+
+rtrees = {table: _rtree(table) for table in ANNOTATION_TABLES}
+
+
+def _sqlite_ddl(table:str) -> list[str]:
+    rtree = f"{table}_rtree"
+    row = f"NEW.id, image_id, image_id, NEW.x_min, NEW.x_max, NEW.y_min, NEW.y_max FROM task WHERE task.id = NEW.task_id"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree(id, image_min, image_max, x_min, x_max, y_min, y_max)",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_rtree_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {rtree} SELECT {row};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_rtree_update AFTER UPDATE OF x_min, y_min, x_max, y_max, task_id ON {table} BEGIN
+            DELETE FROM {rtree} WHERE id = OLD.id;
+            INSERT INTO {rtree} SELECT {row};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_rtree_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM {rtree} WHERE id = OLD.id;
+        END""",
+    ]
+
+def _postgresql_ddl(table:str) -> list[str]:
+    return [
+        "CREATE EXTENSION IF NOT EXISTS btree_gist",
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS image_id INTEGER",
+        f"""CREATE OR REPLACE FUNCTION {table}_image_id() RETURNS trigger AS $$ BEGIN
+            NEW.image_id := (SELECT image_id FROM task WHERE task.id = NEW.task_id);
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql""",
+        f"DROP TRIGGER IF EXISTS {table}_image_id ON {table}",
+        f"CREATE TRIGGER {table}_image_id BEFORE INSERT OR UPDATE OF task_id ON {table} FOR EACH ROW EXECUTE FUNCTION {table}_image_id()",
+        # the box only index of migration 5
+        f"DROP INDEX IF EXISTS ix_{table}_box",
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_image_box ON {table} USING gist (image_id, box(point(x_min, y_min), point(x_max, y_max)))",
+    ]
+
+def install(conn:Connection, table:str):
+    if conn.dialect.name == "sqlite":
+        statements = _sqlite_ddl(table)
+    elif conn.dialect.name == "postgresql":
+        statements = _postgresql_ddl(table)
+    else:
+        return
+    for statement in statements:
+        conn.execute(text(statement))
+
+def rebuild(conn:Connection, table:str):
+    # fill the R*Tree (sqlite) or the image_id column (postgresql) from existing rows
+    if conn.dialect.name == "sqlite":
+        conn.execute(text(f"DELETE FROM {table}_rtree"))
+        conn.execute(text(
+            f"INSERT INTO {table}_rtree SELECT a.id, t.image_id, t.image_id, a.x_min, a.x_max, a.y_min, a.y_max "
+            f"FROM {table} a JOIN task t ON t.id = a.task_id"
+        ))
+    elif conn.dialect.name == "postgresql":
+        conn.execute(text(f"UPDATE {table} a SET image_id = t.image_id FROM task t WHERE t.id = a.task_id"))
+
+
+def intersecting(stmt:Select, model, dialect:str, x_min:float, y_min:float, x_max:float, y_max:float, image_id:int) -> Select:
+    # annotations of model on image image_id whose bounds intersect the region, edges included.
+    # The image condition on dialects not in IMAGE_KEYED_DIALECTS is left to the caller
+    exact = and_(model.x_min <= x_max, model.x_max >= x_min, model.y_min <= y_max, model.y_max >= y_min)
+    if dialect == "sqlite":
+        rtree = rtrees[model.__tablename__]
+        # a subquery, so the planner starts from the R*Tree search and not from the model table
+        hits = select(rtree.c.id).where(
+            rtree.c.image_min <= image_id, rtree.c.image_max >= image_id,
+            rtree.c.x_min <= x_max, rtree.c.x_max >= x_min,
+            rtree.c.y_min <= y_max, rtree.c.y_max >= y_min,
+        )
+        stmt = stmt.where(model.id.in_(hits))
+    elif dialect == "postgresql":
+        box = func.box(func.point(model.x_min, model.y_min), func.point(model.x_max, model.y_max))
+        image = literal_column(f"{model.__tablename__}.image_id")
+        stmt = stmt.where(image == image_id, box.op("&&")(func.box(func.point(x_min, y_min), func.point(x_max, y_max))))
+    # R*Tree keeps float32 bounds rounded outwards, the exact check drops the extra hits
+    return stmt.where(exact)
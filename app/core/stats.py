@@ -0,0 +1,100 @@
+import asyncio
+from collections import Counter
+from datetime import date
+from sqlalchemy import Connection, Integer, String, bindparam, cast, delete, func, insert, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import database
+from app.core.database import AnnotationCount, FinishedTaskCount, TaskCount, engine
+
+# Counters behind /stats. Writes add deltas with INSERT ... ON CONFLICT DO UPDATE SET count = count + delta
+# in the same transaction as the change they count, so reading them costs the same at any table size.
+# recompute() rebuilds them from the data, run it after writes that bypass crud.py.
+
+_KINDS = {database.BboxAnnotation: "bbox", database.PolyAnnotation: "poly"}
+
+
+def _upsert(db:AsyncSession, model, keys:list[str], source=None):
+    # INSERT (VALUES or source SELECT) ... ON CONFLICT (keys) DO UPDATE SET count = count + excluded.count
+    table = model.__table__
+    stmt = (sqlite.insert if db.bind.dialect.name == "sqlite" else postgresql.insert)(table)
+    if source is not None:
+        stmt = stmt.from_select([*keys, "count"], source)
+    return stmt.on_conflict_do_update(index_elements=keys, set_={"count": table.c.count + stmt.excluded.count})
+
+async def _add(db:AsyncSession, model, keys:list[str], deltas:Counter):
+    rows = [dict(zip(keys, key), count=count) for key, count in deltas.items() if count]
+    if rows:
+        await db.execute(_upsert(db, model, keys), rows)
+
+async def count_tasks(db:AsyncSession, deltas:Counter):
+    # deltas: (TaskStatus, TaskType) -> change
+    await _add(db, TaskCount, ["status", "task_type"], Counter({(status.name, task_type.name): count for (status, task_type), count in deltas.items()}))
+
+async def move_tasks(db:AsyncSession, task_types:list[database.TaskType], old:database.TaskStatus, new:database.TaskStatus):
+    deltas = Counter()
+    for task_type in task_types:
+        deltas[old, task_type] -= 1
+        deltas[new, task_type] += 1
+    await count_tasks(db, deltas)
+
+async def count_annotations(db:AsyncSession, model, deltas:Counter):
+    # deltas: task id -> change in the number of annotations of model.
+    # The species is looked up by the INSERT ... SELECT itself, one row per task
+    rows = [{"task_id": task_id, "delta": count} for task_id, count in deltas.items() if count]
+    if not rows:
+        return
+    source = (
+        select(database.Image.species_id, literal(_KINDS[model]), bindparam("delta", type_=Integer))
+        .join(database.Task, database.Task.image_id == database.Image.id)
+        .filter(database.Task.id == bindparam("task_id"))
+    )
+    await db.execute(_upsert(db, AnnotationCount, ["species_id", "kind"], source), rows)
+
+async def count_species_annotations(db:AsyncSession, model, deltas:Counter):
+    # deltas: species id -> change, for writers that know the species already
+    await _add(db, AnnotationCount, ["species_id", "kind"], Counter({(species_id, _KINDS[model]): count for species_id, count in deltas.items()}))
+
+async def count_finished(db:AsyncSession, user_id:int, day:date, delta:int=1):
+    await _add(db, FinishedTaskCount, ["user_id", "day"], Counter({(user_id, day): delta}))
+
+
+def recompute(conn:Connection):
+    # sync, call through AsyncConnection.run_sync, replaces all counters in one transaction
+    task = database.Task
+    for model in [TaskCount, AnnotationCount, FinishedTaskCount]:
+        conn.execute(delete(model))
+    conn.execute(insert(TaskCount).from_select(
+        ["status", "task_type", "count"],
+        select(cast(task.status, String), cast(task.task_type, String), func.count()).group_by(task.status, task.task_type)
+    ))
+    for model, kind in _KINDS.items():
+        conn.execute(insert(AnnotationCount).from_select(
+            ["species_id", "kind", "count"],
+            select(database.Image.species_id, literal(kind), func.count())
+            .select_from(model)
+            .join(task, task.id == model.task_id)
+            .join(database.Image, database.Image.id == task.image_id)
+            .group_by(database.Image.species_id)
+        ))
+    # UTC day, sqlite keeps UTC values without the zone
+    day = func.date(task.finished_at if conn.dialect.name == "sqlite" else func.timezone("UTC", task.finished_at))
+    conn.execute(insert(FinishedTaskCount).from_select(
+        ["user_id", "day", "count"],
+        select(task.accepted_user_id, day, func.count())
+        .filter(task.status == database.TaskStatus.finished)
+        .group_by(task.accepted_user_id, day)
+    ))
+
+
+async def main():
+    async with engine.begin() as conn:
+        await conn.run_sync(recompute)
+    await engine.dispose()
+    print("stats recomputed")
+
+
+if __name__ == "__main__":
+    # python -m app.core.stats
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import os
+import posixpath
+import uuid
+from typing import Any, BinaryIO, Callable
+
+import aiofiles
+from fastapi import UploadFile
+
+from app import crud
+from app.core import backfills
+from app.core.database import engine
+from app.settings import import_workers
+
+# Content-addressed image files: an upload is hashed while it is written and stored as <sha256>.<ext>
+# in its species folder, Image.sha256 is unique so the same content is stored and annotated once.
+# Images stored before hashing get theirs from backfill() (python -m app.core.storage).
+
+CHUNK_SIZE = 1024 * 1024
+BACKFILL_BATCH = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def content_name(sha256:str, filename:str) -> str:
+    return sha256 + posixpath.splitext(filename)[1].lower()
+
+def is_content_addressed(path:str, sha256:str|None) -> bool:
+    # stored under its hash, what is at path never changes
+    return sha256 is not None and posixpath.splitext(posixpath.basename(path))[0] == sha256
+
+def hash_file(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def save_upload(file:UploadFile, directory:str) -> str:
+    # writes the upload to directory under its content name, returns the sha256.
+    # Written to a temporary name first, the rename is atomic and same content means same file
+    digest = hashlib.sha256()
+    part = os.path.join(directory, f".{uuid.uuid4()}.part")
+    try:
+        async with aiofiles.open(part, "wb") as out:
+            while chunk := await file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                await out.write(chunk)
+        sha256 = digest.hexdigest()
+        await asyncio.to_thread(os.replace, part, os.path.join(directory, content_name(sha256, file.filename)))
+    except BaseException:
+        await discard(part)
+        raise
+    return sha256
+
+
+async def discard(path:str):
+    # a stored file nothing refers to
+    try:
+        await asyncio.to_thread(os.remove, path)
+    except FileNotFoundError:
+        pass
+
+
+def save_file(file:BinaryIO, directory:str, filename:str, inspect:Callable[[str], Any]=lambda path: None) -> tuple[str, Any]:
+    # save_upload for worker threads (blocking, never called on the event loop), (sha256, inspect(temporary file)).
+    # inspect sees the complete file before it is renamed, an exception from it leaves nothing behind
+    digest = hashlib.sha256()
+    part = os.path.join(directory, f".{uuid.uuid4()}.part")
+    try:
+        with file, open(part, "wb") as out:
+            while chunk := file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+        result = inspect(part)
+        sha256 = digest.hexdigest()
+        os.replace(part, os.path.join(directory, content_name(sha256, filename)))
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return sha256, result
+
+
+async def backfill(batch_size:int=BACKFILL_BATCH, workers:int=import_workers) -> dict:
+    # hashes files of images without sha256 (see core/backfills.py). Files are not moved.
+    # An image whose content is already stored by another one keeps no hash and is reported
+    counts = {"hashed": 0, "missing": 0, "duplicates": 0}
+    async for db, images, hashes in backfills.read_files(crud.get_unhashed_images, hash_file, batch_size, workers):
+        existing = await crud.get_images_by_sha256(db=db, hashes=[i for i in hashes if i is not backfills.MISSING])
+        rows = []
+        for image, sha256 in zip(images, hashes):
+            if sha256 is backfills.MISSING:
+                counts["missing"] += 1
+            elif sha256 in existing:
+                counts["duplicates"] += 1
+                logger.warning("image %d: same content as image %d", image.id, existing[sha256].id)
+            else:
+                rows.append({"id": image.id, "sha256": sha256})
+                existing[sha256] = image
+        await crud.set_image_hashes(db=db, rows=rows)
+        counts["hashed"] += len(rows)
+    return counts
+
+
+async def main():
+    counts = await backfill()
+    await engine.dispose()
+    print(counts)
+
+
+if __name__ == "__main__":
+    # python -m app.core.storage
+    asyncio.run(main())
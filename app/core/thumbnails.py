@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+
+from app import crud
+from app.core import imaging, workers
+from app.core.database import SessionLocal, engine
+from app.settings import image_domain, thumbnail_dir
+
+# Thumbnails for galleries (GET /image/sprite): thumbnail_dir/<content key>.jpg, at most THUMBNAIL_SIZE on a side.
+# Made by the worker pool (see core/workers.py) in the background after upload, on demand for images without one,
+# and for every existing image by python -m app.core.thumbnails.
+
+BACKFILL_BATCH = 500
+
+logger = logging.getLogger(__name__)
+
+
+def path(image) -> str:
+    return os.path.join(thumbnail_dir, imaging.cache_key(image) + ".jpg")
+
+def _missing(paths:list[str]) -> set[str]:
+    # runs in a thread, a sprite page checks up to a thousand files
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    return {p for p in paths if not os.path.exists(p)}
+
+async def ensure(images:list) -> list[str|None]:
+    # thumbnail paths in images order, missing thumbnails are made first, None where that failed
+    paths = [path(i) for i in images]
+    absent = await asyncio.to_thread(_missing, paths)
+    missing = {p: i for p, i in zip(paths, images) if p in absent}
+    results = await asyncio.gather(*[workers.run(imaging.make_thumbnail, image_domain + i.path, p) for p, i in missing.items()], return_exceptions=True)
+    failed = set()
+    for (p, image), result in zip(missing.items(), results):
+        if isinstance(result, Exception):
+            logger.warning("no thumbnail of image %d: %s", image.id, result)
+            failed.add(p)
+    return [None if p in failed else p for p in paths]
+
+def schedule(images:list):
+    workers.background(ensure(images), f"making thumbnails of {len(images)} images")
+
+
+async def backfill(batch_size:int=BACKFILL_BATCH) -> dict:
+    counts = {"made": 0, "failed": 0}
+    after_id = None
+    async with SessionLocal() as db:
+        while images := await crud.get_images(db=db, after_id=after_id, limit=batch_size):
+            after_id = images[-1].id
+            absent = await asyncio.to_thread(_missing, [path(i) for i in images])
+            missing = [i for i in images if path(i) in absent]
+            paths = await ensure(missing)
+            counts["failed"] += paths.count(None)
+            counts["made"] += len(paths) - paths.count(None)
+    return counts
+
+
+async def main():
+    counts = await backfill()
+    workers.shutdown()
+    await engine.dispose()
+    print(counts)
+
+
+if __name__ == "__main__":
+    # python -m app.core.thumbnails
+    asyncio.run(main())
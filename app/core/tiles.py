@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+from app.core import imaging, workers
+from app.settings import image_domain, tile_cache_dir, tile_cache_max_bytes
+
+# Tile pyramids of images for the viewer (GET /image/{id}/tiles/...).
+# A pyramid is cut whole by a worker process (see core/workers.py) the first time a tile of the image is asked for
+# (or right after upload with TILE_PREGENERATE=1), written under a temporary name and renamed when complete.
+# Pyramids are keyed by content hash, so duplicates share one. The cache drops whole pyramids,
+# least recently used first, once they take more than tile_cache_max_bytes.
+# Every app worker keeps its own index of the cache directory and enforces the cap on the pyramids it knows of,
+# so with N workers the directory can grow to N x tile_cache_max_bytes. A pyramid another worker cut is
+# taken over from the directory, one it removed is cut again.
+
+def _size(directory:str) -> int:
+    return sum(os.path.getsize(os.path.join(root, i)) for root, _, files in os.walk(directory) for i in files)
+
+def _scan(directory:str) -> OrderedDict[str, int]:
+    # key -> size of the pyramids in directory, least recently used first
+    os.makedirs(directory, exist_ok=True)
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith("."):
+            # left by an interrupted build
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            entries.append((os.path.getmtime(path), name, _size(path)))
+    return OrderedDict((name, size) for _, name, size in sorted(entries))
+
+
+class TileCache:
+    def __init__(self, directory:str, max_bytes:int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # key -> size in bytes, least recently used first, read from the directory on first use
+        self._sizes:OrderedDict[str, int]|None = None
+        self._total = 0
+        self._loading = asyncio.Lock()
+        self._building:dict[str, asyncio.Future] = {}
+
+    async def _index(self) -> OrderedDict[str, int]:
+        async with self._loading:
+            if self._sizes is None:
+                self._sizes = await asyncio.to_thread(_scan, self.directory)
+                self._total = sum(self._sizes.values())
+        return self._sizes
+
+    async def _touch(self, key:str):
+        (await self._index()).move_to_end(key)
+        try:
+            # order survives restarts
+            os.utime(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    async def _add(self, key:str, size:int):
+        index = await self._index()
+        self._total += size - index.get(key, 0)
+        index[key] = size
+        index.move_to_end(key)
+        evicted = []
+        while self._total > self.max_bytes and len(index) > 1:
+            name, evicted_size = index.popitem(last=False)
+            self._total -= evicted_size
+            evicted.append(os.path.join(self.directory, name))
+        for path in evicted:
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+
+    async def _build(self, key:str, source:str):
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            # cut by another app worker, taken over without decoding the image again
+            await self._add(key, await asyncio.to_thread(_size, path))
+            return
+        part = os.path.join(self.directory, f".{key}.{uuid.uuid4()}")
+        try:
+            size = await workers.run(imaging.build_pyramid, source, part)
+            if os.path.isdir(path):
+                # built by another app worker meanwhile
+                await asyncio.to_thread(shutil.rmtree, part, ignore_errors=True)
+            else:
+                os.rename(part, path)
+        except BaseException:
+            shutil.rmtree(part, ignore_errors=True)
+            raise
+        await self._add(key, size)
+
+    async def pyramid(self, key:str, source:str) -> str:
+        # directory of the complete pyramid of source, cut first if needed
+        path = os.path.join(self.directory, key)
+        if key in await self._index() and os.path.isdir(path):
+            await self._touch(key)
+            return path
+        await workers.shared(self._building, key, lambda: self._build(key, source))
+        return path
+
+cache = TileCache(tile_cache_dir, tile_cache_max_bytes)
+
+
+async def tile(image, level:int, x:int, y:int) -> str|None:
+    # path of the tile file, None if the pyramid of the image has no such tile
+    directory = await cache.pyramid(imaging.cache_key(image), image_domain + image.path)
+    path = os.path.join(directory, str(level), f"{x}_{y}.jpg")
+    return path if os.path.isfile(path) else None
+
+def info(image) -> dict:
+    width, height = (image.width, image.height) if image.width is not None else imaging.image_size(image_domain + image.path)
+    return {
+        "width": width, "height": height, "tile_size": imaging.TILE_SIZE, "overlap": 0,
+        "format": "jpg", "max_level": imaging.max_level(width, height),
+    }
+
+def pregenerate(image):
+    workers.background(cache.pyramid(imaging.cache_key(image), image_domain + image.path), f"cutting tiles of image {image.id}")
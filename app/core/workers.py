@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Hashable
+
+from app.settings import image_workers
+
+# Shared process pool for decoding images (tile pyramids, thumbnails) and the background jobs awaiting it.
+# Functions run in it come from core/imaging.py, which workers import without the database layer.
+
+logger = logging.getLogger(__name__)
+
+_executor:ProcessPoolExecutor|None = None
+_background:set[asyncio.Task] = set()
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that runs an event loop and threads is unsafe
+        _executor = ProcessPoolExecutor(max_workers=image_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+async def run(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_pool(), function, *args)
+
+def background(job:Awaitable, description:str):
+    # runs job without waiting for it, a failure is only logged
+    async def wrapper():
+        try:
+            await job
+        except Exception:
+            logger.exception("%s failed", description)
+    task = asyncio.create_task(wrapper())
+    # the loop keeps only weak references to tasks
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+def shared(running:dict[Hashable, asyncio.Future], key:Hashable, start:Callable[[], Awaitable]) -> Awaitable:
+    # one start() per key at a time, callers while it runs wait for the same result.
+    # A caller going away (a closed request) does not cancel what others wait for
+    if key not in running:
+        future = asyncio.ensure_future(start())
+        running[key] = future
+        future.add_done_callback(lambda done: running.pop(key, None) if running.get(key) is done else None)
+    return asyncio.shield(running[key])
+
+def shutdown():
+    global _executor
+    for task in _background:
+        task.cancel()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
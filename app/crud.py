@@ -1,161 +1,463 @@
-from datetime import datetime, timezone
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from app.core import database
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy import delete, insert, select, true, update
+from app.core import database, spatial, stats
+from app.core.geometry import pack_polygon
 from app import schemas
+from app.settings import task_lease_seconds
+
+
+# Loader options, relationships are lazy="raise" so callers pass the ones their response needs.
+# Without options every getter is a single-table query (a primary-key lookup for *_by_id)
+image_options = [joinedload(database.Image.species), joinedload(database.Image.uploaded_user)]
+image_full_options = [*image_options, selectinload(database.Image.tasks)]
+task_full_options = [
+    joinedload(database.Task.image).options(*image_options),
+    joinedload(database.Task.created_user),
+    joinedload(database.Task.accepted_user),
+    selectinload(database.Task.bboxes),
+    selectinload(database.Task.polygons),
+]
+user_full_options = [
+    selectinload(database.User.uploaded_images).options(*image_options),
+    selectinload(database.User.created_tasks),
+    selectinload(database.User.accepted_tasks),
+]
+
+
+# List getters page by key: rows with id > after_id in id order (see core/pagination.py)
+def _after(stmt, model, after_id:int|None, limit:int):
+    if after_id is not None:
+        stmt = stmt.filter(model.id > after_id)
+    return stmt.order_by(model.id).limit(limit)
+
+
+# Bulk insert: multi-row INSERT ... RETURNING, the returned rows are the created objects,
+# no refresh per row. SQLAlchemy splits the rows into statements of insertmanyvalues_page_size (1000)
+async def insert_many(db:AsyncSession, model, rows:list[dict]) -> list:
+    # the created objects in rows order, does not commit (used by the importer too)
+    if not rows:
+        return []
+    if db.bind.dialect.name == "sqlite":
+        # sqlite runs the sorted form row by row, its rowids grow in VALUES order anyway
+        result = await db.scalars(insert(model).returning(model), rows)
+        return sorted(result.all(), key=lambda row: row.id)
+    result = await db.scalars(insert(model).returning(model, sort_by_parameter_order=True), rows)
+    return result.all()
+
+
+# Write checks: the user and the state of the referenced tasks in one query.
+# None if the user does not exist
+# and the image size, annotations are checked against
+_task_state = [database.Task.id.label("task_id"), database.Task.status, database.Task.task_type, database.Task.accepted_user_id, database.Image.width, database.Image.height]
+
+async def _with_user(db:AsyncSession, user_id:int, subquery) -> list|None:
+    # user LEFT JOIN subquery ON true: no row - no user, a row without task_id - user without matches
+    stmt = (
+        select(database.User.id.label("user_id"), subquery)
+        .select_from(database.User)
+        .outerjoin(subquery, true())
+        .filter(database.User.id == user_id)
+    )
+    rows = (await db.execute(stmt)).all()
+    if not rows:
+        return None
+    return [row for row in rows if row.task_id is not None]
+
+async def get_task_states(db:AsyncSession, user_id:int, task_ids:list[int]) -> dict|None:
+    # task id -> (task_id, status, task_type, accepted_user_id, width, height)
+    subquery = (
+        select(*_task_state)
+        .join(database.Image, database.Image.id == database.Task.image_id)
+        .filter(database.Task.id.in_(task_ids))
+        .subquery()
+    )
+    rows = await _with_user(db, user_id, subquery)
+    return None if rows is None else {row.task_id: row for row in rows}
+
+async def get_annotation_states(db:AsyncSession, user_id:int, model, ids:list[int]) -> dict|None:
+    # annotation id -> (annotation_id, task_id, status, task_type, accepted_user_id, width, height)
+    subquery = (
+        select(model.id.label("annotation_id"), *_task_state)
+        .join(database.Task, database.Task.id == model.task_id)
+        .join(database.Image, database.Image.id == database.Task.image_id)
+        .filter(model.id.in_(ids))
+        .subquery()
+    )
+    rows = await _with_user(db, user_id, subquery)
+    return None if rows is None else {row.annotation_id: row for row in rows}
+
+
+# Batch update/delete by primary key, the caller commits
+async def get_task_ids(db:AsyncSession, model, ids:list[int]) -> dict[int, int]:
+    # annotation id -> task id, missing ids are left out
+    result = await db.execute(select(model.id, model.task_id).filter(model.id.in_(ids)))
+    return dict(result.all())
+
+async def _update_many(db:AsyncSession, model, rows:list[dict]) -> list:
+    # executemany UPDATE ... WHERE id = ?, then the updated rows in one SELECT
+    await db.execute(update(model), rows)
+    ids = [row["id"] for row in rows]
+    result = await db.scalars(select(model).filter(model.id.in_(ids)).execution_options(populate_existing=True))
+    by_id = {i.id: i for i in result}
+    return [by_id[i] for i in dict.fromkeys(ids)]
+
+async def _delete_many(db:AsyncSession, model, ids:list[int]) -> list[int]:
+    result = await db.execute(delete(model).filter(model.id.in_(ids)).returning(model.task_id).execution_options(synchronize_session=False))
+    await stats.count_annotations(db, model, Counter({task_id: -count for task_id, count in Counter(result.scalars()).items()}))
+    return list(dict.fromkeys(ids))
+
+
+# Region queries: annotations of an image whose bounds intersect (x_min, y_min, x_max, y_max),
+# answered through the spatial index (see core/spatial.py)
+async def _get_in_region(db:AsyncSession, model, image_id:int, x_min:float, y_min:float, x_max:float, y_max:float, after_id:int|None=None, limit=100, exclude_id:int|None=None):
+    dialect = db.bind.dialect.name
+    stmt = spatial.intersecting(select(model), model, dialect, x_min, y_min, x_max, y_max, image_id=image_id)
+    if dialect not in spatial.IMAGE_KEYED_DIALECTS:
+        stmt = stmt.filter(model.task_id.in_(select(database.Task.id).filter(database.Task.image_id == image_id)))
+    if exclude_id is not None:
+        stmt = stmt.filter(model.id != exclude_id)
+    result = await db.execute(_after(stmt, model, after_id, limit))
+    return result.scalars().all()
 
 
 # Users
-def get_users(db:Session,skip=0, limit=100) -> list[database.User]:
-    return db.execute(select(database.User).offset(skip).limit(limit)).scalars()
+async def get_users(db:AsyncSession, after_id:int|None=None, limit=100) -> list[database.User]:
+    result = await db.execute(_after(select(database.User), database.User, after_id, limit))
+    return result.scalars().all()
 
-def get_user_by_id(db:Session, user_id:int) -> database.User:
-    return db.get(database.User, user_id)
-    
-def get_user_by_email(db:Session, email:str) -> database.User:
-    return db.execute(select(database.User).filter(database.User.email==email)).scalar()
+async def get_user_by_id(db:AsyncSession, user_id:int, options=()) -> database.User:
+    return await db.get(database.User, user_id, options=options)
 
-def get_user_by_username(db:Session, username:str) -> database.User:
-    return db.execute(select(database.User).filter(database.User.username==username)).scalar()
+async def get_user_by_email(db:AsyncSession, email:str) -> database.User:
+    result = await db.execute(select(database.User).filter(database.User.email==email))
+    return result.scalar()
 
-def create_user(db:Session, new_user:schemas.UserCreate) -> database.User:
+async def get_user_by_username(db:AsyncSession, username:str) -> database.User:
+    result = await db.execute(select(database.User).filter(database.User.username==username))
+    return result.scalar()
+
+async def create_user(db:AsyncSession, new_user:schemas.UserCreate) -> database.User:
     db_user = database.User(username=new_user.username, email=new_user.email, hashed_password=new_user.hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
 # Task
-def get_tasks(db:Session, skip=0, limit=100, task_type:schemas.TaskType=None, task_status: database.TaskStatus=None) -> list[database.Task]:
+# Tasks are listed and dispatched in priority order: priority DESC, id
+_dispatch_order = [database.Task.priority.desc(), database.Task.id]
+
+async def get_tasks(db:AsyncSession, after:tuple[int, int]|None=None, limit=100, task_type:schemas.TaskType=None, task_status: database.TaskStatus=None, options=()) -> list[database.Task]:
+    # after - (priority, id) of the last task of the previous page
     conditions = []
     if task_type is not None:
         conditions.append(database.Task.task_type == task_type)
     if task_status is not None:
         conditions.append(database.Task.status == task_status)
 
-    return db.execute(select(database.Task).filter(*conditions).offset(skip).limit(limit)).scalars()
-   
-def get_task_by_id(db:Session, id:int) -> database.Task:
-    return db.get(database.Task, id)
-
-def get_tasks_by_image(db:Session, image_id:int) -> database.Task:
-    return db.execute(select(database.Task).filter_by(image_id=image_id)).scalars()
-
-def create_task(db:Session, new_task:schemas.TaskBase) -> database.Task:
+    stmt = select(database.Task).options(*options).filter(*conditions)
+    if after is None:
+        result = await db.execute(stmt.order_by(*_dispatch_order).limit(limit))
+        return result.scalars().all()
+    # the mixed direction key is two index range reads instead of one OR condition
+    # the index could not seek on: the rest of the same priority, then lower priorities
+    priority, id = after
+    result = await db.execute(_after(stmt.filter(database.Task.priority == priority), database.Task, id, limit))
+    tasks = result.scalars().all()
+    if len(tasks) < limit:
+        result = await db.execute(stmt.filter(database.Task.priority < priority).order_by(*_dispatch_order).limit(limit - len(tasks)))
+        tasks += result.scalars().all()
+    return tasks
+
+async def get_task_by_id(db:AsyncSession, id:int, options=()) -> database.Task:
+    return await db.get(database.Task, id, options=options)
+
+async def patch_annotations(db:AsyncSession, task_id:int, model, operations:list[schemas.AnnotationOperation], revision:int|None=None) -> tuple[int, list[int]]|None:
+    # one transaction: bump the task revision, then the net effect of the operations
+    # as one executemany UPDATE, one DELETE and one INSERT. None if revision is stale
+    stmt = update(database.Task).where(database.Task.id == task_id).values(revision=database.Task.revision + 1).returning(database.Task.revision)
+    if revision is not None:
+        stmt = stmt.where(database.Task.revision == revision)
+    new_revision = (await db.execute(stmt)).scalar()
+    if new_revision is None:
+        await db.rollback()
+        return None
+
+    added, updated, deleted = [], {}, []
+    for operation in operations:
+        if operation.op == "delete":
+            updated.pop(operation.id, None)
+            deleted.append(operation.id)
+            continue
+        row = operation.bbox.model_dump() if operation.bbox is not None else pack_polygon(operation.polygon.points)
+        if operation.op == "add":
+            added.append({"task_id": task_id, **row})
+        else:
+            updated[operation.id] = {"id": operation.id, **row}
+    if updated:
+        await db.execute(update(model), list(updated.values()))
+    if deleted:
+        await _delete_many(db, model, deleted)
+    added = await insert_many(db, model, added)
+    await stats.count_annotations(db, model, Counter({task_id: len(added)}))
+    await db.commit()
+    return new_revision, [i.id for i in added]
+
+async def get_tasks_by_image(db:AsyncSession, image_id:int) -> database.Task:
+    result = await db.execute(select(database.Task).filter_by(image_id=image_id))
+    return result.scalars().all()
+
+async def create_task(db:AsyncSession, new_task:schemas.TaskBase) -> database.Task:
     db_task = database.Task(
-        **new_task.model_dump(),
+        **new_task.model_dump(exclude={"priority"}),
         created_at=datetime.now(timezone.utc)
     )
+    if new_task.priority is not None:
+        db_task.priority = new_task.priority
+    else:
+        # species priority, evaluated within the INSERT
+        db_task.priority = (
+            select(database.Species.priority)
+            .join(database.Image, database.Image.species_id == database.Species.id)
+            .filter(database.Image.id == new_task.image_id)
+            .scalar_subquery()
+        )
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
+    await stats.count_tasks(db, Counter({(database.TaskStatus.pending, new_task.task_type): 1}))
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
-def accept_task(db:Session, id:int, user_id:int) -> database.Task:
-    task = get_task_by_id(db=db, id=id)
-    task.accepted_user_id = user_id
-    task.accepted_at = datetime.now(timezone.utc)
-    task.status = database.TaskStatus.accepted
-    db.commit()
-    db.refresh(task)
+# Accepting is a conditional UPDATE ... WHERE status = 'pending', so of two users accepting
+# the same task at once exactly one gets it, the other gets None
+def _accept(task_id, user_id:int):
+    now = datetime.now(timezone.utc)
+    return (
+        update(database.Task)
+        .where(database.Task.id == task_id, database.Task.status == database.TaskStatus.pending)
+        .values(
+            accepted_user_id=user_id, accepted_at=now, status=database.TaskStatus.accepted,
+            expires_at=now + timedelta(seconds=task_lease_seconds)
+        )
+        .returning(database.Task)
+    )
+
+async def accept_task(db:AsyncSession, id:int, user_id:int) -> database.Task|None:
+    task = (await db.scalars(_accept(id, user_id))).one_or_none()
+    if task:
+        await stats.move_tasks(db, [task.task_type], database.TaskStatus.pending, database.TaskStatus.accepted)
+    await db.commit()
     return task
 
-def finish_task(db:Session, id:int) -> database.Task:
-    task = get_task_by_id(db=db, id=id)
+async def claim_task(db:AsyncSession, user_id:int, task_type:database.TaskType|None=None, species_id:int|None=None) -> database.Task|None:
+    # accept the first pending task in dispatch order matching the filters in one statement
+    candidate = (
+        select(database.Task.id)
+        .filter(database.Task.status == database.TaskStatus.pending)
+        .order_by(*_dispatch_order)
+        .limit(1)
+    )
+    if task_type is not None:
+        candidate = candidate.filter(database.Task.task_type == task_type)
+    if species_id is not None:
+        candidate = candidate.filter(database.Task.image_id.in_(select(database.Image.id).filter(database.Image.species_id == species_id)))
+    if db.bind.dialect.name == "postgresql":
+        # concurrent claims pass over rows locked by each other instead of queueing on the same one
+        candidate = candidate.with_for_update(skip_locked=True)
+    # sqlite serializes writers, the subquery and the update see the same rows
+    task = (await db.scalars(_accept(candidate.scalar_subquery(), user_id))).one_or_none()
+    if task:
+        await stats.move_tasks(db, [task.task_type], database.TaskStatus.pending, database.TaskStatus.accepted)
+    await db.commit()
+    return task
+
+async def finish_task(db:AsyncSession, id:int) -> database.Task:
+    task = await get_task_by_id(db=db, id=id)
+    await stats.move_tasks(db, [task.task_type], task.status, database.TaskStatus.finished)
     task.finished_at = datetime.now(timezone.utc)
     task.status = database.TaskStatus.finished
-    db.commit()
-    db.refresh(task)
+    task.expires_at = None
+    await stats.count_finished(db, task.accepted_user_id, task.finished_at.date())
+    await db.commit()
+    await db.refresh(task)
     return task
 
+async def extend_task_lease(db:AsyncSession, id:int, user_id:int) -> database.Task|None:
+    # None if the task is not accepted by the user (anymore)
+    stmt = (
+        update(database.Task)
+        .where(
+            database.Task.id == id,
+            database.Task.status == database.TaskStatus.accepted,
+            database.Task.accepted_user_id == user_id,
+        )
+        .values(expires_at=datetime.now(timezone.utc) + timedelta(seconds=task_lease_seconds))
+        .returning(database.Task)
+    )
+    task = (await db.scalars(stmt)).one_or_none()
+    await db.commit()
+    return task
+
+async def release_expired_tasks(db:AsyncSession, now:datetime, batch_size:int=1000) -> int:
+    # expired accepted tasks back to pending, batch_size per statement and commit.
+    # Reads only expired rows from ix_task_status_expires_at, so the cost does not depend on the table size
+    released = 0
+    while True:
+        expired = (
+            select(database.Task.id)
+            .filter(database.Task.status == database.TaskStatus.accepted, database.Task.expires_at < now)
+            .order_by(database.Task.expires_at)
+            .limit(batch_size)
+        )
+        if db.bind.dialect.name == "postgresql":
+            expired = expired.with_for_update(skip_locked=True)
+        stmt = (
+            update(database.Task)
+            .where(database.Task.id.in_(expired), database.Task.status == database.TaskStatus.accepted)
+            .values(status=database.TaskStatus.pending, accepted_user_id=None, accepted_at=None, expires_at=None)
+            .returning(database.Task.task_type)
+            .execution_options(synchronize_session=False)
+        )
+        task_types = (await db.execute(stmt)).scalars().all()
+        await stats.move_tasks(db, task_types, database.TaskStatus.accepted, database.TaskStatus.pending)
+        await db.commit()
+        count = len(task_types)
+        released += count
+        if count < batch_size:
+            return released
+
 
 # Images
-def get_image_by_id(db:Session, id:int) -> database.Image:
-    image = db.get(database.Image, id)
+async def get_image_by_id(db:AsyncSession, id:int, options=()) -> database.Image:
+    image = await db.get(database.Image, id, options=options)
     return image
 
-def get_images(db:Session, skip=0, limit=100, species_id:int|None=None) -> list[database.Image]:
+async def get_images(db:AsyncSession, after_id:int|None=None, limit=100, species_id:int|None=None, options=()) -> list[database.Image]:
+    stmt = select(database.Image).options(*options)
     if species_id:
-        return db.execute(select(database.Image).filter(database.Image.species_id == species_id).offset(skip).limit(limit))
-    return db.execute(select(database.Image).offset(skip).limit(limit)).scalars()
+        stmt = stmt.filter(database.Image.species_id == species_id)
+    result = await db.execute(_after(stmt, database.Image, after_id, limit))
+    return result.scalars().all()
+
+async def get_images_by_ids(db:AsyncSession, ids:list[int]) -> dict[int, database.Image]:
+    # id -> image, missing ids are left out
+    result = await db.scalars(select(database.Image).filter(database.Image.id.in_(ids)))
+    return {i.id: i for i in result}
 
-def create_image(db:Session, image:schemas.ImageBase) -> database.Image:
+async def create_image(db:AsyncSession, image:schemas.ImageBase) -> database.Image:
     db_image = database.Image(
         **image.model_dump(),
         uploaded_at = datetime.now(timezone.utc)
     )
     db.add(db_image)
-    db.commit()
-    db.refresh(db_image)
+    await db.commit()
+    # schemas.Image response
+    await db.refresh(db_image, attribute_names=["species", "uploaded_user"])
     return db_image
 
-def update_image_species():
+async def create_images(db:AsyncSession, images:list[schemas.ImageBase]) -> list[database.Image]:
+    now = datetime.now(timezone.utc)
+    db_images = await insert_many(db, database.Image, [{**i.model_dump(), "uploaded_at": now} for i in images])
+    await db.commit()
+    return db_images
+
+async def get_image_by_sha256(db:AsyncSession, sha256:str, options=()) -> database.Image|None:
+    image = await db.execute(select(database.Image).options(*options).filter(database.Image.sha256 == sha256))
+    return image.scalar()
+
+async def get_images_by_sha256(db:AsyncSession, hashes:list[str]) -> dict[str, database.Image]:
+    images = await db.scalars(select(database.Image).filter(database.Image.sha256.in_(hashes)))
+    return {i.sha256: i for i in images}
+
+async def get_unhashed_images(db:AsyncSession, after_id:int|None=None, limit=1000) -> list[database.Image]:
+    images = await db.scalars(_after(select(database.Image).filter(database.Image.sha256 == None), database.Image, after_id, limit))
+    return images.all()
+
+async def set_image_hashes(db:AsyncSession, rows:list[dict]):
+    # rows: {"id", "sha256"}
+    if rows:
+        await db.execute(update(database.Image), rows)
+    await db.commit()
+
+async def get_images_without_metadata(db:AsyncSession, after_id:int|None=None, limit=1000) -> list[database.Image]:
+    images = await db.scalars(_after(select(database.Image).filter(database.Image.format == None), database.Image, after_id, limit))
+    return images.all()
+
+async def set_image_metadata(db:AsyncSession, rows:list[dict]):
+    # rows: {"id", "width", "height", "channels", "format"}
+    if rows:
+        await db.execute(update(database.Image), rows)
+    await db.commit()
+
+async def update_image_species():
     pass
 
 
 # Species
-def get_species(db:Session, skip:int=0, limit:int=100) -> list[database.Species]:
-    species = db.execute(select(database.Species).offset(skip).limit(limit)).scalars()
-    return species
+async def get_species(db:AsyncSession, after_id:int|None=None, limit:int=100) -> list[database.Species]:
+    species = await db.execute(_after(select(database.Species), database.Species, after_id, limit))
+    return species.scalars().all()
 
-def get_species_by_id(db:Session, id:int) -> database.Species:
-    species = db.get(database.Species, id)
+async def get_species_by_id(db:AsyncSession, id:int) -> database.Species:
+    species = await db.get(database.Species, id)
     return species
 
-def get_species_by_name(db:Session, name:str) -> database.Species:
-    species = db.execute(select(database.Species).filter(database.Species.name == name)).scalar()
-    return species
+async def get_species_by_name(db:AsyncSession, name:str) -> database.Species:
+    species = await db.execute(select(database.Species).filter(database.Species.name == name))
+    return species.scalar()
 
-def create_species(db:Session, new_species: schemas.SpeciesCreate) -> database.Species:
+async def create_species(db:AsyncSession, new_species: schemas.SpeciesCreate) -> database.Species:
     db_species = database.Species(**new_species.model_dump())
     db.add(db_species)
-    db.commit()
-    db.refresh(db_species)
+    await db.commit()
+    await db.refresh(db_species)
     return db_species
-    
-def delete_species(db:Session):
+
+async def delete_species(db:AsyncSession):
     # check image with given species existed
     # check any other relationship with given species
     pass
 
 # BBOXES
-def get_bboxes(db:Session, skip=0, limit=100, task_id:int|None=None) -> list[database.BboxAnnotation]:
+async def get_bboxes(db:AsyncSession, after_id:int|None=None, limit=100, task_id:int|None=None) -> list[database.BboxAnnotation]:
+    stmt = select(database.BboxAnnotation)
     if task_id:
-        return db.execute(select(database.BboxAnnotation).filter(database.BboxAnnotation.task_id == task_id).offset(skip).limit(limit))
-    return db.execute(select(database.BboxAnnotation).offset(skip).limit(limit)).scalars()
+        stmt = stmt.filter(database.BboxAnnotation.task_id == task_id)
+    result = await db.execute(_after(stmt, database.BboxAnnotation, after_id, limit))
+    return result.scalars().all()
 
-def get_bbox_by_id(db:Session, bbox_id:int) -> database.BboxAnnotation:
-    bbox = db.get(database.BboxAnnotation, bbox_id)
+async def get_bbox_by_id(db:AsyncSession, bbox_id:int) -> database.BboxAnnotation:
+    bbox = await db.get(database.BboxAnnotation, bbox_id)
     return bbox
 
-def create_bboxes(db:Session, new_bboxes: list[schemas.BboxAnnotationBase]) -> list[database.BboxAnnotation]:
-    # # not add relationship
-    # return db.scalars(
-    #     insert(database.BboxAnnotation).returning(database.BboxAnnotation),
-    #     new_bboxes
-    # ).all()
-
-    db_bboxes = [database.BboxAnnotation(**new_bbox.model_dump()) for new_bbox in new_bboxes]
-    db.add_all(db_bboxes)
-    db.commit()
-    for db_bbox in db_bboxes:
-        db.refresh(db_bbox)
+async def get_bboxes_in_region(db:AsyncSession, image_id:int, x_min:float, y_min:float, x_max:float, y_max:float, after_id:int|None=None, limit=100, exclude_id:int|None=None) -> list[database.BboxAnnotation]:
+    return await _get_in_region(db, database.BboxAnnotation, image_id, x_min, y_min, x_max, y_max, after_id=after_id, limit=limit, exclude_id=exclude_id)
+
+async def create_bboxes(db:AsyncSession, new_bboxes: list[schemas.BboxAnnotationBase]) -> list[database.BboxAnnotation]:
+    db_bboxes = await insert_many(db, database.BboxAnnotation, [new_bbox.model_dump() for new_bbox in new_bboxes])
+    await stats.count_annotations(db, database.BboxAnnotation, Counter(i.task_id for i in db_bboxes))
+    await db.commit()
     return db_bboxes
 
-def create_bbox(db:Session, new_bbox: schemas.BboxAnnotationBase) -> database.BboxAnnotation:
+async def create_bbox(db:AsyncSession, new_bbox: schemas.BboxAnnotationBase) -> database.BboxAnnotation:
     db_bbox = database.BboxAnnotation(**new_bbox.model_dump())
     db.add(db_bbox)
-    db.commit()
-    db.refresh(db_bbox)
+    await stats.count_annotations(db, database.BboxAnnotation, Counter({new_bbox.task_id: 1}))
+    await db.commit()
+    await db.refresh(db_bbox)
     return db_bbox
 
-def update_bbox_by_id(db:Session, bbox_id:int, new_bbox:str) -> database.BboxAnnotation:
+async def update_bbox_by_id(db:AsyncSession, bbox_id:int, new_bbox:schemas.BboxAnnotationData) -> database.BboxAnnotation:
     # 2 queries to db
-    db_bbox = get_bbox_by_id(db=db, bbox_id=bbox_id)
-    db_bbox.bbox = new_bbox
-    db.commit()
-    db.refresh(db_bbox)
+    db_bbox = await get_bbox_by_id(db=db, bbox_id=bbox_id)
+    for key, value in new_bbox.model_dump().items():
+        setattr(db_bbox, key, value)
+    await db.commit()
+    await db.refresh(db_bbox)
 
     # # 1 query to db
     # stmt = (
@@ -164,50 +466,118 @@ def update_bbox_by_id(db:Session, bbox_id:int, new_bbox:str) -> database.BboxAnn
     #     .filter_by(id=bbox_id)
     #     .returning(database.BboxAnnotation)
     # )
-    # db_bbox = db.execute(stmt).scalar()
-    
+    # db_bbox = (await db.execute(stmt)).scalar()
+
     return db_bbox
 
-def delete_bbox_by_id(db:Session, bbox_id:int):
-    db_bbox = get_bbox_by_id(db=db, bbox_id=bbox_id)
-    db.delete(db_bbox)
-    db.commit()
+async def delete_bbox_by_id(db:AsyncSession, bbox_id:int):
+    db_bbox = await get_bbox_by_id(db=db, bbox_id=bbox_id)
+    await db.delete(db_bbox)
+    await stats.count_annotations(db, database.BboxAnnotation, Counter({db_bbox.task_id: -1}))
+    await db.commit()
     return bbox_id
 
+async def update_bboxes(db:AsyncSession, new_bboxes:list[schemas.BboxAnnotationUpdate]) -> list[database.BboxAnnotation]:
+    db_bboxes = await _update_many(db, database.BboxAnnotation, [new_bbox.model_dump() for new_bbox in new_bboxes])
+    await db.commit()
+    return db_bboxes
+
+async def delete_bboxes(db:AsyncSession, bboxes_id:list[int]) -> list[int]:
+    bboxes_id = await _delete_many(db, database.BboxAnnotation, bboxes_id)
+    await db.commit()
+    return bboxes_id
+
 # POLYGONS
-def get_polygons(db:Session, skip=0, limit=100, task_id:int|None=None) -> list[database.PolyAnnotation]:
+async def get_polygons(db:AsyncSession, after_id:int|None=None, limit=100, task_id:int|None=None) -> list[database.PolyAnnotation]:
+    stmt = select(database.PolyAnnotation)
     if task_id:
-        return db.execute(select(database.PolyAnnotation).filter(database.PolyAnnotation.task_id == task_id).offset(skip).limit(limit))
-    return db.execute(select(database.PolyAnnotation).offset(skip).limit(limit)).scalars()
+        stmt = stmt.filter(database.PolyAnnotation.task_id == task_id)
+    result = await db.execute(_after(stmt, database.PolyAnnotation, after_id, limit))
+    return result.scalars().all()
 
-def get_polygon_by_id(db:Session, polygon_id:int) -> database.PolyAnnotation:
-    polygon = db.get(database.PolyAnnotation, polygon_id)
+async def get_polygon_by_id(db:AsyncSession, polygon_id:int) -> database.PolyAnnotation:
+    polygon = await db.get(database.PolyAnnotation, polygon_id)
     return polygon
 
-def create_polygon(db:Session, new_polygon: schemas.PolyAnnotationBase) -> database.PolyAnnotation:
-    db_polygon = database.PolyAnnotation(**new_polygon.model_dump())
+async def get_polygons_in_region(db:AsyncSession, image_id:int, x_min:float, y_min:float, x_max:float, y_max:float, after_id:int|None=None, limit=100, exclude_id:int|None=None) -> list[database.PolyAnnotation]:
+    # by polygon bounds, not the exact outline
+    return await _get_in_region(db, database.PolyAnnotation, image_id, x_min, y_min, x_max, y_max, after_id=after_id, limit=limit, exclude_id=exclude_id)
+
+async def create_polygon(db:AsyncSession, new_polygon: schemas.PolyAnnotationBase) -> database.PolyAnnotation:
+    db_polygon = database.PolyAnnotation(task_id=new_polygon.task_id, **pack_polygon(new_polygon.points))
     db.add(db_polygon)
-    db.commit()
-    db.refresh(db_polygon)
+    await stats.count_annotations(db, database.PolyAnnotation, Counter({new_polygon.task_id: 1}))
+    await db.commit()
+    await db.refresh(db_polygon)
     return db_polygon
 
-def create_polygons(db:Session, new_polygons: list[schemas.PolyAnnotationBase]) -> list[database.PolyAnnotation]:
-    db_polygons = [database.PolyAnnotation(**new_polygon.model_dump()) for new_polygon in new_polygons]
-    db.add_all(db_polygons)
-    db.commit()
-    for db_polygon in db_polygons:
-        db.refresh(db_polygon)
+async def create_polygons(db:AsyncSession, new_polygons: list[schemas.PolyAnnotationBase]) -> list[database.PolyAnnotation]:
+    db_polygons = await insert_many(
+        db, database.PolyAnnotation,
+        [{"task_id": new_polygon.task_id, **pack_polygon(new_polygon.points)} for new_polygon in new_polygons]
+    )
+    await stats.count_annotations(db, database.PolyAnnotation, Counter(i.task_id for i in db_polygons))
+    await db.commit()
     return db_polygons
 
-def update_polygon_by_id(db:Session, polygon_id:int, new_polygon:str) -> database.PolyAnnotation:
-    db_polygon = get_polygon_by_id(db=db, polygon_id=polygon_id)
-    db_polygon.polygon = new_polygon
-    db.commit()
-    db.refresh(db_polygon)
+async def update_polygon_by_id(db:AsyncSession, polygon_id:int, new_polygon:schemas.PolyAnnotationData) -> database.PolyAnnotation:
+    db_polygon = await get_polygon_by_id(db=db, polygon_id=polygon_id)
+    for key, value in pack_polygon(new_polygon.points).items():
+        setattr(db_polygon, key, value)
+    await db.commit()
+    await db.refresh(db_polygon)
     return db_polygon
 
-def delete_polygon_by_id(db:Session, polygon_id:int):
-    db_polygon = get_polygon_by_id(db=db, polygon_id=polygon_id)
-    db.delete(db_polygon)
-    db.commit()
+async def delete_polygon_by_id(db:AsyncSession, polygon_id:int):
+    db_polygon = await get_polygon_by_id(db=db, polygon_id=polygon_id)
+    await db.delete(db_polygon)
+    await stats.count_annotations(db, database.PolyAnnotation, Counter({db_polygon.task_id: -1}))
+    await db.commit()
     return polygon_id
+
+async def update_polygons(db:AsyncSession, new_polygons:list[schemas.PolyAnnotationUpdate]) -> list[database.PolyAnnotation]:
+    db_polygons = await _update_many(
+        db, database.PolyAnnotation,
+        [{"id": new_polygon.id, **pack_polygon(new_polygon.points)} for new_polygon in new_polygons]
+    )
+    await db.commit()
+    return db_polygons
+
+async def delete_polygons(db:AsyncSession, polygons_id:list[int]) -> list[int]:
+    polygons_id = await _delete_many(db, database.PolyAnnotation, polygons_id)
+    await db.commit()
+    return polygons_id
+
+
+# Stats, counters maintained by the writes above (see core/stats.py)
+async def get_task_counts(db:AsyncSession, task_status:database.TaskStatus|None=None, task_type:database.TaskType|None=None) -> list[database.TaskCount]:
+    stmt = select(database.TaskCount).filter(database.TaskCount.count != 0).order_by(database.TaskCount.status, database.TaskCount.task_type)
+    if task_status is not None:
+        stmt = stmt.filter(database.TaskCount.status == task_status.name)
+    if task_type is not None:
+        stmt = stmt.filter(database.TaskCount.task_type == task_type.name)
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+async def get_annotation_counts(db:AsyncSession, species_id:int|None=None) -> list[database.AnnotationCount]:
+    stmt = select(database.AnnotationCount).filter(database.AnnotationCount.count != 0).order_by(database.AnnotationCount.species_id, database.AnnotationCount.kind)
+    if species_id is not None:
+        stmt = stmt.filter(database.AnnotationCount.species_id == species_id)
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+async def get_finished_task_counts(db:AsyncSession, user_id:int|None=None, date_from:date|None=None, date_to:date|None=None) -> list[database.FinishedTaskCount]:
+    stmt = select(database.FinishedTaskCount).filter(database.FinishedTaskCount.count != 0).order_by(database.FinishedTaskCount.user_id, database.FinishedTaskCount.day)
+    if user_id is not None:
+        stmt = stmt.filter(database.FinishedTaskCount.user_id == user_id)
+    if date_from is not None:
+        stmt = stmt.filter(database.FinishedTaskCount.day >= date_from)
+    if date_to is not None:
+        stmt = stmt.filter(database.FinishedTaskCount.day <= date_to)
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+async def recompute_stats(db:AsyncSession):
+    conn = await db.connection()
+    await conn.run_sync(stats.recompute)
+    await db.commit()
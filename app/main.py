@@ -1,19 +1,58 @@
-from fastapi import FastAPI
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
 from app.routes.image import image_router
 from app.routes.task import task_router
 from app.routes.user import user_router
 from app.routes.species import species_router
 from app.routes.bbox import bbox_router
 from app.routes.polygon import poly_router
-from app.core.database import Base, engine
+from app.routes.stats import stats_router
+from app.routes.export import export_router
+from app.routes.importer import import_router
+from app.core.database import engine
+from app.core.migrations import migrate
+from app.core.leases import sweep_forever
+from app.core import workers
 
-Base.metadata.drop_all(engine)
-Base.metadata.create_all(engine)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    # every worker runs this, only the first one to take the lock applies pending migrations
+    await migrate(engine)
+    sweeper = asyncio.create_task(sweep_forever())
+    yield
+    sweeper.cancel()
+    workers.shutdown()
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+
+def _json_safe(value):
+    # NaN and infinity from a request body are not valid json, echoed back as strings
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_json_safe(i) for i in value]
+    return value
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request:Request, exc:RequestValidationError):
+    # FastAPI's default 422 response, which fails to encode rejected NaN and infinity
+    return JSONResponse(status_code=422, content={"detail": _json_safe(jsonable_encoder(exc.errors()))})
+
 app.include_router(image_router)
 app.include_router(task_router)
 app.include_router(user_router)
 app.include_router(species_router)
 app.include_router(bbox_router)
 app.include_router(poly_router)
+app.include_router(stats_router)
+app.include_router(export_router)
+app.include_router(import_router)
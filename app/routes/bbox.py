@@ -1,73 +1,104 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Body, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
 from app.core.database import get_db
-from app.core.common import check_task, check_user
-from app.schemas import BboxAnnotationBase
+from app.core.common import check_annotations, check_user, check_write
+from app.schemas import BboxAnnotation, BboxAnnotationBase, BboxAnnotationData, BboxAnnotationUpdate, Page
+from app.core.pagination import PageLimit, after_id, paginate
 from app.routes.exception import *
 
-# TODO update many, Delete many
- 
 bbox_router = APIRouter(prefix="/bbox", tags=["bbox"])
 
 @bbox_router.get("/")
 async def get_bboxes(
-    skip=0,
-    limit=100,
+    cursor:str|None=None,
+    limit:PageLimit=100,
     task_id:int|None=None,
-    db:Session=Depends(get_db)
-):
-    bboxes = crud.get_bboxes(db=db, skip=skip,limit=limit, task_id=task_id)
-    return bboxes
+    db:AsyncSession=Depends(get_db)
+) -> Page[BboxAnnotation]:
+    bboxes = await crud.get_bboxes(db=db, after_id=after_id(cursor),limit=limit+1, task_id=task_id)
+    return paginate(bboxes, limit)
+
+@bbox_router.get("/region")
+async def get_bboxes_in_region(
+    image_id:int,
+    x_min:float,
+    y_min:float,
+    x_max:float,
+    y_max:float,
+    cursor:str|None=None,
+    limit:PageLimit=100,
+    db:AsyncSession=Depends(get_db)
+) -> Page[BboxAnnotation]:
+    # bboxes of the image whose bounds intersect the region
+    if x_min > x_max or y_min > y_max:
+        raise InvalidRegionException
+    bboxes = await crud.get_bboxes_in_region(db=db, image_id=image_id, x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max, after_id=after_id(cursor), limit=limit+1)
+    return paginate(bboxes, limit)
+
+@bbox_router.get("/{bbox_id:int}/overlapping")
+async def get_overlapping_bboxes(bbox_id:int, cursor:str|None=None, limit:PageLimit=100, db:AsyncSession=Depends(get_db)) -> Page[BboxAnnotation]:
+    # other bboxes of the same image whose bounds intersect the bounds of this one
+    bbox = await crud.get_bbox_by_id(db=db, bbox_id=bbox_id)
+    if not bbox:
+        raise BboxNotFoundException
+    task = await crud.get_task_by_id(db=db, id=bbox.task_id)
+    bboxes = await crud.get_bboxes_in_region(
+        db=db, image_id=task.image_id,
+        x_min=bbox.x_min, y_min=bbox.y_min, x_max=bbox.x_max, y_max=bbox.y_max,
+        after_id=after_id(cursor), limit=limit+1, exclude_id=bbox.id
+    )
+    return paginate(bboxes, limit)
 
 @bbox_router.get("/{bbox_id:int}")
-async def get_bbox(bbox_id:int, db:Session=Depends(get_db)):
-    bbox = crud.get_bbox_by_id(db=db,bbox_id=bbox_id)
+async def get_bbox(bbox_id:int, db:AsyncSession=Depends(get_db)):
+    bbox = await crud.get_bbox_by_id(db=db,bbox_id=bbox_id)
     if not bbox:
         raise BboxNotFoundException
     return bbox
 
 @bbox_router.post("/create")
-async def create_bbox(user_id:int, new_bbox:BboxAnnotationBase, db:Session=Depends(get_db)):
-    user = check_user(db=db, user_id=user_id)
-    task = check_task(db=db,user_id=user.id, task_id=new_bbox.task_id, type="bbox")
+async def create_bbox(user_id:int, new_bbox:BboxAnnotationBase, db:AsyncSession=Depends(get_db)):
+    await check_write(db=db, user_id=user_id, task_ids=[new_bbox.task_id], type="bbox", annotations=[new_bbox])
 
-    bbox = crud.create_bbox(db=db, new_bbox=new_bbox)
+    bbox = await crud.create_bbox(db=db, new_bbox=new_bbox)
     return bbox
 
 @bbox_router.post("/createmany")
-async def create_bboxes(user_id:int, new_bboxes:list[BboxAnnotationBase], db:Session=Depends(get_db)):
+async def create_bboxes(user_id:int, new_bboxes:list[BboxAnnotationBase], db:AsyncSession=Depends(get_db)):
     # add all or nothing
-    user = check_user(db=db, user_id=user_id)
-    tasks_id = set([i.task_id for i in new_bboxes])
-    for task_id in tasks_id:
-        task = check_task(db=db,user_id=user.id, task_id=task_id, type="bbox")
-    bboxes = crud.create_bboxes(db=db, new_bboxes=new_bboxes)
+    await check_write(db=db, user_id=user_id, task_ids=[i.task_id for i in new_bboxes], type="bbox", annotations=new_bboxes)
+    bboxes = await crud.create_bboxes(db=db, new_bboxes=new_bboxes)
     return bboxes
 
 @bbox_router.put("/update/{bbox_id:int}")
-async def update_bbox(bbox_id:int, user_id:int, new_bbox:str, db:Session=Depends(get_db)):
-    user = check_user(db=db, user_id=user_id)
-    # TODO check task is opened
-    bbox = crud.get_bbox_by_id(db=db, bbox_id=bbox_id)
-    if not bbox:
-        raise BboxNotFoundException
-
-    bbox = crud.update_bbox_by_id(db=db,bbox_id=bbox_id,new_bbox=new_bbox)
+async def update_bbox(bbox_id:int, user_id:int, new_bbox:BboxAnnotationData, db:AsyncSession=Depends(get_db)):
+    await check_annotations(db=db, user_id=user_id, ids=[bbox_id], type="bbox", updates=[BboxAnnotationUpdate(id=bbox_id, **new_bbox.model_dump())])
+    bbox = await crud.update_bbox_by_id(db=db,bbox_id=bbox_id,new_bbox=new_bbox)
     return bbox
 
-# @bbox_router.put("/updatemany/")
-# async def update_bboxes(bboxes_id:list[int], user_id:int, new_bboxes:list[int], db:Session=Depends(get_db)):
-#     pass
+@bbox_router.put("/updatemany")
+async def update_bboxes(user_id:int, new_bboxes:list[BboxAnnotationUpdate], db:AsyncSession=Depends(get_db)) -> list[BboxAnnotation]:
+    # update all or nothing
+    await check_annotations(db=db, user_id=user_id, ids=[i.id for i in new_bboxes], type="bbox", updates=new_bboxes)
+    bboxes = await crud.update_bboxes(db=db, new_bboxes=new_bboxes)
+    return bboxes
 
 @bbox_router.delete("/delete/{bbox_id:int}")
-async def delete_bbox(bbox_id:int, user_id:int, db:Session=Depends(get_db)):
+async def delete_bbox(bbox_id:int, user_id:int, db:AsyncSession=Depends(get_db)):
     # TODO check task is opened
-    bbox = crud.get_bbox_by_id(db=db, bbox_id=bbox_id)
+    bbox = await crud.get_bbox_by_id(db=db, bbox_id=bbox_id)
     if not bbox:
         raise BboxNotFoundException
-    user = check_user(db=db,user_id=user_id)
+    user = await check_user(db=db,user_id=user_id)
+
+    bbox = await crud.delete_bbox_by_id(db=db,bbox_id=bbox_id)
+    return bbox
 
-    bbox = crud.delete_bbox_by_id(db=db,bbox_id=bbox_id)
-    return bbox
\ No newline at end of file
+@bbox_router.delete("/deletemany")
+async def delete_bboxes(user_id:int, bboxes_id:list[int]=Body(), db:AsyncSession=Depends(get_db)) -> list[int]:
+    # delete all or nothing
+    await check_annotations(db=db, user_id=user_id, ids=bboxes_id, type="bbox")
+    bboxes_id = await crud.delete_bboxes(db=db, bboxes_id=bboxes_id)
+    return bboxes_id
\ No newline at end of file
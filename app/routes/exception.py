@@ -1,10 +1,17 @@
 from fastapi import HTTPException
-from starlette.status import HTTP_404_NOT_FOUND,HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_404_NOT_FOUND,HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_409_CONFLICT, HTTP_415_UNSUPPORTED_MEDIA_TYPE
 
 UserNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User with this ID does not exist.")
 UserExistedException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="User with this username or email has already been existed.")
 
 ImageNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Image with this ID does not exist.")
+TileNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Image has no tile at this level and position.")
+ImageFileNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Image file is missing from storage.")
+UnreadableImageException = HTTPException(status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Image file is not a readable image.")
+ImageTooLargeException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Image has more pixels than allowed (IMAGE_MAX_PIXELS).")
+NotAnImageException = HTTPException(status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Uploaded file is not an image.")
+CropOutOfImageException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Crop region does not overlap the image.")
+InvalidArchiveException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="File must be a zip or tar archive.")
 
 SpeciesNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Species with this ID does not existed.")
 SpeciesNameExistedException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Species with this name has already been existed")
@@ -15,6 +22,12 @@ TaskFinishUserNotSame = HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail=
 TaskFinishNotAcceptedTaskError = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot finish a task that has been not accepted.")
 TaskFinishFinishedTaskError = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot finish a task that has been finished.")
 TaskAcceptFinishedException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Task with this ID has already been finished.")
+TaskRevisionConflictException = HTTPException(status_code=HTTP_409_CONFLICT, detail="Annotations of this task have been changed since the given revision.")
+TaskLeaseNotHeldException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Task with this ID is not accepted by this user.")
+NoPendingTaskException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="There is no pending task matching the filters.")
+
+InvalidCursorException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor.")
+InvalidRegionException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Region minimum corner must not be greater than its maximum corner.")
 
 BboxNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Bbox with this ID does not exist.")
 PolygonNotFoundException = HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Polygon with this ID does not exist.")
@@ -23,4 +36,7 @@ AddAnnotationToFinishedTaskException = HTTPException(status_code=HTTP_400_BAD_RE
 AddAnnotationToPendingTaskException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot add an annotation to a task that has not been accepted.")
 AddAnnotationFromNotAcceptedUser = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot add an annotation to a task that did not accepted.")
 AddBboxToPolygonTaskTypeException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot add a bbox to a task that have not bbox annotation type")
-AddPolygonToBboxTaskTypeException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot add a polygon to a task that have not polygon annotation type")
\ No newline at end of file
+AddPolygonToBboxTaskTypeException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="You cannot add a polygon to a task that have not polygon annotation type")
+AnnotationOutOfImageException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Annotation must lie within the image.")
+
+InvalidDatasetException = HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Dataset must be a COCO json and a zip or tar archive of its images.")
\ No newline at end of file
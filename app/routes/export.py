@@ -0,0 +1,44 @@
+from datetime import datetime
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from app.core.common import ANNOTATIONS, BBOX_TASK_TYPES, POLY_TASK_TYPES, AnnotationType
+from app.core.database import TaskType
+from app.core.export import ExportFilter, coco, yolo
+
+# Finished annotations as training datasets, streamed (see core/export.py)
+export_router = APIRouter(prefix="/export", tags=["export"])
+
+@export_router.get("/coco")
+async def export_coco(
+    species_id:int|None=None,
+    task_type:TaskType=None,
+    finished_from:datetime|None=None,
+    finished_to:datetime|None=None,
+):
+    # finished_from inclusive, finished_to exclusive
+    filter = ExportFilter(species_id=species_id, task_type=task_type, finished_from=finished_from, finished_to=finished_to)
+    return StreamingResponse(
+        coco(filter),
+        media_type="application/json",
+        headers={"Content-Disposition": 'attachment; filename="coco.json"'}
+    )
+
+@export_router.get("/yolo")
+async def export_yolo(
+    kind:AnnotationType="bbox",
+    species_id:int|None=None,
+    task_type:TaskType=None,
+    finished_from:datetime|None=None,
+    finished_to:datetime|None=None,
+):
+    # kind: bbox for detection labels, poly for segmentation labels
+    task_types = POLY_TASK_TYPES if kind == "poly" else BBOX_TASK_TYPES
+    filter = ExportFilter(
+        species_id=species_id, task_type=task_type, finished_from=finished_from, finished_to=finished_to,
+        task_types=[TaskType(i) for i in task_types]
+    )
+    return StreamingResponse(
+        yolo(filter, ANNOTATIONS[kind][0]),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="yolo.zip"'}
+    )
@@ -1,40 +1,98 @@
+import asyncio
 import os
-import uuid
-from fastapi import APIRouter, Depends, File, UploadFile
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
-import aiofiles
+from typing import Annotated
+from fastapi import APIRouter, Depends, File, Query, Request, Response, UploadFile
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 import app.crud as crud
 from app.core.database import get_db
-from app.schemas import Image, ImageBase, ImageCreate
+from app.schemas import BulkUploadResult, Image, ImageBase, ImageCreate, ImageFull, Page, TileInfo
+from app.core.archive import extract_images, remove
+from app.core import crops, http_cache, imaging, storage, thumbnails, tiles
+from app.core.common import stored_image
+from app.core.pagination import PageLimit, after_id, paginate
 from app.routes.exception import *
-from app.settings import image_domain
+from app.settings import image_domain, import_workers, tile_pregenerate
 
 image_router = APIRouter(prefix="/image", tags=["image"])
 
+# a page of GET /image/
+SpriteIds = Annotated[list[int], Query(min_length=1, max_length=1000)]
+# context around a crop region, pixels
+CropPad = Annotated[int, Query(ge=0, le=1024)]
+
 @image_router.get("/")
-async def get_images(skip:int=0, limit:int=100, species_id:int|None=None, db:Session=Depends(get_db)) -> list[Image]:
-    return crud.get_images(db=db, skip=skip,limit=limit,species_id=species_id)
+async def get_images(cursor:str|None=None, limit:PageLimit=100, species_id:int|None=None, db:AsyncSession=Depends(get_db)) -> Page[Image]:
+    images = await crud.get_images(db=db, after_id=after_id(cursor),limit=limit+1,species_id=species_id, options=crud.image_options)
+    return paginate(images, limit)
+
+@image_router.get("/sprite")
+async def get_image_sprite(ids:SpriteIds, columns:Annotated[int, Query(ge=1, le=100)]=10, db:AsyncSession=Depends(get_db)) -> Response:
+    # thumbnails of a page of images in one jpeg: cell i is at column i % columns, row i // columns,
+    # cells are THUMBNAIL_SIZE (X-Sprite-Cell) squares with the thumbnail centered
+    images = await crud.get_images_by_ids(db=db, ids=ids)
+    if len(images) != len(set(ids)):
+        raise ImageNotFoundException
+    paths = await thumbnails.ensure([images[i] for i in ids])
+    content = await asyncio.to_thread(imaging.sprite, paths, columns)
+    return Response(content=content, media_type="image/jpeg", headers={"X-Sprite-Columns": str(columns), "X-Sprite-Cell": str(imaging.THUMBNAIL_SIZE)})
 
 @image_router.get("/{id:int}")
-async def get_image(id:int, db:Session=Depends(get_db)) -> Image:
-    image = crud.get_image_by_id(db=db,id=id)
+async def get_image(id:int, db:AsyncSession=Depends(get_db)) -> ImageFull:
+    image = await crud.get_image_by_id(db=db,id=id, options=crud.image_full_options)
     if not image:
         raise ImageNotFoundException
     return image
 
 @image_router.get("/{id:int}/download")
-async def download_image(id:int, db:Session=Depends(get_db)) -> FileResponse:
-    image = crud.get_image_by_id(db=db,id=id)
+async def download_image(id:int, request:Request, db:AsyncSession=Depends(get_db)) -> Response:
+    # conditional and range requests are answered, see core/http_cache.py
+    image = await crud.get_image_by_id(db=db,id=id)
+    if not image:
+        raise ImageNotFoundException
+    cache_control = http_cache.IMMUTABLE if storage.is_content_addressed(image.path, image.sha256) else http_cache.REVALIDATE
+    return http_cache.file_response(request, image_domain + image.path, sha256=image.sha256, cache_control=cache_control, headers={"filename": image.path.split('/')[-1]})
+
+@image_router.get("/{id:int}/crop")
+async def get_image_crop(id:int, x0:float, y0:float, x1:float, y1:float, pad:CropPad=0, db:AsyncSession=Depends(get_db)) -> Response:
+    # jpeg of the region (x0, y0)-(x1, y1) grown by pad pixels on every side, cut to the image
+    if x0 > x1 or y0 > y1:
+        raise InvalidRegionException
+    image = await crud.get_image_by_id(db=db,id=id)
+    if not image:
+        raise ImageNotFoundException
+    with stored_image():
+        content = await crops.crop(image, x0, y0, x1, y1, pad)
+    if content is None:
+        raise CropOutOfImageException
+    return Response(content=content, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+@image_router.get("/{id:int}/tiles")
+async def get_image_tiles(id:int, db:AsyncSession=Depends(get_db)) -> TileInfo:
+    image = await crud.get_image_by_id(db=db,id=id)
     if not image:
         raise ImageNotFoundException
-    return FileResponse(path=image_domain + image.path, headers={"filename": image.path.split('/')[-1]})
+    with stored_image():
+        return await asyncio.to_thread(tiles.info, image)
+
+@image_router.get("/{id:int}/tiles/{level:int}/{x:int}_{y:int}")
+async def get_image_tile(id:int, level:int, x:int, y:int, request:Request, db:AsyncSession=Depends(get_db)) -> Response:
+    # jpeg tile of the image pyramid, cut on first request (see core/tiles.py)
+    image = await crud.get_image_by_id(db=db,id=id)
+    if not image:
+        raise ImageNotFoundException
+    with stored_image():
+        path = await tiles.tile(image, level, x, y)
+    if not path:
+        raise TileNotFoundException
+    # tiles of an image never change
+    return http_cache.file_response(request, path, cache_control="public, max-age=86400", media_type="image/jpeg")
 
 @image_router.post("/")
 async def upload_image(
     image_file: UploadFile = File(...),
     image_data: ImageCreate = Depends(),
-    db:Session=Depends(get_db)
+    db:AsyncSession=Depends(get_db)
 ) -> Image:
     # first of all we need to take an image and place it somewhere 
     # (in our domain, like c:/data/images/ - it's our constant path (domain)
@@ -43,36 +101,108 @@ async def upload_image(
     # and create entity like below
     # id = 1, path = "/gallus/u1opsad.jpg", species_id = 1, uploaded_user_id = 1, uploaded_at="sometime"
     
-    species = crud.get_species_by_id(db=db,id=image_data.species_id)
+    species = await crud.get_species_by_id(db=db,id=image_data.species_id)
     if not species:
         raise SpeciesNotFoundException
     
-    user = crud.get_user_by_id(db=db,user_id=image_data.uploaded_user_id)
+    user = await crud.get_user_by_id(db=db,user_id=image_data.uploaded_user_id)
     if not user:
         raise UserNotFoundException
 
-    # store images like /species/image_uuid.jpg
+    # store images like /species/<sha256>.jpg
     image_path_without_domain = '/' + species.name + '/'
     image_path_with_domain = image_domain + image_path_without_domain
 
-    # check species folder exist
-    if not os.path.exists(image_path_with_domain):
-        os.mkdir(image_path_with_domain)
-    
-    # generate out_file_path
-    out_file_path = str(uuid.uuid4())+'.'+image_file.filename.split('.')[-1]
-    while os.path.exists(image_path_with_domain+'/'+out_file_path):
-        out_file_path = str(uuid.uuid4())+'.'+image_file.filename.split('.')[-1]
-
-    # check that file is image
-    async with aiofiles.open(image_path_with_domain+'/'+out_file_path, 'wb') as fout:
-        while content := await image_file.read(1024): # async read chunk
-            await fout.write(content) # async write chunk
-    
-    image = crud.create_image(db=db,image=ImageBase(**image_data.model_dump(), path=image_path_without_domain+'/'+out_file_path))
+    await asyncio.to_thread(os.makedirs, image_path_with_domain, exist_ok=True)
+    sha256 = await storage.save_upload(image_file, image_path_with_domain)
+    path = image_path_without_domain + '/' + storage.content_name(sha256, image_file.filename)
+
+    # the same content was uploaded before: that image instead of a second one
+    image = await crud.get_image_by_sha256(db=db, sha256=sha256, options=crud.image_options)
+    if not image:
+        try:
+            # header only, off the event loop
+            metadata = await asyncio.to_thread(imaging.read_metadata, image_domain + path)
+            if metadata is None:
+                # nothing could be shown or annotated on it
+                raise NotAnImageException
+            image = await crud.create_image(db=db,image=ImageBase(**image_data.model_dump(), **metadata, path=path, sha256=sha256))
+        except IntegrityError:
+            # a concurrent upload of the same content got there first
+            await db.rollback()
+            image = await crud.get_image_by_sha256(db=db, sha256=sha256, options=crud.image_options)
+        except imaging.ImageTooLargeError:
+            await storage.discard(image_domain + path)
+            raise ImageTooLargeException
+        except BaseException:
+            # not an image or not registered, the file is not kept
+            await storage.discard(image_domain + path)
+            raise
+    if image.path != path:
+        # stored under another name (another species or before hashing), keep one copy
+        await storage.discard(image_domain + path)
+    else:
+        thumbnails.schedule([image])
+        if tile_pregenerate:
+            tiles.pregenerate(image)
     return image
 
+@image_router.post("/bulk")
+async def upload_images(
+    archive: UploadFile = File(...),
+    image_data: ImageCreate = Depends(),
+    db:AsyncSession=Depends(get_db)
+) -> list[BulkUploadResult]:
+    # zip or tar (any compression) of images of one species from one uploader,
+    # files are stored like upload_image does and registered with one INSERT,
+    # files with the content of an existing image get its id and detail "duplicate"
+    species = await crud.get_species_by_id(db=db,id=image_data.species_id)
+    if not species:
+        raise SpeciesNotFoundException
+
+    user = await crud.get_user_by_id(db=db,user_id=image_data.uploaded_user_id)
+    if not user:
+        raise UserNotFoundException
+
+    image_path_without_domain = '/' + species.name + '/'
+    image_path_with_domain = image_domain + image_path_without_domain
+    await asyncio.to_thread(os.makedirs, image_path_with_domain, exist_ok=True)
+
+    try:
+        results = await asyncio.to_thread(extract_images, archive.file, image_path_with_domain, import_workers)
+    except ValueError:
+        raise InvalidArchiveException
+
+    stored = [i for i in results if "file_name" in i]
+    existing = await crud.get_images_by_sha256(db=db, hashes=[i["sha256"] for i in stored])
+    new = {}
+    for result in stored:
+        if result["sha256"] not in existing:
+            # first of the same content in the archive
+            new.setdefault(result["sha256"], result)
+    try:
+        images = await crud.create_images(db=db, images=[
+            ImageBase(**image_data.model_dump(), **(i["metadata"] or {}), path=image_path_without_domain + '/' + i["file_name"], sha256=i["sha256"]) for i in new.values()
+        ])
+    except BaseException:
+        await asyncio.to_thread(remove, image_path_with_domain, list(new.values()))
+        raise
+    existing.update((i.sha256, i) for i in images)
+    if images:
+        thumbnails.schedule(images)
+    if tile_pregenerate:
+        for image in images:
+            tiles.pregenerate(image)
+    for result in stored:
+        image = existing[result["sha256"]]
+        result["image_id"] = image.id
+        if new.get(result["sha256"]) is not result:
+            result["detail"] = "duplicate"
+            if image.path != image_path_without_domain + '/' + result["file_name"]:
+                await asyncio.to_thread(remove, image_path_with_domain, [result])
+    return [BulkUploadResult(name=i["name"], image_id=i.get("image_id"), detail=i.get("detail")) for i in results]
+
 @image_router.put("/{id:int}")
-async def change_image_species(id: int, new_species:str, db:Session=Depends(get_db)) -> Image:
+async def change_image_species(id: int, new_species:str, db:AsyncSession=Depends(get_db)) -> Image:
     #TODO
     pass
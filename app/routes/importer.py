@@ -0,0 +1,35 @@
+import asyncio
+from fastapi import APIRouter, Depends, File, Query, UploadFile
+from sqlalchemy.ext.asyncio import AsyncSession
+import app.crud as crud
+from app.core import importer
+from app.core.database import get_db, TaskType
+from app.routes.exception import *
+from app.schemas import SPECIES_NAME_PATTERN, ImportResult
+
+# Bulk dataset import (see core/importer.py), python -m app.core.importer does the same from a local directory or archive
+import_router = APIRouter(prefix="/import", tags=["import"])
+
+@import_router.post("/coco")
+async def import_coco(
+    uploaded_user_id:int,
+    coco_file:UploadFile=File(...),
+    images_archive:UploadFile=File(...),
+    species:str|None=Query(default=None, pattern=SPECIES_NAME_PATTERN),
+    empty_task_type:TaskType|None=None,
+    db:AsyncSession=Depends(get_db)
+) -> ImportResult:
+    # posting the same dataset again resumes an interrupted import, imported images are skipped
+    user = await crud.get_user_by_id(db=db, user_id=uploaded_user_id)
+    if not user:
+        raise UserNotFoundException
+    try:
+        dataset = importer.parse_coco(await coco_file.read())
+        # uploads over 1MB are spooled to a temporary file, archives are read from it in place
+        source = await asyncio.to_thread(importer.open_source, images_archive.file)
+    except ValueError:
+        raise InvalidDatasetException
+    try:
+        return await importer.import_coco(dataset, source, uploaded_user_id, species=species, empty_task_type=empty_task_type)
+    finally:
+        source.close()
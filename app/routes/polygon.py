@@ -1,73 +1,116 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Body, Depends, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
 from app.core.database import get_db
-from app.core.common import check_task, check_user
-from app.schemas import PolyAnnotationBase
+from app.core.common import check_annotations, check_user, check_write
+from app.schemas import PolyAnnotation, PolyAnnotationBase, PolyAnnotationData, PolyAnnotationUpdate, Page
+from app.core.pagination import PageLimit, after_id, paginate
 from app.routes.exception import *
 
-# TODO update many, Delete many
-
 poly_router = APIRouter(prefix="/polygon", tags=["polygon"])
 
 @poly_router.get("/")
 async def get_polygons(
-    skip=0,
-    limit=100,
+    cursor:str|None=None,
+    limit:PageLimit=100,
     task_id:int|None=None,
-    db:Session=Depends(get_db)
-):
-    polygons = crud.get_polygons(db=db, skip=skip,limit=limit, task_id=task_id)
-    return polygons
+    db:AsyncSession=Depends(get_db)
+) -> Page[PolyAnnotation]:
+    polygons = await crud.get_polygons(db=db, after_id=after_id(cursor),limit=limit+1, task_id=task_id)
+    return paginate(polygons, limit)
+
+@poly_router.get("/region")
+async def get_polygons_in_region(
+    image_id:int,
+    x_min:float,
+    y_min:float,
+    x_max:float,
+    y_max:float,
+    cursor:str|None=None,
+    limit:PageLimit=100,
+    db:AsyncSession=Depends(get_db)
+) -> Page[PolyAnnotation]:
+    # polygons of the image whose bounds intersect the region
+    if x_min > x_max or y_min > y_max:
+        raise InvalidRegionException
+    polygons = await crud.get_polygons_in_region(db=db, image_id=image_id, x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max, after_id=after_id(cursor), limit=limit+1)
+    return paginate(polygons, limit)
+
+@poly_router.get("/{polygon_id:int}/overlapping")
+async def get_overlapping_polygons(polygon_id:int, cursor:str|None=None, limit:PageLimit=100, db:AsyncSession=Depends(get_db)) -> Page[PolyAnnotation]:
+    # other polygons of the same image whose bounds intersect the bounds of this one
+    polygon = await crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
+    if not polygon:
+        raise PolygonNotFoundException
+    task = await crud.get_task_by_id(db=db, id=polygon.task_id)
+    polygons = await crud.get_polygons_in_region(
+        db=db, image_id=task.image_id,
+        x_min=polygon.x_min, y_min=polygon.y_min, x_max=polygon.x_max, y_max=polygon.y_max,
+        after_id=after_id(cursor), limit=limit+1, exclude_id=polygon.id
+    )
+    return paginate(polygons, limit)
 
 @poly_router.get("/{polygon_id:int}")
-async def get_polygon(polygon_id:int, db:Session=Depends(get_db)):
-    polygon = crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
+async def get_polygon(polygon_id:int, db:AsyncSession=Depends(get_db)) -> PolyAnnotation:
+    polygon = await crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
     if not polygon:
         raise PolygonNotFoundException
     return polygon
 
+@poly_router.get("/{polygon_id:int}/vertices")
+async def get_polygon_vertices(polygon_id:int, db:AsyncSession=Depends(get_db)) -> Response:
+    # stored buffer as is: vertex_count little-endian float32 (x, y) pairs
+    polygon = await crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
+    if not polygon:
+        raise PolygonNotFoundException
+    return Response(
+        content=polygon.vertices,
+        media_type="application/octet-stream",
+        headers={"X-Vertex-Count": str(polygon.vertex_count)}
+    )
+
 @poly_router.post("/create")
-async def create_polygon(user_id:int, new_polygon:PolyAnnotationBase, db:Session=Depends(get_db)):
-    user = check_user(db=db, user_id=user_id)
-    task = check_task(db=db,user_id=user.id, task_id=new_polygon.task_id, type="poly")
+async def create_polygon(user_id:int, new_polygon:PolyAnnotationBase, db:AsyncSession=Depends(get_db)) -> PolyAnnotation:
+    await check_write(db=db, user_id=user_id, task_ids=[new_polygon.task_id], type="poly", annotations=[new_polygon])
 
-    polygon = crud.create_polygon(db=db, new_polygon=new_polygon)
+    polygon = await crud.create_polygon(db=db, new_polygon=new_polygon)
     return polygon
 
 @poly_router.post("/createmany")
-async def create_polygons(user_id:int, new_polygons:list[PolyAnnotationBase], db:Session=Depends(get_db)):
+async def create_polygons(user_id:int, new_polygons:list[PolyAnnotationBase], db:AsyncSession=Depends(get_db)) -> list[PolyAnnotation]:
     # add all or nothing
-    user = check_user(db=db,user_id=user_id)
-    tasks_id = set([i.task_id for i in new_polygons])
-    for task_id in tasks_id:
-        task = check_task(db=db,user_id=user.id, task_id=task_id, type="poly")
-    poygons = crud.create_polygons(db=db, new_polygons=new_polygons)
+    await check_write(db=db, user_id=user_id, task_ids=[i.task_id for i in new_polygons], type="poly", annotations=new_polygons)
+    poygons = await crud.create_polygons(db=db, new_polygons=new_polygons)
     return poygons
 
 @poly_router.put("/update/{polygon_id:int}")
-async def update_polygon(polygon_id:int, user_id:int, new_polygon:str, db:Session=Depends(get_db)):
-    user = check_user(db=db, user_id=user_id)
-    # TODO check task is opened
-    polygon = crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
-    if not polygon:
-        raise PolygonNotFoundException
-
-    polygon = crud.update_polygon_by_id(db=db, polygon_id=polygon_id, new_polygon=new_polygon)
+async def update_polygon(polygon_id:int, user_id:int, new_polygon:PolyAnnotationData, db:AsyncSession=Depends(get_db)) -> PolyAnnotation:
+    await check_annotations(db=db, user_id=user_id, ids=[polygon_id], type="poly", updates=[PolyAnnotationUpdate(id=polygon_id, **new_polygon.model_dump())])
+    polygon = await crud.update_polygon_by_id(db=db, polygon_id=polygon_id, new_polygon=new_polygon)
     return polygon
 
-# @poly_router.put("/updatemany/")
-# async def update_polygons(polygons_id:list[int], user_id:int, new_polygons:list[str], db:Session=Depends(get_db)):
-#     pass
+@poly_router.put("/updatemany")
+async def update_polygons(user_id:int, new_polygons:list[PolyAnnotationUpdate], db:AsyncSession=Depends(get_db)) -> list[PolyAnnotation]:
+    # update all or nothing
+    await check_annotations(db=db, user_id=user_id, ids=[i.id for i in new_polygons], type="poly", updates=new_polygons)
+    polygons = await crud.update_polygons(db=db, new_polygons=new_polygons)
+    return polygons
 
 @poly_router.delete("/delete/{polygon_id:int}")
-async def delete_bbox(polygon_id:int, user_id:int, db:Session=Depends(get_db)):
+async def delete_bbox(polygon_id:int, user_id:int, db:AsyncSession=Depends(get_db)):
     # TODO check task is opened
-    polygon = crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
+    polygon = await crud.get_polygon_by_id(db=db, polygon_id=polygon_id)
     if not polygon:
         raise PolygonNotFoundException
-    user = check_user(db=db,user_id=user_id)
+    user = await check_user(db=db,user_id=user_id)
+
+    polygon = await crud.delete_polygon_by_id(db=db,polygon_id=polygon_id)
+    return polygon
 
-    polygon = crud.delete_polygon_by_id(db=db,polygon_id=polygon_id)
-    return polygon
\ No newline at end of file
+@poly_router.delete("/deletemany")
+async def delete_polygons(user_id:int, polygons_id:list[int]=Body(), db:AsyncSession=Depends(get_db)) -> list[int]:
+    # delete all or nothing
+    await check_annotations(db=db, user_id=user_id, ids=polygons_id, type="poly")
+    polygons_id = await crud.delete_polygons(db=db, polygons_id=polygons_id)
+    return polygons_id
\ No newline at end of file
@@ -1,34 +1,36 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import app.crud as crud
 from app.core.database import get_db
-from app.schemas import SpeciesCreate, Species
+from app.schemas import SpeciesCreate, Species, Page
+from app.core.pagination import PageLimit, after_id, paginate
 from app.routes.exception import *
 
 
 species_router = APIRouter(prefix="/species", tags=["species"])
 
 @species_router.get("/")
-async def get_species(skip:int=0, limit:int=100, db:Session=Depends(get_db)) -> list[Species]:
-    return crud.get_species(db=db,skip=skip,limit=limit)
+async def get_species(cursor:str|None=None, limit:PageLimit=100, db:AsyncSession=Depends(get_db)) -> Page[Species]:
+    species = await crud.get_species(db=db,after_id=after_id(cursor),limit=limit+1)
+    return paginate(species, limit)
 
 
 @species_router.get("/{id:int}")
-async def get_species_by_id(id:int, db:Session=Depends(get_db)) -> Species:
-    species = crud.get_species_by_id(db=db,id=id)
+async def get_species_by_id(id:int, db:AsyncSession=Depends(get_db)) -> Species:
+    species = await crud.get_species_by_id(db=db,id=id)
     if not species:
         raise SpeciesNotFoundException
     return species
 
 @species_router.post("/")
-async def create_species(new_species: SpeciesCreate, db:Session=Depends(get_db)) -> Species:
-    species = crud.get_species_by_name(db=db, name=new_species.name)
+async def create_species(new_species: SpeciesCreate, db:AsyncSession=Depends(get_db)) -> Species:
+    species = await crud.get_species_by_name(db=db, name=new_species.name)
     if species:
         raise SpeciesNameExistedException
-    species = crud.create_species(db=db, new_species=new_species)
+    species = await crud.create_species(db=db, new_species=new_species)
     return species
     
 
 @species_router.delete("/{id:int}")
-async def delete_species(id:int, db:Session=Depends(get_db)) -> Species:
+async def delete_species(id:int, db:AsyncSession=Depends(get_db)) -> Species:
     pass
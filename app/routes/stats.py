@@ -0,0 +1,36 @@
+from datetime import date
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+import app.crud as crud
+from app.core.database import get_db, TaskType, TaskStatus
+from app.schemas import TaskCount, AnnotationCount, FinishedTaskCount
+
+# Dashboard counters, read from counter tables (see core/stats.py) instead of counting rows
+stats_router = APIRouter(prefix="/stats", tags=["stats"])
+
+@stats_router.get("/tasks")
+async def get_task_counts(
+    task_status:TaskStatus=None,
+    task_type:TaskType=None,
+    db:AsyncSession=Depends(get_db)
+) -> list[TaskCount]:
+    return await crud.get_task_counts(db=db, task_status=task_status, task_type=task_type)
+
+@stats_router.get("/annotations")
+async def get_annotation_counts(species_id:int|None=None, db:AsyncSession=Depends(get_db)) -> list[AnnotationCount]:
+    return await crud.get_annotation_counts(db=db, species_id=species_id)
+
+@stats_router.get("/finished")
+async def get_finished_task_counts(
+    user_id:int|None=None,
+    date_from:date|None=None,
+    date_to:date|None=None,
+    db:AsyncSession=Depends(get_db)
+) -> list[FinishedTaskCount]:
+    # finished tasks per user per UTC day
+    return await crud.get_finished_task_counts(db=db, user_id=user_id, date_from=date_from, date_to=date_to)
+
+@stats_router.post("/recompute")
+async def recompute_stats(db:AsyncSession=Depends(get_db)):
+    # repairs counters after writes that bypassed the api
+    await crud.recompute_stats(db=db)
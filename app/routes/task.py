@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from typing import Annotated
+from fastapi import APIRouter, Depends, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 import app.crud as crud
 from app.core.database import get_db, TaskType, TaskStatus
-from app.schemas import Task,TaskBase
+from app.core import crops
+from app.core.common import annotation_type, check_patch, stored_image
+from app.schemas import Task,TaskBase,TaskFull,Page,AnnotationPatch,AnnotationPatchResult
+from app.core.pagination import PageLimit, after_key, paginate
 from app.routes.exception import *
 
 task_router = APIRouter(prefix="/task", tags=["task"])
@@ -12,39 +16,56 @@ task_router = APIRouter(prefix="/task", tags=["task"])
 async def get_tasks(
     task_status:TaskStatus=None,
     task_type:TaskType=None,
-    skip=0,
-    limit=100,
-    db:Session=Depends(get_db)
-) -> list[Task]:
-    tasks = crud.get_tasks(task_status=task_status,task_type=task_type,skip=skip,limit=limit,db=db)
-    return tasks
+    cursor:str|None=None,
+    limit:PageLimit=100,
+    db:AsyncSession=Depends(get_db)
+) -> Page[Task]:
+    # highest priority first
+    tasks = await crud.get_tasks(task_status=task_status,task_type=task_type,after=after_key(cursor, "priority", "id"),limit=limit+1,db=db)
+    return paginate(tasks, limit, key=("priority", "id"))
 
 
 @task_router.get("/{id:int}")
 async def get_task_by_id(
     id:int,
-    db:Session=Depends(get_db)
-):
-    task = crud.get_task_by_id(db=db, id=id)
+    db:AsyncSession=Depends(get_db)
+) -> TaskFull:
+    task = await crud.get_task_by_id(db=db, id=id, options=crud.task_full_options)
     if not task:
         raise TaskNotFoundException
     return task
 
 
+@task_router.get("/{id:int}/crops")
+async def get_task_crops(
+    id:int,
+    pad:Annotated[int, Query(ge=0, le=1024)]=0,
+    db:AsyncSession=Depends(get_db)
+) -> Response:
+    # zip of <annotation id>.jpg, the bounds of every bbox or polygon of the task grown by pad, for verification
+    task = await crud.get_task_by_id(db=db, id=id, options=crud.task_full_options)
+    if not task:
+        raise TaskNotFoundException
+    annotations = task.polygons if annotation_type(task.task_type) == "poly" else task.bboxes
+    with stored_image():
+        content = await crops.crops(task.image, annotations, pad)
+    return Response(content=content, media_type="application/zip", headers={"Content-Disposition": f'attachment; filename="task-{id}-crops.zip"'})
+
+
 @task_router.post("/")
 async def create_task(
     new_task:TaskBase=Depends(),
-    db:Session=Depends(get_db)
+    db:AsyncSession=Depends(get_db)
 ):
-    user = crud.get_user_by_id(user_id=new_task.created_user_id, db=db)
+    user = await crud.get_user_by_id(user_id=new_task.created_user_id, db=db)
     if not user:
         raise UserNotFoundException
     
-    image = crud.get_image_by_id(id=new_task.image_id,db=db)
+    image = await crud.get_image_by_id(id=new_task.image_id,db=db)
     if not image:
         raise ImageNotFoundException
     
-    task = crud.create_task(db=db, new_task=new_task)
+    task = await crud.create_task(db=db, new_task=new_task)
     return task
 
 
@@ -52,13 +73,13 @@ async def create_task(
 async def accept_task(
     id:int,
     user_id:int,
-    db:Session=Depends(get_db)
+    db:AsyncSession=Depends(get_db)
 ):
-    user = crud.get_user_by_id(db=db, user_id=user_id)
+    user = await crud.get_user_by_id(db=db, user_id=user_id)
     if not user:
         raise UserNotFoundException
     
-    task = crud.get_task_by_id(db=db,id=id)
+    task = await crud.get_task_by_id(db=db,id=id)
     if not task:
         raise TaskNotFoundException
     
@@ -68,21 +89,73 @@ async def accept_task(
     if task.status.value == TaskStatus.finished.value:
         raise TaskAcceptFinishedException
 
-    task = crud.accept_task(db=db,id=id,user_id=user_id)
+    task = await crud.accept_task(db=db,id=id,user_id=user_id)
+    if not task:
+        # accepted by someone else after the check above
+        raise TaskAcceptAcceptedException
     return task
 
 
+@task_router.post("/claim")
+async def claim_task(
+    user_id:int,
+    task_type:TaskType=None,
+    species_id:int|None=None,
+    db:AsyncSession=Depends(get_db)
+) -> Task:
+    # accepts the highest priority pending task matching the filters, no need to pick an id from GET /task/
+    user = await crud.get_user_by_id(db=db, user_id=user_id)
+    if not user:
+        raise UserNotFoundException
+
+    task = await crud.claim_task(db=db, user_id=user_id, task_type=task_type, species_id=species_id)
+    if not task:
+        raise NoPendingTaskException
+    return task
+
+
+@task_router.put("/{id:int}/heartbeat")
+async def heartbeat_task(
+    id:int,
+    user_id:int,
+    db:AsyncSession=Depends(get_db)
+) -> Task:
+    # extends the lease of an accepted task, clients call it while the task is open in the editor
+    task = await crud.extend_task_lease(db=db, id=id, user_id=user_id)
+    if not task:
+        if not await crud.get_task_by_id(db=db, id=id):
+            raise TaskNotFoundException
+        raise TaskLeaseNotHeldException
+    return task
+
+
+@task_router.patch("/{id:int}/annotations")
+async def patch_annotations(
+    id:int,
+    user_id:int,
+    patch:AnnotationPatch,
+    db:AsyncSession=Depends(get_db)
+) -> AnnotationPatchResult:
+    # editor autosave: adds, updates and deletes of the task annotations, all or nothing
+    model = await check_patch(db=db, user_id=user_id, task_id=id, patch=patch)
+    result = await crud.patch_annotations(db=db, task_id=id, model=model, operations=patch.operations, revision=patch.revision)
+    if result is None:
+        raise TaskRevisionConflictException
+    revision, added = result
+    return AnnotationPatchResult(revision=revision, added=added)
+
+
 @task_router.put("/{id:int}/finish")
 async def finish_task(
     id:int,
     user_id:int,
-    db:Session=Depends(get_db)
+    db:AsyncSession=Depends(get_db)
 ):
-    user = crud.get_user_by_id(db=db, user_id=user_id)
+    user = await crud.get_user_by_id(db=db, user_id=user_id)
     if not user:
         raise UserNotFoundException
     
-    task = crud.get_task_by_id(db=db,id=id)
+    task = await crud.get_task_by_id(db=db,id=id)
     if not task:
         raise TaskNotFoundException
     
@@ -95,5 +168,5 @@ async def finish_task(
     if user.id != task.accepted_user_id:
         raise TaskFinishUserNotSame
 
-    task = crud.finish_task(db=db,id=id)
+    task = await crud.finish_task(db=db,id=id)
     return task
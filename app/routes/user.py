@@ -1,29 +1,31 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import app.crud as crud
 from app.core.database import get_db
-from app.schemas import User, UserCreate, UserFull
+from app.schemas import User, UserCreate, UserFull, Page
+from app.core.pagination import PageLimit, after_id, paginate
 from app.routes.exception import *
 
 
 user_router = APIRouter(prefix="/user", tags=["user"])
 
 @user_router.get("/")
-async def get_users(skip: int = 0, limit: int = 100, db:Session=Depends(get_db)) -> list[User]:
-    return crud.get_users(skip=skip, limit=limit, db=db)
+async def get_users(cursor: str|None = None, limit: PageLimit = 100, db:AsyncSession=Depends(get_db)) -> Page[User]:
+    users = await crud.get_users(after_id=after_id(cursor), limit=limit+1, db=db)
+    return paginate(users, limit)
 
 @user_router.get("/{id:int}")
-async def get_user_by_id(id:int, db:Session=Depends(get_db)) -> UserFull:
-    user = crud.get_user_by_id(user_id=id, db=db)
+async def get_user_by_id(id:int, db:AsyncSession=Depends(get_db)) -> UserFull:
+    user = await crud.get_user_by_id(user_id=id, db=db, options=crud.user_full_options)
     if not user:
         raise UserNotFoundException
     return UserFull.model_validate(user, from_attributes=True)
 
 @user_router.post("/")
-async def create_user(user:UserCreate, db: Session=Depends(get_db)) -> User:
-    user_email = crud.get_user_by_email(email=user.email, db=db)
-    user_username = crud.get_user_by_username(username=user.username, db=db)
+async def create_user(user:UserCreate, db: AsyncSession=Depends(get_db)) -> User:
+    user_email = await crud.get_user_by_email(email=user.email, db=db)
+    user_username = await crud.get_user_by_username(username=user.username, db=db)
     if user_email or user_username:
         raise UserExistedException
-    user = crud.create_user(new_user=user,db=db)
+    user = await crud.create_user(new_user=user,db=db)
     return user
@@ -1,11 +1,25 @@
 from __future__ import annotations
-from datetime import datetime
-from pydantic import BaseModel, ConfigDict
+from datetime import date, datetime
+from typing import Generic, Literal, TypeVar
+from pydantic import BaseModel, ConfigDict, Field, FiniteFloat, model_validator
 from app.core.database import TaskType, TaskStatus
 
 
+T = TypeVar("T")
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    # pass as cursor to get the next page, None on the last page
+    next_cursor: str|None = None
+
+
+# species names are directory names under image_domain: no separators, no leading dot
+SPECIES_NAME_PATTERN = r"^\w[\w .-]*$"
+
 class SpeciesCreate(BaseModel):
-    name: str
+    name: str = Field(pattern=SPECIES_NAME_PATTERN)
+    # default priority of tasks on images of this species
+    priority: int = 0
 
 class Species(SpeciesCreate):
     model_config = ConfigDict(from_attributes=True)
@@ -30,7 +44,7 @@ class User(UserID, UserBase):
 class UserFull(User):
     uploaded_images: list[Image] = []
     created_tasks: list[Task] = []
-    accepted_task: list[Task] = []
+    accepted_tasks: list[Task] = []
 
 
 class ImageID(BaseModel):
@@ -41,8 +55,16 @@ class ImageCreate(BaseModel):
     uploaded_user_id:int
     model_config = ConfigDict(from_attributes=True)
 
-class ImageBase(ImageCreate):
+class ImageMetadata(BaseModel):
+    # None if the file could not be read as an image
+    width:int|None = None
+    height:int|None = None
+    channels:int|None = None
+    format:str|None = None
+
+class ImageBase(ImageCreate, ImageMetadata):
     path:str
+    sha256:str|None = None
 
 class Image(ImageID, ImageBase):
     species: Species
@@ -50,8 +72,24 @@ class Image(ImageID, ImageBase):
     uploaded_user: User
     uploaded_at: datetime
 
+class ImageFull(Image):
     tasks: list[Task] = []
 
+class TileInfo(BaseModel):
+    # DeepZoom descriptor, tiles are /image/{id}/tiles/{level}/{x}_{y} for level 0..max_level
+    width: int
+    height: int
+    tile_size: int
+    overlap: int
+    format: str
+    max_level: int
+
+class BulkUploadResult(BaseModel):
+    # one per file in the archive, image_id if it was stored, detail why not otherwise
+    name: str
+    image_id: int|None = None
+    detail: str|None = None
+
 
 class TaskID(BaseModel):
     id: int
@@ -60,22 +98,30 @@ class TaskBase(BaseModel):
     created_user_id: int
     task_type: TaskType
     image_id: int
+    # higher is dispatched first, defaults to the priority of the image species
+    priority: int|None = None
     model_config = ConfigDict(from_attributes=True)
 
 class Task(TaskID,TaskBase):
-    image:Image
-
     status: TaskStatus
+    priority: int
 
-    created_user: User
     created_at: datetime
     
     accepted_user_id:int|None = None
-    accepted_user: User|None = None
     accepted_at: datetime|None = None
+    expires_at: datetime|None = None
 
     finished_at: datetime|None = None
 
+    revision: int = 0
+
+class TaskFull(Task):
+    image:Image
+
+    created_user: User
+    accepted_user: User|None = None
+
     bboxes: list[BboxAnnotation] = []
     polygons: list[PolyAnnotation] = []
 
@@ -83,23 +129,135 @@ class Task(TaskID,TaskBase):
 class BboxAnnotationID(BaseModel):
     id:int
 
-class BboxAnnotationBase(BaseModel):
-    bbox:str
+class BboxAnnotationData(BaseModel):
+    # no NaN or infinity, they pass every comparison check and break the spatial index
+    x_min: FiniteFloat
+    y_min: FiniteFloat
+    x_max: FiniteFloat
+    y_max: FiniteFloat
+    label: str|None = None
+    score: float|None = Field(default=None, ge=0, le=1)
+
+    @model_validator(mode="after")
+    def check_corners(self):
+        if self.x_min >= self.x_max or self.y_min >= self.y_max:
+            raise ValueError("bbox (x_min, y_min) must be less than (x_max, y_max)")
+        return self
+
+class BboxAnnotationBase(BboxAnnotationData):
     task_id: int
 
+class BboxAnnotationUpdate(BboxAnnotationID, BboxAnnotationData):
+    pass
+
 class BboxAnnotation(BboxAnnotationID, BboxAnnotationBase):
     model_config = ConfigDict(from_attributes=True)
 
 class PolyAnnotationID(BaseModel):
     id:int
 
-class PolyAnnotationBase(BaseModel):
-    polygon:str
+class PolyAnnotationData(BaseModel):
+    # [[x, y], ...], stored as float32
+    points: list[tuple[FiniteFloat, FiniteFloat]] = Field(min_length=3)
+
+class PolyAnnotationBase(PolyAnnotationData):
     task_id: int
 
-class PolyAnnotationUpdate(PolyAnnotationID):
-    polygon:str
+class PolyAnnotationUpdate(PolyAnnotationID, PolyAnnotationData):
+    pass
 
 class PolyAnnotation(PolyAnnotationID, PolyAnnotationBase):
-    task: Task
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    vertex_count: int
+    x_min: float
+    y_min: float
+    x_max: float
+    y_max: float
+    model_config = ConfigDict(from_attributes=True)
+
+class AnnotationOperation(BaseModel):
+    # {"op": "add", "bbox": {...}}, {"op": "update", "id": 1, "bbox": {...}}, {"op": "delete", "id": 1},
+    # polygons with "polygon": {"points": [...]} instead of "bbox"
+    op: Literal["add", "update", "delete"]
+    id: int|None = None
+    bbox: BboxAnnotationData|None = None
+    polygon: PolyAnnotationData|None = None
+
+    @model_validator(mode="after")
+    def check_fields(self):
+        if (self.id is None) != (self.op == "add"):
+            raise ValueError("update and delete need an id, add must not have one")
+        if self.op == "delete":
+            if self.bbox is not None or self.polygon is not None:
+                raise ValueError("delete takes only an id")
+        elif (self.bbox is None) == (self.polygon is None):
+            raise ValueError(f"{self.op} takes either a bbox or a polygon")
+        return self
+
+    @property
+    def type(self) -> Literal["bbox", "poly"]|None:
+        if self.bbox is not None:
+            return "bbox"
+        if self.polygon is not None:
+            return "poly"
+        return None
+
+class AnnotationPatch(BaseModel):
+    # task revision the edits are based on, the patch is rejected if the task has moved on since
+    revision: int|None = None
+    # applied in order
+    operations: list[AnnotationOperation]
+
+    @model_validator(mode="after")
+    def check_type(self):
+        if len({i.type for i in self.operations} - {None}) > 1:
+            raise ValueError("a patch cannot mix bboxes and polygons")
+        return self
+
+    @property
+    def type(self) -> Literal["bbox", "poly"]|None:
+        # None for deletes only
+        return next((i.type for i in self.operations if i.type), None)
+
+class AnnotationPatchResult(BaseModel):
+    revision: int
+    # ids of added annotations in operation order
+    added: list[int]
+
+
+# Stats
+class TaskCount(BaseModel):
+    status: TaskStatus
+    task_type: TaskType
+    count: int
+    model_config = ConfigDict(from_attributes=True)
+
+class AnnotationCount(BaseModel):
+    species_id: int
+    kind: Literal["bbox", "poly"]
+    count: int
+    model_config = ConfigDict(from_attributes=True)
+
+class FinishedTaskCount(BaseModel):
+    user_id: int
+    day: date
+    count: int
+    model_config = ConfigDict(from_attributes=True)
+
+
+# Import
+class ImportResult(BaseModel):
+    # images imported by this run, already stored under their species (e.g. by an earlier run), without a file
+    # in the source, without a species (no annotations and no species given), with the content of an image
+    # stored under another species or name or of an earlier image of the dataset,
+    # over the pixel limit (IMAGE_MAX_PIXELS)
+    images: int = 0
+    skipped: int = 0
+    missing: int = 0
+    unassigned: int = 0
+    duplicates: int = 0
+    too_large: int = 0
+    tasks: int = 0
+    bboxes: int = 0
+    polygons: int = 0
+    # annotations that are neither a valid bbox nor a polygon, e.g. RLE masks
+    invalid: int = 0
@@ -1,5 +1,6 @@
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.tests.utils.image import create_test_image
 from app.tests.utils.species import create_test_species
 from app.tests.utils.user import create_test_user
@@ -7,12 +8,16 @@ from app.tests.utils.task import create_test_task
 from app.core.database import TaskType, TaskStatus
 from app.settings import image_domain
 from app.routes.exception import *
+from app import crud
+from app.schemas import ImageBase, TaskBase
 
-def test_valid_create_bbox(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+pytestmark = pytest.mark.anyio
+
+async def test_valid_create_bbox(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -22,11 +27,11 @@ def test_valid_create_bbox(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -35,17 +40,17 @@ def test_valid_create_bbox(client:TestClient, db:Session):
     )
     assert response.status_code == 200
     assert response.json()["task_id"] == task.id
-    assert response.json()["bbox"] == bbox["bbox"]
+    assert {k:response.json()[k] for k in bbox} == bbox
     resp_bbox = response.json()
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["bboxes"] == [resp_bbox]
 
-def test_invalid_create_bbox_bad_user(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_create_bbox_bad_user(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -55,11 +60,11 @@ def test_invalid_create_bbox_bad_user(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":-1,
@@ -69,11 +74,11 @@ def test_invalid_create_bbox_bad_user(client:TestClient, db:Session):
     assert response.status_code == 404
     assert response.json()["detail"] == UserNotFoundException.detail
 
-def test_invalid_create_bbox_not_same_user(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_create_bbox_not_same_user(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
-    user2 = create_test_user(db=db)
-    response = client.put(
+    user2 = await create_test_user(db=db)
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id
@@ -83,11 +88,11 @@ def test_invalid_create_bbox_not_same_user(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user2.id,
@@ -97,14 +102,14 @@ def test_invalid_create_bbox_not_same_user(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationFromNotAcceptedUser.detail
 
-def test_invalid_create_bbox_bad_task(client:TestClient, db:Session):
-    user = create_test_user(db=db)
+async def test_invalid_create_bbox_bad_task(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": -1
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -114,15 +119,15 @@ def test_invalid_create_bbox_bad_task(client:TestClient, db:Session):
     assert response.status_code == 404
     assert response.json()["detail"] == TaskNotFoundException.detail
 
-def test_invalid_create_bbox_pending_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_create_bbox_pending_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -132,17 +137,17 @@ def test_invalid_create_bbox_pending_task(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationToPendingTaskException.detail
 
-def test_invalid_create_bbox_finished_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_create_bbox_finished_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user.id
@@ -150,11 +155,11 @@ def test_invalid_create_bbox_finished_task(client:TestClient, db:Session):
     )
 
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -164,11 +169,11 @@ def test_invalid_create_bbox_finished_task(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationToFinishedTaskException.detail
 
-def test_invalid_create_bbox_bad_bbox(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_create_bbox_bad_bbox(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -179,7 +184,7 @@ def test_invalid_create_bbox_bad_bbox(client:TestClient, db:Session):
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -188,22 +193,56 @@ def test_invalid_create_bbox_bad_bbox(client:TestClient, db:Session):
     )
     assert response.status_code == 422
 
-def test_invalid_create_bbox_bad_task_type(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_bbox_bad_corners(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    user = task.created_user
+
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    bbox = {
+        "x_min":2, "y_min":1, "x_max":1, "y_max":2,
+        "task_id": task.id
+    }
+
+    response = await client.post(
+        "/bbox/create",
+        params={
+            "user_id":user.id,
+        },
+        json = bbox
+    )
+    assert response.status_code == 422
+
+    # NaN passes the corner check
+    for value in ["NaN", "Infinity"]:
+        response = await client.post(
+            "/bbox/create",
+            params={"user_id":user.id},
+            headers={"content-type": "application/json"},
+            content='{"x_min":%s, "y_min":1, "x_max":2, "y_max":2, "task_id":%d}' % (value, task.id)
+        )
+        assert response.status_code == 422
+
+async def test_invalid_create_bbox_bad_task_type(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -213,22 +252,22 @@ def test_invalid_create_bbox_bad_task_type(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddBboxToPolygonTaskTypeException.detail
 
-def test_valid_update_bbox(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+async def test_valid_update_bbox(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
     # add bbox to task
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -240,36 +279,36 @@ def test_valid_update_bbox(client:TestClient, db:Session):
     bbox = response.json()
 
     # update bbox
-    response = client.put(
+    response = await client.put(
         f"/bbox/update/{bbox["id"]}",
         params={
             "user_id":user.id,
-            "new_bbox":"(3,3),(10,10)"
-        }
+        },
+        json={"x_min":3, "y_min":3, "x_max":10, "y_max":10, "label":"cell"}
     )
     assert response.status_code == 200
-    assert response.json() == {"id":bbox["id"],"bbox":"(3,3),(10,10)","task_id":bbox["task_id"]}
+    assert response.json() == {"id":bbox["id"],"x_min":3,"y_min":3,"x_max":10,"y_max":10,"label":"cell","score":None,"task_id":bbox["task_id"]}
 
-def test_valid_create_many_bboxes(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+async def test_valid_create_many_bboxes(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     bbox1 = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
     bbox2 = {
-        "bbox":"(3,3),(4,4)",
+        "x_min":3, "y_min":3, "x_max":4, "y_max":4,
         "task_id": task.id
     }
     # add bbox to task
-    response = client.post(
+    response = await client.post(
         "/bbox/createmany",
         params={
             "user_id":user.id,
@@ -280,42 +319,40 @@ def test_valid_create_many_bboxes(client:TestClient, db:Session):
             ]
     )
     assert response.status_code == 200
-    assert response.json()[0]['bbox'] == bbox1['bbox']
-    assert response.json()[0]['task_id'] == bbox1['task_id']
+    assert {k:response.json()[0][k] for k in bbox1} == bbox1
     assert response.json()[0]['id'] == 1
     
-    assert response.json()[1]['bbox'] == bbox2['bbox']
-    assert response.json()[1]['task_id'] == bbox2['task_id']
+    assert {k:response.json()[1][k] for k in bbox2} == bbox2
     assert response.json()[1]['id'] == 2
 
     bbox1["id"]=response.json()[0]['id']
     bbox2["id"]=response.json()[1]['id']
 
     # check task
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.status_code == 200
-    assert response.json()['bboxes'] == [bbox1,bbox2]
+    assert [{k:i[k] for k in bbox1} for i in response.json()['bboxes']] == [bbox1,bbox2]
 
-def test_invalid_create_many_bboxes_bad_task_id(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+async def test_invalid_create_many_bboxes_bad_task_id(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     bbox1 = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
     bbox2 = {
-        "bbox":"(3,3),(4,4)",
+        "x_min":3, "y_min":3, "x_max":4, "y_max":4,
         "task_id": -1
     }
     # add bbox to task
-    response = client.post(
+    response = await client.post(
         "/bbox/createmany",
         params={
             "user_id":user.id,
@@ -328,11 +365,11 @@ def test_invalid_create_many_bboxes_bad_task_id(client:TestClient, db:Session):
     assert response.status_code == 404
     assert response.json()["detail"] == TaskNotFoundException.detail
 
-def test_valid_delete_bbox(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_valid_delete_bbox(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -342,11 +379,11 @@ def test_valid_delete_bbox(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     bbox = {
-        "bbox":"(1,1),(2,2)",
+        "x_min":1, "y_min":1, "x_max":2, "y_max":2,
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/bbox/create",
         params={
             "user_id":user.id,
@@ -355,13 +392,13 @@ def test_valid_delete_bbox(client:TestClient, db:Session):
     )
     assert response.status_code == 200
     assert response.json()["task_id"] == task.id
-    assert response.json()["bbox"] == bbox["bbox"]
+    assert {k:response.json()[k] for k in bbox} == bbox
     resp_bbox = response.json()
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["bboxes"] == [resp_bbox]
 
-    response = client.delete(
+    response = await client.delete(
         f"/bbox/delete/{resp_bbox["id"]}",
         params={
             "user_id": user.id
@@ -370,13 +407,293 @@ def test_valid_delete_bbox(client:TestClient, db:Session):
     assert response.status_code == 200
     assert response.json() == resp_bbox["id"]
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["bboxes"] == []
 
 
+async def test_valid_get_bboxes_pagination(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    response = await client.post(
+        "/bbox/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(3)]
+    )
+    assert response.status_code == 200
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.get("/bbox/", params={"task_id": task.id, "limit": 2})
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == ids[:2]
+    next_cursor = response.json()["next_cursor"]
+    assert next_cursor is not None
+
+    response = await client.get("/bbox/", params={"task_id": task.id, "limit": 2, "cursor": next_cursor})
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == ids[2:]
+    assert response.json()["next_cursor"] is None
+
+async def test_valid_create_many_bboxes_bulk_insert(client:AsyncClient, db:AsyncSession):
+    from sqlalchemy import event
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.bind.sync_engine, "before_cursor_execute", capture)
+    try:
+        response = await client.post(
+            "/bbox/createmany",
+            params={
+                "user_id":user.id,
+            },
+            json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(2500)]
+        )
+    finally:
+        event.remove(db.bind.sync_engine, "before_cursor_execute", capture)
+    assert response.status_code == 200
+    assert [i["x_min"] for i in response.json()] == list(range(2500))
+    assert len({i["id"] for i in response.json()}) == 2500
+    # no SELECT per created row
+    assert len(statements) < 10
+
+async def test_valid_create_many_bboxes_checks_in_one_query(client:AsyncClient, db:AsyncSession):
+    from sqlalchemy import event
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    tasks = [task] + [
+        await crud.create_task(db=db, new_task=TaskBase(created_user_id=user.id, task_type=TaskType.bbox_annotation.value, image_id=task.image_id))
+        for _ in range(4)
+    ]
+    for t in tasks:
+        response = await client.put(f"/task/{t.id}/accept", params={"user_id":user.id})
+
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.bind.sync_engine, "before_cursor_execute", capture)
+    try:
+        response = await client.post(
+            "/bbox/createmany",
+            params={
+                "user_id":user.id,
+            },
+            json = [{"x_min":0, "y_min":0, "x_max":1, "y_max":1, "task_id": t.id} for t in tasks]
+        )
+    finally:
+        event.remove(db.bind.sync_engine, "before_cursor_execute", capture)
+    assert response.status_code == 200
+    # user and all five tasks checked by one query
+    assert len([i for i in statements if i.lstrip().startswith("SELECT")]) == 1
+
+    response = await client.post(
+        "/bbox/createmany",
+        params={
+            "user_id":-1,
+        },
+        json = [{"x_min":0, "y_min":0, "x_max":1, "y_max":1, "task_id": t.id} for t in tasks]
+    )
+    assert response.status_code == 404
+    assert response.json()["detail"] == UserNotFoundException.detail
+
+async def test_invalid_get_bboxes_bad_cursor(client:AsyncClient, db:AsyncSession):
+    response = await client.get("/bbox/", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == InvalidCursorException.detail
+
+async def test_valid_get_bboxes_in_region(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    image = await crud.get_image_by_id(db=db, id=task.image_id)
+    other_image = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=user.id, path=image.path+".copy"))
+    other_task = await crud.create_task(db=db, new_task=TaskBase(created_user_id=user.id, task_type=TaskType.bbox_annotation.value, image_id=other_image.id))
+    for t in [task, other_task]:
+        response = await client.put(
+            f"/task/{t.id}/accept",
+            params={
+                "user_id":user.id
+            }
+        )
+    response = await client.post(
+        "/bbox/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [
+            {"x_min":0, "y_min":0, "x_max":10, "y_max":10, "task_id": task.id},
+            {"x_min":5, "y_min":5, "x_max":15, "y_max":15, "task_id": task.id},
+            {"x_min":50, "y_min":50, "x_max":60, "y_max":60, "task_id": task.id},
+            # same place, another image
+            {"x_min":0, "y_min":0, "x_max":10, "y_max":10, "task_id": other_task.id},
+        ]
+    )
+    assert response.status_code == 200
+    ids = [i["id"] for i in response.json()]
+
+    region = {"image_id": task.image_id, "x_min": 8, "y_min": 8, "x_max": 20, "y_max": 20}
+    response = await client.get("/bbox/region", params=region)
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == ids[:2]
+
+    response = await client.get("/bbox/region", params={**region, "limit": 1})
+    assert [i["id"] for i in response.json()["items"]] == ids[:1]
+    response = await client.get("/bbox/region", params={**region, "limit": 1, "cursor": response.json()["next_cursor"]})
+    assert [i["id"] for i in response.json()["items"]] == ids[1:2]
+    assert response.json()["next_cursor"] is None
+
+    response = await client.get("/bbox/region", params={**region, "x_min": 100, "x_max": 200})
+    assert response.json()["items"] == []
+
+    # moved bbox is found at its new place
+    response = await client.put(
+        f"/bbox/update/{ids[2]}",
+        params={
+            "user_id":user.id,
+        },
+        json={"x_min":9, "y_min":9, "x_max":11, "y_max":11}
+    )
+    assert response.status_code == 200
+    response = await client.get(f"/bbox/{ids[0]}/overlapping")
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == ids[1:3]
+
+async def test_invalid_get_bboxes_in_region_bad_region(client:AsyncClient, db:AsyncSession):
+    response = await client.get("/bbox/region", params={"image_id": 1, "x_min": 10, "y_min": 0, "x_max": 0, "y_max": 10})
+    assert response.status_code == 400
+    assert response.json()["detail"] == InvalidRegionException.detail
+
+    response = await client.get("/bbox/0/overlapping")
+    assert response.status_code == 404
+    assert response.json()["detail"] == BboxNotFoundException.detail
+
+async def test_valid_update_many_bboxes(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    response = await client.post(
+        "/bbox/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(3)]
+    )
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.put(
+        "/bbox/updatemany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"id": ids[2], "x_min":0, "y_min":0, "x_max":5, "y_max":5, "label":"hen"}, {"id": ids[0], "x_min":1, "y_min":1, "x_max":2, "y_max":2}]
+    )
+    assert response.status_code == 200
+    assert [(i["id"], i["x_max"], i["label"]) for i in response.json()] == [(ids[2], 5, "hen"), (ids[0], 2, None)]
+
+    # all or nothing
+    response = await client.put(
+        "/bbox/updatemany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"id": ids[1], "x_min":0, "y_min":0, "x_max":9, "y_max":9}, {"id": -1, "x_min":0, "y_min":0, "x_max":9, "y_max":9}]
+    )
+    assert response.status_code == 404
+    assert response.json()["detail"] == BboxNotFoundException.detail
+    response = await client.get(f"/bbox/{ids[1]}")
+    assert response.json()["x_max"] == 2
+
+    user2 = await create_test_user(db=db)
+    response = await client.put(
+        "/bbox/updatemany",
+        params={
+            "user_id":user2.id,
+        },
+        json = [{"id": ids[1], "x_min":0, "y_min":0, "x_max":9, "y_max":9}]
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == AddAnnotationFromNotAcceptedUser.detail
+
+async def test_valid_delete_many_bboxes(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    response = await client.post(
+        "/bbox/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(3)]
+    )
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.request("DELETE", "/bbox/deletemany", params={"user_id":user.id}, json=[ids[0], -1])
+    assert response.status_code == 404
+    response = await client.request("DELETE", "/bbox/deletemany", params={"user_id":user.id}, json=ids[:2])
+    assert response.status_code == 200
+    assert response.json() == ids[:2]
+
+    response = await client.get(f"/task/{task.id}")
+    assert [i["id"] for i in response.json()["bboxes"]] == ids[2:]
+
+    response = await client.put(f"/task/{task.id}/finish", params={"user_id":user.id})
+    response = await client.request("DELETE", "/bbox/deletemany", params={"user_id":user.id}, json=ids[2:])
+    assert response.status_code == 400
+    assert response.json()["detail"] == AddAnnotationToFinishedTaskException.detail
+
 # createmany pending taskstatus
 # createmany finished taskstatus
 # createmany wrong tasktype
 # createmany bad user
 # createmany not accepted user
-# delete bad bbox_id
\ No newline at end of file
+# delete bad bbox_id
+async def test_invalid_create_bbox_out_of_image(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    user = task.created_user
+    await crud.set_image_metadata(db=db, rows=[{"id": task.image_id, "width": 800, "height": 1200, "channels": 3, "format": "JPEG"}])
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+
+    # on the edge is inside
+    response = await client.post("/bbox/create", params={"user_id":user.id}, json={"x_min":0, "y_min":0, "x_max":800, "y_max":1200, "task_id": task.id})
+    assert response.status_code == 200
+    bbox_id = response.json()["id"]
+    for bbox in [{"x_min":-1, "y_min":0, "x_max":10, "y_max":10}, {"x_min":0, "y_min":0, "x_max":801, "y_max":10}, {"x_min":0, "y_min":0, "x_max":10, "y_max":1201}]:
+        response = await client.post("/bbox/createmany", params={"user_id":user.id}, json=[{**bbox, "task_id": task.id}])
+        assert response.status_code == 400
+        assert response.json()["detail"] == AnnotationOutOfImageException.detail
+    response = await client.put("/bbox/updatemany", params={"user_id":user.id}, json=[{"id": bbox_id, "x_min":0, "y_min":0, "x_max":900, "y_max":10}])
+    assert response.status_code == 400
+    response = await client.put(f"/bbox/update/{bbox_id}", params={"user_id":user.id}, json={"x_min":0, "y_min":0, "x_max":900, "y_max":10})
+    assert response.status_code == 400
+    assert response.json()["detail"] == AnnotationOutOfImageException.detail
+    response = await client.patch(f"/task/{task.id}/annotations", params={"user_id":user.id}, json={"operations": [
+        {"op": "add", "bbox": {"x_min":0, "y_min":0, "x_max":10, "y_max":1300}},
+    ]})
+    assert response.status_code == 400
+    response = await client.get("/bbox/", params={"task_id": task.id})
+    assert len(response.json()["items"]) == 1
@@ -0,0 +1,122 @@
+import io
+import os
+import zipfile
+import pytest
+from datetime import datetime, timedelta, timezone
+from httpx import AsyncClient
+from PIL import Image as PILImage
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crud
+from app.core.database import TaskType
+from app.schemas import TaskBase
+from app.settings import image_domain
+from app.tests.utils.task import create_test_task
+
+pytestmark = pytest.mark.anyio
+
+
+async def finished_dataset(client:AsyncClient, db:AsyncSession):
+    # finished bbox task with two boxes and finished polygon task with one triangle on the same image
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    poly_task = await crud.create_task(db=db, new_task=TaskBase(created_user_id=user.id, task_type=TaskType.poly_annotation, image_id=task.image_id))
+    # pending task, not exported
+    await crud.create_task(db=db, new_task=TaskBase(created_user_id=user.id, task_type=TaskType.bbox_annotation, image_id=task.image_id))
+
+    await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+    response = await client.post(
+        "/bbox/createmany",
+        params={"user_id":user.id},
+        json = [
+            {"x_min":10, "y_min":20, "x_max":30, "y_max":60, "label":"cell", "task_id": task.id},
+            {"x_min":0, "y_min":0, "x_max":5, "y_max":5, "task_id": task.id},
+        ]
+    )
+    assert response.status_code == 200
+    await client.put(f"/task/{task.id}/finish", params={"user_id":user.id})
+
+    await client.put(f"/task/{poly_task.id}/accept", params={"user_id":user.id})
+    response = await client.post("/polygon/create", params={"user_id":user.id}, json={"points":[[0,0],[4,0],[0,4]], "task_id": poly_task.id})
+    assert response.status_code == 200
+    await client.put(f"/task/{poly_task.id}/finish", params={"user_id":user.id})
+
+    image = await crud.get_image_by_id(db=db, id=task.image_id)
+    return image
+
+async def test_valid_export_coco(client:AsyncClient, db:AsyncSession):
+    image = await finished_dataset(client, db)
+    with PILImage.open("app/tests/data/test_image.jpg") as file:
+        width, height = file.size
+
+    response = await client.get("/export/coco")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    dataset = response.json()
+    assert dataset["images"] == [{"id": image.id, "file_name": image.path.lstrip("/"), "width": width, "height": height}]
+    assert dataset["categories"] == [{"id": image.species_id, "name": "test_species"}]
+    assert [i["id"] for i in dataset["annotations"]] == [1, 2, 3]
+    bbox, _, polygon = dataset["annotations"]
+    assert bbox == {"id": 1, "image_id": image.id, "category_id": image.species_id, "bbox": [10, 20, 20, 40], "area": 800, "iscrowd": 0, "label": "cell"}
+    assert polygon["segmentation"] == [[0, 0, 4, 0, 0, 4]]
+    assert polygon["bbox"] == [0, 0, 4, 4]
+    assert polygon["area"] == 8
+
+async def test_valid_export_coco_filters(client:AsyncClient, db:AsyncSession):
+    image = await finished_dataset(client, db)
+
+    response = await client.get("/export/coco", params={"task_type": TaskType.poly_annotation.value})
+    assert [i["id"] for i in response.json()["images"]] == [image.id]
+    assert ["segmentation" in i for i in response.json()["annotations"]] == [True]
+
+    response = await client.get("/export/coco", params={"species_id": image.species_id + 1})
+    assert response.json()["images"] == []
+    assert response.json()["annotations"] == []
+
+    now = datetime.now(timezone.utc)
+    response = await client.get("/export/coco", params={"finished_from": (now - timedelta(hours=1)).isoformat(), "finished_to": (now + timedelta(hours=1)).isoformat()})
+    assert len(response.json()["annotations"]) == 3
+    response = await client.get("/export/coco", params={"finished_from": (now + timedelta(hours=1)).isoformat()})
+    assert response.json()["annotations"] == []
+
+async def test_valid_export_yolo(client:AsyncClient, db:AsyncSession):
+    image = await finished_dataset(client, db)
+    with PILImage.open("app/tests/data/test_image.jpg") as file:
+        width, height = file.size
+    stem = image.path.rsplit("/", 1)[1].rsplit(".", 1)[0]
+
+    response = await client.get("/export/yolo")
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.read("classes.txt") == b"test_species\n"
+    lines = archive.read(f"labels/{stem}.txt").decode().splitlines()
+    assert [i.split()[0] for i in lines] == ["0", "0"]
+    assert [float(i) for i in lines[0].split()[1:]] == pytest.approx([20/width, 40/height, 20/width, 40/height], abs=1e-6)
+
+    response = await client.get("/export/yolo", params={"kind": "poly"})
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    lines = archive.read(f"labels/{stem}.txt").decode().splitlines()
+    assert len(lines) == 1
+    assert [float(i) for i in lines[0].split()[1:]] == pytest.approx([0, 0, 4/width, 0, 0, 4/height], abs=1e-6)
+
+async def test_valid_export_yolo_empty(client:AsyncClient, db:AsyncSession):
+    await create_test_task(db=db)
+    response = await client.get("/export/yolo")
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["classes.txt"]
+
+async def test_valid_export_skips_missing_files(client:AsyncClient, db:AsyncSession):
+    image = await finished_dataset(client, db)
+    os.remove(image_domain + image.path)
+
+    response = await client.get("/export/coco")
+    assert response.status_code == 200
+    dataset = response.json()
+    assert dataset["images"] == []
+    assert dataset["annotations"] == []
+    assert dataset["skipped_images"] == [image.id]
+
+    response = await client.get("/export/yolo")
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["classes.txt", "skipped.txt"]
+    assert archive.read("skipped.txt").decode() == image.path + "\n"
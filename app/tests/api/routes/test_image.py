@@ -1,22 +1,29 @@
+import io
 import os
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import tarfile
+import zipfile
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.tests.utils.image import create_test_image
 from app.tests.utils.species import create_test_species
 from app.tests.utils.user import create_test_user
 from app.settings import image_domain
+from app.routes.exception import ImageFileNotFoundException, UnreadableImageException
+
+pytestmark = pytest.mark.anyio
 
 #TODO test get many images
 
-def test_valid_create_image(
-        client: TestClient,
-        db:Session
+async def test_valid_create_image(
+        client: AsyncClient,
+        db:AsyncSession
 ):
-    species = create_test_species(db=db)
-    user = create_test_user(db=db)
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
 
     with open(rf"app\tests\data\test_upload.png",'rb') as fout:
-        response = client.post(
+        response = await client.post(
                 "/image/",
                 params={
                     "species_id":species.id,
@@ -34,11 +41,11 @@ def test_valid_create_image(
 
     assert os.path.exists(image_domain+response.json()["path"])
 
-def test_invalid_species_create_image(client:TestClient, db:Session):
-    user = create_test_user(db=db)
+async def test_invalid_species_create_image(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
 
     with open(rf"app\tests\data\test_upload.png",'rb') as fout:
-            response = client.post(
+            response = await client.post(
                     "/image/",
                     params={
                         "species_id":"1",
@@ -51,11 +58,11 @@ def test_invalid_species_create_image(client:TestClient, db:Session):
             )
     assert response.status_code==404
 
-def test_invalid_user_create_image(client:TestClient, db:Session):
-    species = create_test_species(db=db)
+async def test_invalid_user_create_image(client:AsyncClient, db:AsyncSession):
+    species = await create_test_species(db=db)
 
     with open(rf"app\tests\data\test_upload.png",'rb') as fout:
-            response = client.post(
+            response = await client.post(
                     "/image/",
                     params={
                         "species_id":species.id,
@@ -68,10 +75,10 @@ def test_invalid_user_create_image(client:TestClient, db:Session):
             )
     assert response.status_code==404
 
-def test_valid_download_image(client:TestClient, db:Session):
+async def test_valid_download_image(client:AsyncClient, db:AsyncSession):
     import filecmp
-    image = create_test_image(db=db)
-    response = client.get(f"/image/{image.id}/download")
+    image = await create_test_image(db=db)
+    response = await client.get(f"/image/{image.id}/download")
     assert response.status_code == 200
     assert response.headers["filename"] == image.path.split("/")[-1]
     # save file
@@ -82,20 +89,344 @@ def test_valid_download_image(client:TestClient, db:Session):
     # remove downloaded image
     os.remove(response.headers["filename"])
 
-def test_invalid_image_id_download_image(client:TestClient, db:Session):
-    response = client.get(f"/image/{1}/download")
+async def test_valid_download_image_conditional(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
+    with open(image_domain + image.path, "rb") as fin:
+        data = fin.read()
+    response = await client.get(f"/image/{image.id}/download")
+    # no hash, the path may get other content
+    assert response.headers["cache-control"] == "no-cache"
+    assert response.headers["accept-ranges"] == "bytes"
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    response = await client.get(f"/image/{image.id}/download", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    response = await client.get(f"/image/{image.id}/download", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = await client.get(f"/image/{image.id}/download", headers={"If-None-Match": '"other"', "If-Modified-Since": last_modified})
+    assert response.status_code == 200
+
+    # resumed download
+    response = await client.get(f"/image/{image.id}/download", headers={"Range": "bytes=100-", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-{len(data) - 1}/{len(data)}"
+    assert response.content == data[100:]
+    # changed meanwhile, the whole file
+    response = await client.get(f"/image/{image.id}/download", headers={"Range": "bytes=100-", "If-Range": '"other"'})
+    assert response.status_code == 200
+    assert response.content == data
+    response = await client.get(f"/image/{image.id}/download", headers={"Range": f"bytes={len(data)}-"})
+    assert response.status_code == 416
+
+async def test_valid_download_image_content_addressed(client:AsyncClient, db:AsyncSession):
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+    with open("app/tests/data/test_image.jpg", "rb") as fin:
+        response = await client.post(
+            "/image/",
+            params={"species_id":species.id, "uploaded_user_id":user.id},
+            files={"image_file": ("a.jpg", fin)}
+        )
+    image = response.json()
+    response = await client.get(f"/image/{image['id']}/download")
+    assert response.headers["etag"] == f'"{image["sha256"]}"'
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    response = await client.get(f"/image/{image['id']}/download", headers={"If-None-Match": f'W/"x", W/"{image["sha256"]}"'})
+    assert response.status_code == 304
+
+async def test_invalid_image_id_download_image(client:AsyncClient, db:AsyncSession):
+    response = await client.get(f"/image/{1}/download")
     assert response.status_code == 404
 
-def test_valid_get_image(client:TestClient, db:Session):
-    image = create_test_image(db=db)
+async def test_valid_get_image(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
 
-    resp = client.get(f"/image/{image.id}")
+    resp = await client.get(f"/image/{image.id}")
     assert resp.status_code == 200
     assert resp.json()["species_id"] == image.species_id
     assert resp.json()["uploaded_user_id"] == image.uploaded_user_id
     assert resp.json()["tasks"] == image.tasks
     assert resp.json()["path"] == image.path
 
-def test_invalid_image_id_get_image(client:TestClient, db:Session):
-    resp = client.get(f"/image/{1}")
-    assert resp.status_code == 404
\ No newline at end of file
+async def test_invalid_image_id_get_image(client:AsyncClient, db:AsyncSession):
+    resp = await client.get(f"/image/{1}")
+    assert resp.status_code == 404
+
+def image_archive(format:str) -> bytes:
+    with open("app/tests/data/test_image.jpg", "rb") as fin:
+        data = fin.read()
+    # 2.JPG has the content of 1.jpg
+    files = {"session/1.jpg": data, "session/2.JPG": data, "session/3.jpg": data + b"\0", "session/notes.txt": b"notes"}
+    buffer = io.BytesIO()
+    if format == "zip":
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+    else:
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("format", ["zip", "tar"])
+async def test_valid_bulk_upload_images(client:AsyncClient, db:AsyncSession, format:str):
+    import filecmp
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+
+    response = await client.post(
+        "/image/bulk",
+        params={"species_id":species.id, "uploaded_user_id":user.id},
+        files={"archive": ("session", image_archive(format))}
+    )
+    assert response.status_code == 200
+    results = response.json()
+    assert [i["name"] for i in results] == ["session/1.jpg", "session/2.JPG", "session/3.jpg", "session/notes.txt"]
+    assert results[3] == {"name": "session/notes.txt", "image_id": None, "detail": "not an image"}
+    assert results[1] == {"name": "session/2.JPG", "image_id": results[0]["image_id"], "detail": "duplicate"}
+    assert results[0]["image_id"] != results[2]["image_id"]
+    for result in [results[0], results[2]]:
+        assert result["detail"] is None
+        response = await client.get(f"/image/{result['image_id']}")
+        assert response.json()["species_id"] == species.id
+        assert response.json()["uploaded_user_id"] == user.id
+        assert response.json()["path"].endswith(response.json()["sha256"] + ".jpg")
+    response = await client.get(f"/image/{results[0]['image_id']}")
+    assert filecmp.cmp("app/tests/data/test_image.jpg", image_domain + response.json()["path"])
+
+    # the whole session again
+    response = await client.post(
+        "/image/bulk",
+        params={"species_id":species.id, "uploaded_user_id":user.id},
+        files={"archive": ("session", image_archive(format))}
+    )
+    assert [(i["image_id"], i["detail"]) for i in response.json()[:3]] == [(i["image_id"], "duplicate") for i in results[:3]]
+
+async def test_invalid_bulk_upload_images(client:AsyncClient, db:AsyncSession):
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+
+    response = await client.post(
+        "/image/bulk",
+        params={"species_id":species.id, "uploaded_user_id":user.id},
+        files={"archive": ("session", b"not an archive")}
+    )
+    assert response.status_code == 400
+    response = await client.post(
+        "/image/bulk",
+        params={"species_id":species.id + 1, "uploaded_user_id":user.id},
+        files={"archive": ("session", image_archive("zip"))}
+    )
+    assert response.status_code == 404
+
+async def test_valid_create_image_duplicate(client:AsyncClient, db:AsyncSession):
+    import hashlib
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+    with open("app/tests/data/test_image.jpg", "rb") as fin:
+        data = fin.read()
+
+    responses = []
+    for name in ["a.jpg", "b.jpg"]:
+        responses.append(await client.post(
+            "/image/",
+            params={"species_id":species.id, "uploaded_user_id":user.id},
+            files={"image_file": (name, data)}
+        ))
+    assert responses[0].status_code == responses[1].status_code == 200
+    image = responses[0].json()
+    assert image["sha256"] == hashlib.sha256(data).hexdigest()
+    # read from the header at upload
+    assert {k: image[k] for k in ["width", "height", "channels", "format"]} == {"width": 800, "height": 1200, "channels": 3, "format": "JPEG"}
+    assert image["path"].endswith(image["sha256"] + ".jpg")
+    # same content, same image and a single file
+    assert responses[1].json()["id"] == image["id"]
+    assert os.listdir(image_domain + "/" + species.name) == [image["sha256"] + ".jpg"]
+
+@pytest.fixture
+def tile_cache(tmp_path, monkeypatch):
+    from app.core import tiles
+    cache = tiles.TileCache(str(tmp_path / "tiles"), 10 * 1024**2)
+    monkeypatch.setattr(tiles, "cache", cache)
+    return cache
+
+async def test_valid_get_image_tiles(client:AsyncClient, db:AsyncSession, tile_cache):
+    from PIL import Image as PILImage
+    image = await create_test_image(db=db)
+
+    response = await client.get(f"/image/{image.id}/tiles")
+    assert response.status_code == 200
+    # 800x1200
+    assert response.json() == {"width": 800, "height": 1200, "tile_size": 256, "overlap": 0, "format": "jpg", "max_level": 11}
+
+    # last column and row of the full resolution level are cut short
+    response = await client.get(f"/image/{image.id}/tiles/11/3_4")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert PILImage.open(io.BytesIO(response.content)).size == (800 - 3*256, 1200 - 4*256)
+    response = await client.get(f"/image/{image.id}/tiles/10/1_2")
+    assert PILImage.open(io.BytesIO(response.content)).size == (400 - 256, 600 - 2*256)
+    response = await client.get(f"/image/{image.id}/tiles/0/0_0")
+    assert PILImage.open(io.BytesIO(response.content)).size == (1, 1)
+
+async def test_invalid_get_image_tiles(client:AsyncClient, db:AsyncSession, tile_cache):
+    image = await create_test_image(db=db)
+    for path in ["11/4_0", "11/0_5", "12/0_0"]:
+        response = await client.get(f"/image/{image.id}/tiles/{path}")
+        assert response.status_code == 404
+    response = await client.get(f"/image/0/tiles/0/0_0")
+    assert response.status_code == 404
+    response = await client.get(f"/image/0/tiles")
+    assert response.status_code == 404
+
+async def test_invalid_get_image_tiles_bad_file(client:AsyncClient, db:AsyncSession, tile_cache):
+    image = await create_test_image(db=db)
+    with open(image_domain + image.path, "w") as file:
+        file.write("not an image")
+    for url in [f"/image/{image.id}/tiles", f"/image/{image.id}/tiles/0/0_0"]:
+        response = await client.get(url)
+        assert response.status_code == 415
+        assert response.json()["detail"] == UnreadableImageException.detail
+
+    os.remove(image_domain + image.path)
+    for url in [f"/image/{image.id}/tiles", f"/image/{image.id}/tiles/0/0_0"]:
+        response = await client.get(url)
+        assert response.status_code == 404
+        assert response.json()["detail"] == ImageFileNotFoundException.detail
+
+@pytest.fixture
+def thumbnail_dir(tmp_path, monkeypatch):
+    from app.core import thumbnails
+    monkeypatch.setattr(thumbnails, "thumbnail_dir", str(tmp_path))
+    return tmp_path
+
+async def test_valid_get_image_sprite(client:AsyncClient, db:AsyncSession, thumbnail_dir):
+    from PIL import Image as PILImage
+    image = await create_test_image(db=db)
+
+    response = await client.get("/image/sprite", params={"ids": [image.id, image.id, image.id], "columns": 2})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["x-sprite-columns"] == "2"
+    assert response.headers["x-sprite-cell"] == "128"
+    assert PILImage.open(io.BytesIO(response.content)).size == (2 * 128, 2 * 128)
+    # 800x1200 fits into 128x128 as 85x128
+    assert os.listdir(thumbnail_dir) == [f"image-{image.id}.jpg"]
+    assert PILImage.open(thumbnail_dir / f"image-{image.id}.jpg").size == (85, 128)
+
+async def test_invalid_get_image_sprite(client:AsyncClient, db:AsyncSession, thumbnail_dir):
+    image = await create_test_image(db=db)
+    response = await client.get("/image/sprite", params={"ids": [image.id, 0]})
+    assert response.status_code == 404
+    response = await client.get("/image/sprite")
+    assert response.status_code == 422
+    response = await client.get("/image/sprite", params={"ids": [image.id], "columns": 0})
+    assert response.status_code == 422
+
+@pytest.fixture
+def crop_cache(monkeypatch):
+    from app.core import crops
+    cache = crops.DecodedCache(64 * 1024**2)
+    monkeypatch.setattr(crops, "cache", cache)
+    return cache
+
+async def test_valid_get_image_crop(client:AsyncClient, db:AsyncSession, crop_cache):
+    from PIL import Image as PILImage
+    image = await create_test_image(db=db)
+
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 10, "y0": 20, "x1": 110.5, "y1": 220, "pad": 5})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    # fractional corners round outward
+    assert PILImage.open(io.BytesIO(response.content)).size == (116 - 5, 225 - 15)
+    # cut to the 800x1200 image
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 750, "y0": 0, "x1": 900, "y1": 10, "pad": 10})
+    assert PILImage.open(io.BytesIO(response.content)).size == (60, 20)
+    # decoded once
+    assert len(crop_cache._images) == 1
+
+async def test_invalid_get_image_crop(client:AsyncClient, db:AsyncSession, crop_cache):
+    image = await create_test_image(db=db)
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 10, "y0": 0, "x1": 5, "y1": 10})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Region minimum corner must not be greater than its maximum corner."
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 900, "y0": 0, "x1": 1000, "y1": 10})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Crop region does not overlap the image."
+    response = await client.get(f"/image/0/crop", params={"x0": 0, "y0": 0, "x1": 10, "y1": 10})
+    assert response.status_code == 404
+
+async def test_invalid_get_image_crop_bad_file(client:AsyncClient, db:AsyncSession, crop_cache):
+    image = await create_test_image(db=db)
+    with open(image_domain + image.path, "w") as file:
+        file.write("not an image")
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 0, "y0": 0, "x1": 10, "y1": 10})
+    assert response.status_code == 415
+    assert response.json()["detail"] == UnreadableImageException.detail
+
+    os.remove(image_domain + image.path)
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 0, "y0": 0, "x1": 10, "y1": 10})
+    assert response.status_code == 404
+    assert response.json()["detail"] == ImageFileNotFoundException.detail
+
+async def test_invalid_create_image_not_an_image(client:AsyncClient, db:AsyncSession):
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+    response = await client.post(
+        "/image/",
+        params={"species_id":species.id, "uploaded_user_id":user.id},
+        files={"image_file": ("notes.jpg", b"not an image")}
+    )
+    assert response.status_code == 415
+    assert os.listdir(image_domain + "/test_species") == []
+
+async def test_invalid_create_image_too_large(client:AsyncClient, db:AsyncSession, monkeypatch):
+    from app.core import imaging
+    # 800x1200 is over
+    monkeypatch.setattr(imaging, "image_max_pixels", 800 * 1200 - 1)
+    species = await create_test_species(db=db)
+    user = await create_test_user(db=db)
+    with open("app/tests/data/test_image.jpg", "rb") as fin:
+        response = await client.post(
+            "/image/",
+            params={"species_id":species.id, "uploaded_user_id":user.id},
+            files={"image_file": ("a.jpg", fin)}
+        )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Image has more pixels than allowed (IMAGE_MAX_PIXELS)."
+    # no file left behind
+    assert os.listdir(image_domain + "/" + species.name) == []
+
+    response = await client.post(
+        "/image/bulk",
+        params={"species_id":species.id, "uploaded_user_id":user.id},
+        files={"archive": ("images.zip", image_archive("zip"))}
+    )
+    assert response.status_code == 200
+    assert all(i["image_id"] is None and "over the limit" in i["detail"] for i in response.json() if i["name"].lower().endswith(".jpg"))
+    assert os.listdir(image_domain + "/" + species.name) == []
+
+async def test_valid_get_image_crop_from_tiles(client:AsyncClient, db:AsyncSession, tile_cache, monkeypatch):
+    from PIL import Image as PILImage
+    from app.core import crops
+    # 800x1200 does not fit, crops come from the pyramid
+    cache = crops.DecodedCache(1024)
+    monkeypatch.setattr(crops, "cache", cache)
+    image = await create_test_image(db=db)
+
+    # across four tiles
+    response = await client.get(f"/image/{image.id}/crop", params={"x0": 200, "y0": 200, "x1": 300, "y1": 310})
+    assert response.status_code == 200
+    region = PILImage.open(io.BytesIO(response.content))
+    assert region.size == (100, 110)
+    with PILImage.open("app/tests/data/test_image.jpg") as original:
+        expected = original.convert("RGB").crop((200, 200, 300, 310))
+    # jpeg twice, close to the original
+    import numpy as np
+    assert np.abs(np.asarray(region.convert("L"), dtype=int) - np.asarray(expected.convert("L"), dtype=int)).mean() < 8
+    assert cache._images == {}
+    assert os.listdir(tile_cache.directory) == [f"image-{image.id}"]
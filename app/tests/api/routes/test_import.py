@@ -0,0 +1,213 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+import pytest
+from httpx import AsyncClient
+from PIL import Image as PILImage
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core import database, importer
+from app.core.database import TaskStatus, TaskType
+from app.settings import image_domain
+from app.tests.utils.user import create_test_user
+
+pytestmark = pytest.mark.anyio
+
+
+with open("app/tests/data/test_image.jpg", "rb") as file:
+    IMAGE = file.read()
+
+COCO = {
+    "images": [
+        {"id": 1, "file_name": "frames/a.jpg", "width": 10, "height": 10},
+        {"id": 2, "file_name": "frames/b.jpg", "width": 10, "height": 10},
+        {"id": 3, "file_name": "frames/c.jpg", "width": 10, "height": 10},
+        # not in the archive
+        {"id": 4, "file_name": "frames/lost.jpg", "width": 10, "height": 10},
+    ],
+    "annotations": [
+        {"id": 1, "image_id": 1, "category_id": 7, "bbox": [1, 2, 3, 4]},
+        {"id": 2, "image_id": 1, "category_id": 7, "bbox": [0, 0, 1, 1]},
+        {"id": 3, "image_id": 2, "category_id": 7, "bbox": [0, 0, 4, 4], "segmentation": [[0, 0, 4, 0, 0, 4]]},
+        {"id": 4, "image_id": 4, "category_id": 7, "bbox": [0, 0, 1, 1]},
+        # RLE mask
+        {"id": 5, "image_id": 2, "category_id": 7, "segmentation": {"counts": [1, 2], "size": [10, 10]}},
+    ],
+    "categories": [{"id": 7, "name": "test_species"}],
+}
+
+def zip_archive() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name in ["a.jpg", "b.jpg", "c.jpg"]:
+            archive.writestr(f"dataset/frames/{name}", IMAGE + name.encode())
+    return buffer.getvalue()
+
+def tar_archive() -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name in ["a.jpg", "b.jpg", "c.jpg"]:
+            info = tarfile.TarInfo(name)
+            info.size = len(IMAGE + name.encode())
+            archive.addfile(info, io.BytesIO(IMAGE + name.encode()))
+    return buffer.getvalue()
+
+async def post_import(client:AsyncClient, user_id:int, archive:bytes, coco=COCO, **params):
+    return await client.post(
+        "/import/coco",
+        params={"uploaded_user_id": user_id, **params},
+        files={"coco_file": ("coco.json", json.dumps(coco)), "images_archive": ("images", archive)}
+    )
+
+async def test_valid_import_coco(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+
+    response = await post_import(client, user.id, zip_archive())
+    assert response.status_code == 200
+    assert response.json() == {"images": 2, "skipped": 0, "missing": 1, "unassigned": 1, "duplicates": 0, "too_large": 0, "tasks": 2, "bboxes": 2, "polygons": 1, "invalid": 1}
+
+    images = (await db.scalars(select(database.Image).order_by(database.Image.id))).all()
+    assert len(images) == 2
+    for image in images:
+        assert image.path.startswith("/test_species/")
+        with open(image_domain + image.path, "rb") as file:
+            assert file.read().startswith(IMAGE)
+    tasks = (await db.scalars(select(database.Task).order_by(database.Task.id))).all()
+    assert [(i.image_id, i.task_type, i.status, i.accepted_user_id) for i in tasks] == [
+        (images[0].id, TaskType.bbox_annotation, TaskStatus.finished, user.id),
+        (images[1].id, TaskType.poly_annotation, TaskStatus.finished, user.id),
+    ]
+    response = await client.get(f"/task/{tasks[0].id}")
+    assert [[i["x_min"], i["y_min"], i["x_max"], i["y_max"]] for i in response.json()["bboxes"]] == [[1, 2, 4, 6], [0, 0, 1, 1]]
+    response = await client.get(f"/task/{tasks[1].id}")
+    assert response.json()["polygons"][0]["points"] == [[0, 0], [4, 0], [0, 4]]
+
+    response = await client.get("/stats/annotations", params={"species_id": images[0].species_id})
+    assert response.json() == [
+        {"species_id": images[0].species_id, "kind": "bbox", "count": 2},
+        {"species_id": images[0].species_id, "kind": "poly", "count": 1},
+    ]
+    response = await client.get("/stats/tasks", params={"task_status": TaskStatus.finished.value})
+    assert sum(i["count"] for i in response.json()) == 2
+
+async def test_valid_import_coco_resumes(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    response = await post_import(client, user.id, zip_archive())
+    assert response.json()["images"] == 2
+
+    response = await post_import(client, user.id, zip_archive())
+    assert response.status_code == 200
+    assert response.json()["images"] == 0
+    assert response.json()["skipped"] == 2
+    assert len((await db.scalars(select(database.Image))).all()) == 2
+
+async def test_valid_import_coco_tar_species(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    coco = {**COCO, "categories": [{"id": 7, "name": "cell"}]}
+
+    response = await post_import(client, user.id, tar_archive(), coco=coco, species="test_species", empty_task_type=TaskType.bbox_annotation.value)
+    assert response.status_code == 200
+    assert response.json()["images"] == 3
+    assert response.json()["unassigned"] == 0
+    # image 3 has no annotations
+    pending = (await db.scalars(select(database.Task).filter(database.Task.status == TaskStatus.pending))).all()
+    assert [i.task_type for i in pending] == [TaskType.bbox_annotation]
+    species = (await db.scalars(select(database.Species.name))).all()
+    assert species == ["test_species"]
+
+async def test_invalid_import_coco(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    response = await post_import(client, user.id + 1, zip_archive())
+    assert response.status_code == 404
+
+    response = await post_import(client, user.id, b"not an archive")
+    assert response.status_code == 400
+    response = await post_import(client, user.id, zip_archive(), coco={"images": [{"id": 1}]})
+    assert response.status_code == 400
+    response = await post_import(client, user.id, zip_archive(), coco={**COCO, "categories": []})
+    assert response.status_code == 400
+    # species names become directories
+    response = await post_import(client, user.id, zip_archive(), coco={**COCO, "categories": [{"id": 7, "name": "../../x"}]})
+    assert response.status_code == 400
+    response = await post_import(client, user.id, zip_archive(), species="../x")
+    assert response.status_code == 422
+
+async def test_valid_open_source_directory(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(IMAGE)
+    source = importer.open_source(str(tmp_path))
+    with source.open("frames/a.jpg") as file:
+        assert file.read() == IMAGE
+    assert source.open("b.jpg") is None
+
+async def test_valid_import_coco_skips_stored_content(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    response = await post_import(client, user.id, zip_archive())
+    assert response.json()["images"] == 2
+
+    # another dataset with the same frames under another species
+    coco = {**COCO, "categories": [{"id": 7, "name": "other_species"}]}
+    response = await post_import(client, user.id, zip_archive(), coco=coco)
+    assert response.status_code == 200
+    assert response.json()["images"] == 0
+    assert response.json()["duplicates"] == 2
+    assert len((await db.scalars(select(database.Image))).all()) == 2
+    assert len(os.listdir(image_domain + "/test_species")) == 2
+    assert os.listdir(image_domain + "/other_species") == []
+    os.rmdir(image_domain + "/other_species")
+
+async def test_valid_import_coco_drops_copies_within_batch(client:AsyncClient, db:AsyncSession):
+    # the same frame twice, the second time under another species and extension
+    user = await create_test_user(db=db)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("a.jpg", IMAGE)
+        archive.writestr("copy.jpeg", IMAGE)
+    coco = {
+        "images": [{"id": 1, "file_name": "a.jpg"}, {"id": 2, "file_name": "copy.jpeg"}],
+        "annotations": [
+            {"id": 1, "image_id": 1, "category_id": 7, "bbox": [0, 0, 1, 1]},
+            {"id": 2, "image_id": 2, "category_id": 8, "bbox": [0, 0, 1, 1]},
+        ],
+        "categories": [{"id": 7, "name": "test_species"}, {"id": 8, "name": "other_species"}],
+    }
+    response = await post_import(client, user.id, buffer.getvalue(), coco=coco)
+    assert response.status_code == 200
+    assert response.json()["images"] == 1
+    assert response.json()["duplicates"] == 1
+    assert len(os.listdir(image_domain + "/test_species")) == 1
+    assert os.listdir(image_domain + "/other_species") == []
+    os.rmdir(image_domain + "/other_species")
+
+async def test_valid_import_coco_skips_non_finite_annotations(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    coco = {**COCO, "annotations": [
+        {"id": 1, "image_id": 1, "category_id": 7, "bbox": [float("nan"), 0, 1, 1]},
+        {"id": 2, "image_id": 1, "category_id": 7, "bbox": [0, 0, float("inf"), 1]},
+        {"id": 3, "image_id": 1, "category_id": 7, "bbox": [0, 0, 1, 1], "segmentation": [[0, 0, float("nan"), 0, 0, 1]]},
+        # beyond float32
+        {"id": 4, "image_id": 1, "category_id": 7, "segmentation": [[0, 0, 1e300, 0, 0, 1]]},
+        {"id": 5, "image_id": 1, "category_id": 7, "bbox": [0, 0, 1, 1]},
+    ]}
+    response = await post_import(client, user.id, zip_archive(), coco=coco)
+    assert response.status_code == 200
+    assert response.json()["bboxes"] == 1
+    assert response.json()["polygons"] == 0
+    assert response.json()["invalid"] == 4
+
+async def test_valid_import_coco_skips_annotations_outside_image(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
+    with PILImage.open(io.BytesIO(IMAGE)) as image:
+        width, height = image.size
+    coco = {**COCO, "annotations": [
+        {"id": 1, "image_id": 1, "category_id": 7, "bbox": [-50, -50, width + 100, height + 100]},
+        {"id": 2, "image_id": 1, "category_id": 7, "segmentation": [[0, 0, width + 1, 0, 0, 1]]},
+        # on the edge is inside
+        {"id": 3, "image_id": 1, "category_id": 7, "bbox": [0, 0, width, height]},
+    ]}
+    response = await post_import(client, user.id, zip_archive(), coco=coco)
+    assert response.status_code == 200
+    assert response.json()["bboxes"] == 1
+    assert response.json()["polygons"] == 0
+    assert response.json()["invalid"] == 2
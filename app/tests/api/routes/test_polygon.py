@@ -1,5 +1,6 @@
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.tests.utils.image import create_test_image
 from app.tests.utils.species import create_test_species
 from app.tests.utils.user import create_test_user
@@ -7,12 +8,15 @@ from app.tests.utils.task import create_test_task
 from app.core.database import TaskType, TaskStatus
 from app.settings import image_domain
 from app.routes.exception import *
+from app import crud
 
-def test_valid_create_polygon(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+pytestmark = pytest.mark.anyio
+
+async def test_valid_create_polygon(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -22,11 +26,11 @@ def test_valid_create_polygon(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -35,16 +39,16 @@ def test_valid_create_polygon(client:TestClient, db:Session):
     )
     assert response.status_code == 200
     assert response.json()["task_id"] == task.id
-    assert response.json()["polygon"] == polygon["polygon"]
+    assert response.json()["points"] == polygon["points"]
     resp_polygon = response.json()
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["polygons"] == [resp_polygon]
 
-def test_invalid_create_polygon_bad_user(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_polygon_bad_user(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -54,11 +58,11 @@ def test_invalid_create_polygon_bad_user(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":-1,
@@ -68,11 +72,11 @@ def test_invalid_create_polygon_bad_user(client:TestClient, db:Session):
     assert response.status_code == 404
     assert response.json()["detail"] == UserNotFoundException.detail
 
-def test_invalid_create_polygon_not_same_user(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_polygon_not_same_user(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user1 = task.created_user
-    user2 = create_test_user(db=db)
-    response = client.put(
+    user2 = await create_test_user(db=db)
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id
@@ -82,11 +86,11 @@ def test_invalid_create_polygon_not_same_user(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user2.id,
@@ -96,14 +100,14 @@ def test_invalid_create_polygon_not_same_user(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationFromNotAcceptedUser.detail
 
-def test_invalid_create_polygon_bad_task(client:TestClient, db:Session):
-    user = create_test_user(db=db)
+async def test_invalid_create_polygon_bad_task(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": -1
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -113,15 +117,15 @@ def test_invalid_create_polygon_bad_task(client:TestClient, db:Session):
     assert response.status_code == 404
     assert response.json()["detail"] == TaskNotFoundException.detail
 
-def test_invalid_create_polygon_pending_task(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_polygon_pending_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -131,17 +135,17 @@ def test_invalid_create_polygon_pending_task(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationToPendingTaskException.detail
 
-def test_invalid_create_polygon_finished_task(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_polygon_finished_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user.id
@@ -149,11 +153,11 @@ def test_invalid_create_polygon_finished_task(client:TestClient, db:Session):
     )
 
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -163,22 +167,22 @@ def test_invalid_create_polygon_finished_task(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddAnnotationToFinishedTaskException.detail
 
-def test_invalid_create_polygon_bad_polygon(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_invalid_create_polygon_bad_polygon(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     polygon = {
-        "bbox":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "bbox":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -187,22 +191,30 @@ def test_invalid_create_polygon_bad_polygon(client:TestClient, db:Session):
     )
     assert response.status_code == 422
 
-def test_invalid_create_polygon_bad_task_type(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    response = await client.post(
+        "/polygon/create",
+        params={"user_id":user.id},
+        headers={"content-type": "application/json"},
+        content='{"points":[[0,0],[NaN,0],[0,1]], "task_id":%d}' % task.id
+    )
+    assert response.status_code == 422
+
+async def test_invalid_create_polygon_bad_task_type(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -212,22 +224,22 @@ def test_invalid_create_polygon_bad_task_type(client:TestClient, db:Session):
     assert response.status_code == 400
     assert response.json()["detail"] == AddPolygonToBboxTaskTypeException.detail
 
-def test_valid_update_polygon(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_valid_update_polygon(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
     # add polygon to task
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -239,36 +251,42 @@ def test_valid_update_polygon(client:TestClient, db:Session):
     polygon = response.json()
 
     # update polygon
-    response = client.put(
+    response = await client.put(
         f"/polygon/update/{polygon["id"]}",
         params={
             "user_id":user.id,
-            "new_polygon":"(1,1),(2,2),(3,3),(4,4),(5,5),(3,3),(10,10)"
-        }
+        },
+        json={"points":[[1,1],[2,2],[3,3],[4,4],[5,5],[3,3],[10,10]]}
     )
     assert response.status_code == 200
-    assert response.json() == {"id":polygon["id"],"polygon":"(1,1),(2,2),(3,3),(4,4),(5,5),(3,3),(10,10)","task_id":polygon["task_id"]}
+    assert response.json() == {
+        "id":polygon["id"],
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5],[3,3],[10,10]],
+        "task_id":polygon["task_id"],
+        "vertex_count":7,
+        "x_min":1, "y_min":1, "x_max":10, "y_max":10
+    }
 
-def test_valid_create_many_polygons(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_valid_create_many_polygons(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     polygon1 = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
     polygon2 = {
-        "polygon":"(6,1),(7,2),(8,3),(9,4),(10,5)",
+        "points":[[6,1],[7,2],[8,3],[9,4],[10,5]],
         "task_id": task.id
     }
     # add polygons to task
-    response = client.post(
+    response = await client.post(
         "/polygon/createmany",
         params={
             "user_id":user.id,
@@ -279,11 +297,11 @@ def test_valid_create_many_polygons(client:TestClient, db:Session):
             ]
     )
     assert response.status_code == 200
-    assert response.json()[0]['polygon'] == polygon1['polygon']
+    assert response.json()[0]['points'] == polygon1['points']
     assert response.json()[0]['task_id'] == polygon1['task_id']
     assert response.json()[0]['id'] == 1
     
-    assert response.json()[1]['polygon'] == polygon2['polygon']
+    assert response.json()[1]['points'] == polygon2['points']
     assert response.json()[1]['task_id'] == polygon2['task_id']
     assert response.json()[1]['id'] == 2
 
@@ -291,30 +309,60 @@ def test_valid_create_many_polygons(client:TestClient, db:Session):
     polygon2["id"]=response.json()[1]['id']
 
     # check task
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.status_code == 200
-    assert response.json()['polygons'] == [polygon1,polygon2]
+    assert [{k:i[k] for k in polygon1} for i in response.json()['polygons']] == [polygon1,polygon2]
 
-def test_invalid_create_many_polygons_bad_task_id(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_valid_get_polygon_vertices(client:AsyncClient, db:AsyncSession):
+    import numpy as np
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    polygon = {
+        "points":[[0.5,1],[2,2],[3,0.25]],
+        "task_id": task.id
+    }
+    response = await client.post(
+        "/polygon/create",
+        params={
+            "user_id":user.id,
+        },
+        json = polygon
+    )
+    assert response.status_code == 200
+    assert response.json()["vertex_count"] == 3
+    assert [response.json()[i] for i in ["x_min", "y_min", "x_max", "y_max"]] == [0.5, 0.25, 3, 2]
+
+    response = await client.get(f"/polygon/{response.json()['id']}/vertices")
+    assert response.status_code == 200
+    assert response.headers["X-Vertex-Count"] == "3"
+    assert np.frombuffer(response.content, dtype="<f4").reshape(-1, 2).tolist() == polygon["points"]
+
+async def test_invalid_create_many_polygons_bad_task_id(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     # accept task
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
         }
     )
     polygon1 = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
     polygon2 = {
-        "polygon":"(6,1),(7,2),(8,3),(9,4),(10,5)",
+        "points":[[6,1],[7,2],[8,3],[9,4],[10,5]],
         "task_id": -1
     }
     # add polygon to task
-    response = client.post(
+    response = await client.post(
         "/polygon/createmany",
         params={
             "user_id":user.id,
@@ -327,11 +375,11 @@ def test_invalid_create_many_polygons_bad_task_id(client:TestClient, db:Session)
     assert response.status_code == 404
     assert response.json()["detail"] == TaskNotFoundException.detail
 
-def test_valid_create_polygon(client:TestClient, db:Session):
-    task = create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+async def test_valid_create_polygon(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
     user = task.created_user
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user.id
@@ -341,11 +389,11 @@ def test_valid_create_polygon(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
 
     polygon = {
-        "polygon":"(1,1),(2,2),(3,3),(4,4),(5,5)",
+        "points":[[1,1],[2,2],[3,3],[4,4],[5,5]],
         "task_id": task.id
     }
 
-    response = client.post(
+    response = await client.post(
         "/polygon/create",
         params={
             "user_id":user.id,
@@ -354,13 +402,13 @@ def test_valid_create_polygon(client:TestClient, db:Session):
     )
     assert response.status_code == 200
     assert response.json()["task_id"] == task.id
-    assert response.json()["polygon"] == polygon["polygon"]
+    assert response.json()["points"] == polygon["points"]
     resp_polygon = response.json()
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["polygons"] == [resp_polygon]
 
-    response = client.delete(
+    response = await client.delete(
         f"/polygon/delete/{resp_polygon["id"]}",
         params={
             "user_id": user.id
@@ -369,12 +417,108 @@ def test_valid_create_polygon(client:TestClient, db:Session):
     assert response.status_code == 200
     assert response.json() == resp_polygon["id"]
 
-    response = client.get(f"/task/{task.id}")
+    response = await client.get(f"/task/{task.id}")
     assert response.json()["polygons"] == []
 
+async def test_valid_get_polygons_in_region(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    response = await client.post(
+        "/polygon/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [
+            {"points":[[0,0],[10,0],[5,10]], "task_id": task.id},
+            {"points":[[8,8],[20,8],[14,20]], "task_id": task.id},
+            {"points":[[50,50],[60,50],[55,60]], "task_id": task.id},
+        ]
+    )
+    assert response.status_code == 200
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.get("/polygon/region", params={"image_id": task.image_id, "x_min": 0, "y_min": 0, "x_max": 9, "y_max": 9})
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == ids[:2]
+
+    response = await client.get(f"/polygon/{ids[2]}/overlapping")
+    assert response.status_code == 200
+    assert response.json()["items"] == []
+
+    # deleted polygon is gone from the index
+    response = await client.delete(
+        f"/polygon/delete/{ids[1]}",
+        params={
+            "user_id": user.id
+        }
+    )
+    response = await client.get(f"/polygon/{ids[0]}/overlapping")
+    assert response.json()["items"] == []
+
+async def test_valid_update_delete_many_polygons(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+    user = task.created_user
+    response = await client.put(
+        f"/task/{task.id}/accept",
+        params={
+            "user_id":user.id
+        }
+    )
+    response = await client.post(
+        "/polygon/createmany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"points":[[i,0],[i+1,0],[i,1]], "task_id": task.id} for i in range(3)]
+    )
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.put(
+        "/polygon/updatemany",
+        params={
+            "user_id":user.id,
+        },
+        json = [{"id": ids[0], "points":[[0,0],[4,0],[4,4],[0,4]]}, {"id": ids[1], "points":[[1,1],[2,1],[2,2]]}]
+    )
+    assert response.status_code == 200
+    assert [(i["id"], i["vertex_count"], i["x_max"]) for i in response.json()] == [(ids[0], 4, 4), (ids[1], 3, 2)]
+    # the spatial index follows the update
+    response = await client.get("/polygon/region", params={"image_id": task.image_id, "x_min": 3.5, "y_min": 3.5, "x_max": 5, "y_max": 5})
+    assert [i["id"] for i in response.json()["items"]] == ids[:1]
+
+    response = await client.request("DELETE", "/polygon/deletemany", params={"user_id":user.id}, json=ids[1:])
+    assert response.status_code == 200
+    assert response.json() == ids[1:]
+    response = await client.get(f"/task/{task.id}")
+    assert [i["id"] for i in response.json()["polygons"]] == ids[:1]
+
+    response = await client.request("DELETE", "/polygon/deletemany", params={"user_id":user.id}, json=ids[1:])
+    assert response.status_code == 404
+    assert response.json()["detail"] == PolygonNotFoundException.detail
+
 # createmany pending taskstatus
 # createmany finished taskstatus
 # createmany wrong tasktype
 # createmany bad user
 # createmany not accepted user
-# delete bad polygon_id
\ No newline at end of file
+# delete bad polygon_id
+async def test_invalid_create_polygon_out_of_image(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+    user = task.created_user
+    await crud.set_image_metadata(db=db, rows=[{"id": task.image_id, "width": 800, "height": 1200, "channels": 3, "format": "JPEG"}])
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+
+    response = await client.post("/polygon/create", params={"user_id":user.id}, json={"points": [[0, 0], [800, 0], [800, 1200]], "task_id": task.id})
+    assert response.status_code == 200
+    response = await client.put(f"/polygon/update/{response.json()['id']}", params={"user_id":user.id}, json={"points": [[0, 0], [900, 0], [800, 1200]]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == AnnotationOutOfImageException.detail
+    response = await client.post("/polygon/create", params={"user_id":user.id}, json={"points": [[0, 0], [800, 0], [400, 1250]], "task_id": task.id})
+    assert response.status_code == 400
+    assert response.json()["detail"] == AnnotationOutOfImageException.detail
@@ -1,10 +1,13 @@
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.tests.utils.species import create_test_species
 
+pytestmark = pytest.mark.anyio
 
-def test_valid_create_species(client: TestClient,db:Session):
-        response = client.post(
+
+async def test_valid_create_species(client: AsyncClient,db:AsyncSession):
+        response = await client.post(
                 "/species/",
                 json={"name":"species"}
         )
@@ -12,23 +15,26 @@ def test_valid_create_species(client: TestClient,db:Session):
         assert response.json()["id"] == 1
         assert response.json()["name"] == "species"
 
-def test_invalid_create_species(client: TestClient, db:Session):
-        species = create_test_species(db=db)
-        response = client.post(
+async def test_invalid_create_species(client: AsyncClient, db:AsyncSession):
+        species = await create_test_species(db=db)
+        response = await client.post(
                 "/species/",
                 json={
                         "name":species.name
                 }
         )
         assert response.status_code==400
+        for name in ["../x", "a/b", ".hidden", ""]:
+                response = await client.post("/species/", json={"name":name})
+                assert response.status_code==422
 
-def test_valid_get_species_by_id(client:TestClient, db:Session):
-        species = create_test_species(db=db)
-        response = client.get(f"/species/{species.id}")
+async def test_valid_get_species_by_id(client:AsyncClient, db:AsyncSession):
+        species = await create_test_species(db=db)
+        response = await client.get(f"/species/{species.id}")
         assert response.status_code == 200
         assert response.json()["id"] == species.id
         assert response.json()["name"] == species.name
 
-def test_invalid_get_species_by_id(client:TestClient, db:Session):
-        response = client.get(f"/species/{1}")
+async def test_invalid_get_species_by_id(client:AsyncClient, db:AsyncSession):
+        response = await client.get(f"/species/{1}")
         assert response.status_code == 404
\ No newline at end of file
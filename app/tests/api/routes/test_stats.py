@@ -0,0 +1,76 @@
+import pytest
+from datetime import datetime, timezone
+from httpx import AsyncClient
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crud
+from app.core import database
+from app.core.database import TaskType, TaskStatus
+from app.schemas import TaskBase
+from app.tests.utils.task import create_test_task
+
+pytestmark = pytest.mark.anyio
+
+
+async def annotate_and_finish(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    # second task stays pending
+    await crud.create_task(db=db, new_task=TaskBase(created_user_id=user.id, task_type=TaskType.poly_annotation, image_id=task.image_id))
+
+    response = await client.post("/task/claim", params={"user_id":user.id, "task_type":TaskType.bbox_annotation.value})
+    assert response.json()["id"] == task.id
+    response = await client.post(
+        "/bbox/createmany",
+        params={"user_id":user.id},
+        json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(3)]
+    )
+    ids = [i["id"] for i in response.json()]
+    response = await client.request("DELETE", "/bbox/deletemany", params={"user_id":user.id}, json=ids[:1])
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"operations": [{"op": "add", "bbox": {"x_min":0, "y_min":0, "x_max":1, "y_max":1}}, {"op": "delete", "id": ids[1]}, {"op": "delete", "id": ids[2]}]}
+    )
+    assert response.status_code == 200
+    response = await client.post("/bbox/create", params={"user_id":user.id}, json={"x_min":0, "y_min":0, "x_max":1, "y_max":1, "task_id": task.id})
+    response = await client.put(f"/task/{task.id}/finish", params={"user_id":user.id})
+    assert response.status_code == 200
+    image = await crud.get_image_by_id(db=db, id=task.image_id)
+    return user, image.species_id
+
+async def check_counts(client:AsyncClient, user_id:int, species_id:int):
+    response = await client.get("/stats/tasks")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"status": TaskStatus.finished.value, "task_type": TaskType.bbox_annotation.value, "count": 1},
+        {"status": TaskStatus.pending.value, "task_type": TaskType.poly_annotation.value, "count": 1},
+    ]
+    response = await client.get("/stats/tasks", params={"task_status": TaskStatus.pending.value})
+    assert [i["task_type"] for i in response.json()] == [TaskType.poly_annotation.value]
+
+    response = await client.get("/stats/annotations", params={"species_id": species_id})
+    assert response.json() == [{"species_id": species_id, "kind": "bbox", "count": 2}]
+
+    today = datetime.now(timezone.utc).date().isoformat()
+    response = await client.get("/stats/finished", params={"date_from": today})
+    assert response.json() == [{"user_id": user_id, "day": today, "count": 1}]
+    response = await client.get("/stats/finished", params={"user_id": user_id + 1})
+    assert response.json() == []
+
+async def test_valid_stats_follow_writes(client:AsyncClient, db:AsyncSession):
+    user, species_id = await annotate_and_finish(client, db)
+    await check_counts(client, user.id, species_id)
+
+async def test_valid_recompute_stats(client:AsyncClient, db:AsyncSession):
+    user, species_id = await annotate_and_finish(client, db)
+    # drift: counters lost
+    for model in [database.TaskCount, database.AnnotationCount, database.FinishedTaskCount]:
+        await db.execute(delete(model))
+    await db.commit()
+    response = await client.get("/stats/tasks")
+    assert response.json() == []
+
+    response = await client.post("/stats/recompute")
+    assert response.status_code == 200
+    await check_counts(client, user.id, species_id)
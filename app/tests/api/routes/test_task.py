@@ -1,17 +1,23 @@
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.tests.utils.image import create_test_image
 from app.tests.utils.user import create_test_user
 from app.tests.utils.task import create_test_task
 from app.core.database import TaskType, TaskStatus
-from app.settings import image_domain
+from app.settings import image_domain, task_lease_seconds
+from app.routes.exception import *
+from app.schemas import ImageBase, TaskBase
+from app import crud
 import os
 
-def test_valid_create_task(client:TestClient, db:Session):
-    image = create_test_image(db=db)
+pytestmark = pytest.mark.anyio
+
+async def test_valid_create_task(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
     user = image.uploaded_user
 
-    response = client.post(
+    response = await client.post(
         "/task/",
         params={
             "created_user_id":user.id,
@@ -25,10 +31,10 @@ def test_valid_create_task(client:TestClient, db:Session):
     assert response.json()["image_id"] == image.id
     assert response.json()["status"] == TaskStatus.pending.value
 
-def test_invalid_image_create_task(client:TestClient, db:Session):
-    user = create_test_user(db=db)
+async def test_invalid_image_create_task(client:AsyncClient, db:AsyncSession):
+    user = await create_test_user(db=db)
 
-    response = client.post(
+    response = await client.post(
         "/task/",
         params={
             "created_user_id":user.id,
@@ -38,10 +44,10 @@ def test_invalid_image_create_task(client:TestClient, db:Session):
     )
     assert response.status_code == 404
 
-def test_invalid_user_create_task(client:TestClient, db:Session):
-    image = create_test_image(db=db)
+async def test_invalid_user_create_task(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
 
-    response = client.post(
+    response = await client.post(
         "/task/",
         params={
             "created_user_id":-1,
@@ -51,11 +57,11 @@ def test_invalid_user_create_task(client:TestClient, db:Session):
     )
     assert response.status_code == 404
 
-def test_invalid_task_type_create_task(client:TestClient, db:Session):
-    image = create_test_image(db=db)
+async def test_invalid_task_type_create_task(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
     user = image.uploaded_user
 
-    response = client.post(
+    response = await client.post(
         "/task/",
         params={
             "created_user_id":user.id,
@@ -65,22 +71,36 @@ def test_invalid_task_type_create_task(client:TestClient, db:Session):
     )
     assert response.status_code == 422
 
-def test_valid_get_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
-    response = client.get(f"/task/{task.id}")
+async def test_valid_get_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    response = await client.get(f"/task/{task.id}")
     assert response.status_code == 200
     assert response.json()["created_user_id"] == task.created_user_id
     assert response.json()["task_type"] == task.task_type.value
     assert response.json()["image_id"] == task.image_id
 
-def test_invalid_id_get_task(client:TestClient, db:Session):
-    response = client.get(f"/task/{1}")
+async def test_valid_get_tasks(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    response = await client.get("/task/", params={"task_status": TaskStatus.pending.value})
+    assert response.status_code == 200
+    assert [i["id"] for i in response.json()["items"]] == [task.id]
+    assert response.json()["next_cursor"] is None
+    # list view does not load nested objects
+    assert "image" not in response.json()["items"][0]
+    assert "bboxes" not in response.json()["items"][0]
+
+    response = await client.get("/task/", params={"task_status": TaskStatus.accepted.value})
+    assert response.status_code == 200
+    assert response.json() == {"items": [], "next_cursor": None}
+
+async def test_invalid_id_get_task(client:AsyncClient, db:AsyncSession):
+    response = await client.get(f"/task/{1}")
     assert response.status_code == 404
 
-def test_valid_accept_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_valid_accept_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     assert task.status.value == TaskStatus.pending.value
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":task.created_user_id,
@@ -90,13 +110,13 @@ def test_valid_accept_task(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
     assert response.json()["accepted_user_id"] == task.created_user_id
 
-def test_invalid_already_accepted_accept_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_already_accepted_accept_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
-    user2 = create_test_user(db=db)
+    user2 = await create_test_user(db=db)
     
     assert task.status.value == TaskStatus.pending.value
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -104,7 +124,7 @@ def test_invalid_already_accepted_accept_task(client:TestClient, db:Session):
     )
     assert response.status_code == 200
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user2.id,
@@ -112,12 +132,12 @@ def test_invalid_already_accepted_accept_task(client:TestClient, db:Session):
     )
     assert response.status_code == 400
 
-def test_invalid_already_accepted_same_user_accept_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_already_accepted_same_user_accept_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
     
     assert task.status.value == TaskStatus.pending.value
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -125,7 +145,7 @@ def test_invalid_already_accepted_same_user_accept_task(client:TestClient, db:Se
     )
     assert response.status_code == 200
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -133,9 +153,9 @@ def test_invalid_already_accepted_same_user_accept_task(client:TestClient, db:Se
     )
     assert response.status_code == 400
 
-def test_invalid_task_id_accept_task(client:TestClient, db:Session):
-    user1 = create_test_user(db=db)
-    response = client.put(
+async def test_invalid_task_id_accept_task(client:AsyncClient, db:AsyncSession):
+    user1 = await create_test_user(db=db)
+    response = await client.put(
         f"/task/-1/accept",
         params={
             "user_id":user1.id,
@@ -143,9 +163,9 @@ def test_invalid_task_id_accept_task(client:TestClient, db:Session):
     )
     assert response.status_code == 404
 
-def test_invalid_user_id_accept_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
-    response = client.put(
+async def test_invalid_user_id_accept_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":-1,
@@ -153,25 +173,25 @@ def test_invalid_user_id_accept_task(client:TestClient, db:Session):
     )
     assert response.status_code == 404
 
-def test_invalid_accept_finished_accept_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_accept_finished_accept_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
         }
     )
     assert response.status_code == 200
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
         }
     )
     assert response.status_code == 200
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
@@ -180,12 +200,12 @@ def test_invalid_accept_finished_accept_task(client:TestClient, db:Session):
     assert response.status_code == 400
 
 
-def test_valid_finish_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_valid_finish_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
     assert task.status.value == TaskStatus.pending.value
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -196,7 +216,7 @@ def test_valid_finish_task(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
     assert response.json()["accepted_user_id"] == user1.id
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
@@ -206,14 +226,14 @@ def test_valid_finish_task(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.finished.value
     assert response.json()["accepted_user_id"] == user1.id
 
-def test_invalid_another_user_finish_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_another_user_finish_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
-    user2 = create_test_user(db=db)
+    user2 = await create_test_user(db=db)
 
     assert task.status.value == TaskStatus.pending.value
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -224,7 +244,7 @@ def test_invalid_another_user_finish_task(client:TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
     assert response.json()["accepted_user_id"] == user1.id
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user2.id,
@@ -232,10 +252,10 @@ def test_invalid_another_user_finish_task(client:TestClient, db:Session):
     )
     assert response.status_code == 401
 
-def test_invalid_task_id_finish_task(client:TestClient, db:Session):
-    user1 = create_test_user(db=db)
+async def test_invalid_task_id_finish_task(client:AsyncClient, db:AsyncSession):
+    user1 = await create_test_user(db=db)
 
-    response = client.put(
+    response = await client.put(
         f"/task/-1/finish",
         params={
             "user_id":user1.id,
@@ -244,12 +264,12 @@ def test_invalid_task_id_finish_task(client:TestClient, db:Session):
 
     assert response.status_code == 404
 
-def test_invalid_user_id_finish_task(client:TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_user_id_finish_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
 
     assert task.status.value == TaskStatus.pending.value
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":-1,
@@ -258,13 +278,13 @@ def test_invalid_user_id_finish_task(client:TestClient, db:Session):
 
     assert response.status_code == 404
 
-def test_invalid_finish_not_accepted_task(client: TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_finish_not_accepted_task(client: AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
     
     assert task.status.value == TaskStatus.pending.value
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
@@ -273,12 +293,12 @@ def test_invalid_finish_not_accepted_task(client: TestClient, db:Session):
 
     assert response.status_code == 400
 
-def test_invalid_finish_finished_task(client: TestClient, db:Session):
-    task = create_test_task(db=db)
+async def test_invalid_finish_finished_task(client: AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
     user1 = task.created_user
     assert task.status.value == TaskStatus.pending.value
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/accept",
         params={
             "user_id":user1.id,
@@ -289,7 +309,7 @@ def test_invalid_finish_finished_task(client: TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.accepted.value
     assert response.json()["accepted_user_id"] == user1.id
 
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
@@ -299,10 +319,303 @@ def test_invalid_finish_finished_task(client: TestClient, db:Session):
     assert response.json()["status"] == TaskStatus.finished.value
     assert response.json()["accepted_user_id"] == user1.id
     
-    response = client.put(
+    response = await client.put(
         f"/task/{task.id}/finish",
         params={
             "user_id":user1.id,
         }
     )
     assert response.status_code == 400
+
+async def test_valid_claim_task(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    # older task of another type and a newer one of the same type
+    for task_type in [TaskType.poly_annotation, TaskType.bbox_annotation]:
+        await crud.create_task(db=db, new_task=TaskBase(created_user_id=task.created_user_id, task_type=task_type, image_id=task.image_id))
+    user = await create_test_user(db=db)
+
+    response = await client.post(
+        "/task/claim",
+        params={
+            "user_id":user.id,
+            "task_type":TaskType.bbox_annotation.value,
+            "species_id":(await crud.get_image_by_id(db=db, id=task.image_id)).species_id,
+        }
+    )
+    assert response.status_code == 200
+    assert response.json()["id"] == task.id
+    assert response.json()["status"] == TaskStatus.accepted.value
+    assert response.json()["accepted_user_id"] == user.id
+
+    response = await client.post("/task/claim", params={"user_id":user.id, "task_type":TaskType.poly_annotation.value})
+    assert response.status_code == 200
+    assert response.json()["task_type"] == TaskType.poly_annotation.value
+
+    response = await client.post("/task/claim", params={"user_id":user.id, "task_type":TaskType.poly_annotation.value})
+    assert response.status_code == 404
+    assert response.json()["detail"] == NoPendingTaskException.detail
+
+    response = await client.post("/task/claim", params={"user_id":user.id, "species_id":-1})
+    assert response.status_code == 404
+
+async def test_valid_claim_task_concurrent(client:AsyncClient, db:AsyncSession):
+    import asyncio
+    task = await create_test_task(db=db)
+    for _ in range(4):
+        await crud.create_task(db=db, new_task=TaskBase(created_user_id=task.created_user_id, task_type=task.task_type, image_id=task.image_id))
+
+    responses = await asyncio.gather(*[client.post("/task/claim", params={"user_id":task.created_user_id}) for _ in range(8)])
+    claimed = [i.json()["id"] for i in responses if i.status_code == 200]
+    # every task claimed exactly once
+    assert len(claimed) == 5
+    assert len(set(claimed)) == 5
+    assert [i.status_code for i in responses].count(404) == 3
+
+async def test_invalid_user_id_claim_task(client:AsyncClient, db:AsyncSession):
+    await create_test_task(db=db)
+    response = await client.post("/task/claim", params={"user_id":-1})
+    assert response.status_code == 404
+    assert response.json()["detail"] == UserNotFoundException.detail
+
+async def test_valid_patch_annotations(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+    response = await client.post(
+        "/bbox/createmany",
+        params={"user_id":user.id},
+        json = [{"x_min":i, "y_min":i, "x_max":i+1, "y_max":i+1, "task_id": task.id} for i in range(2)]
+    )
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"revision": 0, "operations": [
+            {"op": "add", "bbox": {"x_min":10, "y_min":10, "x_max":20, "y_max":20}},
+            {"op": "update", "id": ids[0], "bbox": {"x_min":0, "y_min":0, "x_max":5, "y_max":5, "label":"hen"}},
+            {"op": "update", "id": ids[1], "bbox": {"x_min":0, "y_min":0, "x_max":6, "y_max":6}},
+            {"op": "delete", "id": ids[1]},
+            {"op": "add", "bbox": {"x_min":30, "y_min":30, "x_max":40, "y_max":40}},
+        ]}
+    )
+    assert response.status_code == 200
+    assert response.json()["revision"] == 1
+    added = response.json()["added"]
+    assert len(added) == 2
+
+    response = await client.get(f"/task/{task.id}")
+    assert response.json()["revision"] == 1
+    assert [(i["id"], i["x_max"], i["label"]) for i in response.json()["bboxes"]] == [(ids[0], 5, "hen"), (added[0], 20, None), (added[1], 40, None)]
+
+    # another editor saved revision 0 meanwhile
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"revision": 0, "operations": [{"op": "delete", "id": ids[0]}]}
+    )
+    assert response.status_code == 409
+    assert response.json()["detail"] == TaskRevisionConflictException.detail
+
+    # without revision the patch is applied as is
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"operations": [{"op": "delete", "id": ids[0]}]}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"revision": 2, "added": []}
+
+async def test_valid_patch_polygons(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.poly_annotation.value)
+    user = task.created_user
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"operations": [{"op": "add", "polygon": {"points": [[0,0],[4,0],[0,3]]}}]}
+    )
+    assert response.status_code == 200
+    polygon_id = response.json()["added"][0]
+
+    response = await client.get(f"/polygon/{polygon_id}")
+    assert response.json()["points"] == [[0,0],[4,0],[0,3]]
+    assert response.json()["x_max"] == 4
+
+    response = await client.patch(
+        f"/task/{task.id}/annotations",
+        params={"user_id":user.id},
+        json={"operations": [{"op": "add", "bbox": {"x_min":0, "y_min":0, "x_max":1, "y_max":1}}]}
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == AddBboxToPolygonTaskTypeException.detail
+
+async def test_invalid_patch_annotations(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+    response = await client.post(
+        "/bbox/create",
+        params={"user_id":user.id},
+        json = {"x_min":0, "y_min":0, "x_max":1, "y_max":1, "task_id": task.id}
+    )
+    bbox_id = response.json()["id"]
+    bbox = {"x_min":0, "y_min":0, "x_max":2, "y_max":2}
+
+    # all or nothing, nothing applied on any error
+    for operations, status_code in [
+        ([{"op": "delete", "id": bbox_id}, {"op": "update", "id": bbox_id, "bbox": bbox}], 404),
+        ([{"op": "add", "bbox": bbox}, {"op": "delete", "id": -1}], 404),
+        ([{"op": "add", "bbox": bbox}, {"op": "add", "polygon": {"points": [[0,0],[1,0],[0,1]]}}], 422),
+        ([{"op": "update", "bbox": bbox}], 422),
+        ([{"op": "delete", "id": bbox_id, "bbox": bbox}], 422),
+    ]:
+        response = await client.patch(f"/task/{task.id}/annotations", params={"user_id":user.id}, json={"operations": operations})
+        assert response.status_code == status_code, operations
+
+    response = await client.get(f"/task/{task.id}")
+    assert response.json()["revision"] == 0
+    assert [i["id"] for i in response.json()["bboxes"]] == [bbox_id]
+
+    user2 = await create_test_user(db=db)
+    response = await client.patch(f"/task/{task.id}/annotations", params={"user_id":user2.id}, json={"operations": [{"op": "delete", "id": bbox_id}]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == AddAnnotationFromNotAcceptedUser.detail
+
+async def test_valid_heartbeat_task(client:AsyncClient, db:AsyncSession):
+    from datetime import datetime
+    task = await create_test_task(db=db)
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":task.created_user_id})
+    assert response.status_code == 200
+    # sqlite does not keep the timezone
+    expires_at = datetime.fromisoformat(response.json()["expires_at"]).replace(tzinfo=None)
+    accepted_at = datetime.fromisoformat(response.json()["accepted_at"]).replace(tzinfo=None)
+    assert (expires_at - accepted_at).total_seconds() == task_lease_seconds
+
+    response = await client.put(f"/task/{task.id}/heartbeat", params={"user_id":task.created_user_id})
+    assert response.status_code == 200
+    assert datetime.fromisoformat(response.json()["expires_at"]).replace(tzinfo=None) > expires_at
+
+    user2 = await create_test_user(db=db)
+    response = await client.put(f"/task/{task.id}/heartbeat", params={"user_id":user2.id})
+    assert response.status_code == 400
+    assert response.json()["detail"] == TaskLeaseNotHeldException.detail
+
+    response = await client.put(f"/task/{-1}/heartbeat", params={"user_id":user2.id})
+    assert response.status_code == 404
+
+    response = await client.put(f"/task/{task.id}/finish", params={"user_id":task.created_user_id})
+    assert response.json()["expires_at"] is None
+    response = await client.put(f"/task/{task.id}/heartbeat", params={"user_id":task.created_user_id})
+    assert response.status_code == 400
+
+async def test_valid_release_expired_tasks(client:AsyncClient, db:AsyncSession):
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import update
+    from app.core.database import Task as TaskModel
+    task = await create_test_task(db=db)
+    tasks = [task] + [
+        await crud.create_task(db=db, new_task=TaskBase(created_user_id=task.created_user_id, task_type=task.task_type, image_id=task.image_id))
+        for _ in range(3)
+    ]
+    for t in tasks:
+        await crud.accept_task(db=db, id=t.id, user_id=task.created_user_id)
+    now = datetime.now(timezone.utc)
+    # first three abandoned
+    await db.execute(update(TaskModel).where(TaskModel.id.in_([t.id for t in tasks[:3]])).values(expires_at=now - timedelta(minutes=1)))
+    await db.commit()
+
+    assert await crud.release_expired_tasks(db=db, now=now, batch_size=2) == 3
+    assert await crud.release_expired_tasks(db=db, now=now, batch_size=2) == 0
+
+    response = await client.get("/task/", params={"task_status": TaskStatus.pending.value})
+    assert [i["id"] for i in response.json()["items"]] == [t.id for t in tasks[:3]]
+    assert response.json()["items"][0]["accepted_user_id"] is None
+    assert response.json()["items"][0]["expires_at"] is None
+
+    response = await client.get("/task/", params={"task_status": TaskStatus.accepted.value})
+    assert [i["id"] for i in response.json()["items"]] == [tasks[3].id]
+
+async def test_valid_get_tasks_priority_order(client:AsyncClient, db:AsyncSession):
+    task = await create_test_task(db=db)
+    tasks = [task] + [
+        await crud.create_task(db=db, new_task=TaskBase(created_user_id=task.created_user_id, task_type=task.task_type, image_id=task.image_id, priority=priority))
+        for priority in [5, 0, 5, 10]
+    ]
+    expected = [tasks[4].id, tasks[1].id, tasks[3].id, tasks[0].id, tasks[2].id]
+
+    ids, cursor = [], None
+    while True:
+        response = await client.get("/task/", params={"task_status": TaskStatus.pending.value, "limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        ids += [i["id"] for i in response.json()["items"]]
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == expected
+
+    response = await client.post("/task/claim", params={"user_id":task.created_user_id})
+    assert response.json()["id"] == tasks[4].id
+    assert response.json()["priority"] == 10
+
+async def test_valid_create_task_species_priority(client:AsyncClient, db:AsyncSession):
+    image = await create_test_image(db=db)
+    response = await client.post("/species/", json={"name": "urgent", "priority": 7})
+    assert response.status_code == 200
+    image2 = await crud.create_image(db=db, image=ImageBase(species_id=response.json()["id"], uploaded_user_id=image.uploaded_user.id, path=image.path+".copy"))
+
+    response = await client.post("/task/", params={"created_user_id": image.uploaded_user.id, "task_type": TaskType.bbox_annotation.value, "image_id": image2.id})
+    assert response.status_code == 200
+    assert response.json()["priority"] == 7
+
+    response = await client.post("/task/", params={"created_user_id": image.uploaded_user.id, "task_type": TaskType.bbox_annotation.value, "image_id": image.id})
+    assert response.json()["priority"] == 0
+
+    response = await client.post("/task/", params={"created_user_id": image.uploaded_user.id, "task_type": TaskType.bbox_annotation.value, "image_id": image2.id, "priority": -1})
+    assert response.json()["priority"] == -1
+
+async def test_valid_get_task_crops(client:AsyncClient, db:AsyncSession, monkeypatch):
+    import io
+    import zipfile
+    from PIL import Image as PILImage
+    from app.core import crops
+    monkeypatch.setattr(crops, "cache", crops.DecodedCache(64 * 1024**2))
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    user = task.created_user
+    response = await client.put(f"/task/{task.id}/accept", params={"user_id":user.id})
+    response = await client.post(
+        "/bbox/createmany",
+        params={"user_id":user.id},
+        json = [{"x_min":10*i, "y_min":10*i, "x_max":10*i+20, "y_max":10*i+30, "task_id": task.id} for i in range(3)]
+    )
+    ids = [i["id"] for i in response.json()]
+
+    response = await client.get(f"/task/{task.id}/crops", params={"pad": 5})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.namelist() == [f"{i}.jpg" for i in ids]
+        # the first box is cut at the image corner
+        sizes = [PILImage.open(io.BytesIO(archive.read(f"{i}.jpg"))).size for i in ids]
+    assert sizes == [(25, 35), (30, 40), (30, 40)]
+    # one decode for the whole task
+    assert len(crops.cache._images) == 1
+
+    response = await client.get(f"/task/0/crops")
+    assert response.status_code == 404
+
+async def test_invalid_get_task_crops_bad_file(client:AsyncClient, db:AsyncSession, monkeypatch):
+    import os
+    from app.core import crops
+    from app.settings import image_domain
+    monkeypatch.setattr(crops, "cache", crops.DecodedCache(64 * 1024**2))
+    task = await create_test_task(db=db, task_type=TaskType.bbox_annotation.value)
+    image = await crud.get_image_by_id(db=db, id=task.image_id)
+    with open(image_domain + image.path, "w") as file:
+        file.write("not an image")
+    response = await client.get(f"/task/{task.id}/crops")
+    assert response.status_code == 415
+
+    os.remove(image_domain + image.path)
+    response = await client.get(f"/task/{task.id}/crops")
+    assert response.status_code == 404
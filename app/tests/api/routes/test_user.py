@@ -1,42 +1,62 @@
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.tests.utils.task import create_test_task
 from app.routes.exception import *
 
+pytestmark = pytest.mark.anyio
 
-def test_valid_create_user(
-        client: TestClient,
-        db:Session
+
+async def test_valid_create_user(
+        client: AsyncClient,
+        db:AsyncSession
 ):
-        response = client.post(
+        response = await client.post(
                 "/user/",
                 json={"username":"test","email":"test@email.com","hashed_password":"pass"}
         )
         assert response.status_code==200
 
-def test_invalid_create_user_bad_email(db:Session, client: TestClient):
-        response = client.post(
+async def test_invalid_create_user_bad_email(db:AsyncSession, client: AsyncClient):
+        response = await client.post(
                 "/user/",
                 json={"username":"test","email":"test@email.com","hashed_password":"pass"}
         )
         assert response.status_code==200
         
-        response = client.post(
+        response = await client.post(
                 "/user/",
                 json={"username":"test2","email":"test@email.com","hashed_password":"pass"}
         )
         assert response.status_code==400
         assert response.json()["detail"] == UserExistedException.detail
 
-def test_invalid_create_user_bad_username(db:Session, client: TestClient):
-        response = client.post(
+async def test_invalid_create_user_bad_username(db:AsyncSession, client: AsyncClient):
+        response = await client.post(
                 "/user/",
                 json={"username":"test","email":"test@email.com","hashed_password":"pass"}
         )
         assert response.status_code==200
         
-        response = client.post(
+        response = await client.post(
                 "/user/",
                 json={"username":"test","email":"test2@email.com","hashed_password":"pass"}
         )
         assert response.status_code==400
         assert response.json()["detail"] == UserExistedException.detail
+
+async def test_valid_get_user(client: AsyncClient, db:AsyncSession):
+        task = await create_test_task(db=db)
+        user = task.created_user
+
+        response = await client.get(f"/user/{user.id}")
+        assert response.status_code == 200
+        assert response.json()["id"] == user.id
+        assert [i["id"] for i in response.json()["uploaded_images"]] == [task.image_id]
+        assert [i["id"] for i in response.json()["created_tasks"]] == [task.id]
+        assert response.json()["accepted_tasks"] == []
+
+async def test_invalid_get_user(client: AsyncClient, db:AsyncSession):
+        response = await client.get(f"/user/{1}")
+        assert response.status_code == 404
+        assert response.json()["detail"] == UserNotFoundException.detail
@@ -1,45 +1,57 @@
+import os
+# tests delete every row, keep them away from the real database
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "sqlite+aiosqlite:///test_database.db")
+# and derived files away from the real caches
+import tempfile
+os.environ["THUMBNAIL_DIR"] = tempfile.mkdtemp(prefix="thumbnails-")
+os.environ["TILE_CACHE_DIR"] = tempfile.mkdtemp(prefix="tiles-")
+
 import pytest
-from fastapi.testclient import TestClient
 from sqlalchemy import delete
-from sqlalchemy.orm import Session
-from collections.abc import Generator
+from sqlalchemy.ext.asyncio import AsyncSession
+from collections.abc import AsyncGenerator
 from httpx import ASGITransport, AsyncClient
 from glob import glob
-import os
 from app.main import app
-from app.core.database import engine
+from app.core.database import SessionLocal
 from app.core import database
 from app.settings import image_domain
 
 
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
 @pytest.fixture(scope="function", autouse=True)
-def db() -> Generator[Session,None,None]:
-    with Session(engine) as session:
+async def db(client:AsyncClient) -> AsyncGenerator[AsyncSession,None]:
+    # client runs the app lifespan which migrates the schema
+    async with SessionLocal() as session:
         yield session
-        session.rollback()
+        await session.rollback()
         stmt = delete(database.Image)
-        session.execute(stmt)
+        await session.execute(stmt)
         stmt = delete(database.User)
-        session.execute(stmt)
+        await session.execute(stmt)
         stmt = delete(database.Species)
-        session.execute(stmt)
+        await session.execute(stmt)
         stmt = delete(database.Task)
-        session.execute(stmt)
+        await session.execute(stmt)
         stmt = delete(database.BboxAnnotation)
-        session.execute(stmt)
+        await session.execute(stmt)
         stmt = delete(database.PolyAnnotation)
-        session.execute(stmt)
-        session.commit()
+        await session.execute(stmt)
+        for model in [database.TaskCount, database.AnnotationCount, database.FinishedTaskCount]:
+            await session.execute(delete(model))
+        await session.commit()
 
 
 @pytest.fixture(scope="module")
-def client() -> Generator[TestClient,None,None]:
-    with TestClient(app) as c:
-        yield c
-    # with Client(transport=WSGITransport(app=app), base_url="http://test") as c:
-    #     yield c
-    # async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
-    #     yield c
+async def client() -> AsyncGenerator[AsyncClient,None]:
+    # ASGITransport does not send lifespan events, so run the app lifespan here
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
+            yield c
 
 @pytest.fixture(autouse=True)
 def run_before_and_after_tests(tmpdir):
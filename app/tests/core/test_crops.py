@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+from app.core import crops, imaging
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_valid_decoded_cache_evicts_least_recently_used(monkeypatch):
+    source = "app/tests/data/test_image.jpg"
+    decodes, decode = [], imaging.decode
+    def counted(path):
+        decodes.append(path)
+        return decode(path)
+    monkeypatch.setattr(imaging, "decode", counted)
+    # room for two 800x1200 RGB images
+    cache = crops.DecodedCache(2 * 800 * 1200 * 3)
+
+    # concurrent requests share one decode
+    images = await asyncio.gather(cache.get("a", source), cache.get("a", source))
+    assert images[0] is images[1]
+    assert images[0].size == (800, 1200)
+    await cache.get("b", source)
+    # a was used after b so b goes
+    await cache.get("a", source)
+    await cache.get("c", source)
+    assert list(cache._images) == ["a", "c"]
+    assert len(decodes) == 3
+
+async def test_valid_crop_box():
+    assert imaging.crop_box((800, 1200), 10.5, 20, 30, 40.2, pad=2) == (8, 18, 32, 43)
+    assert imaging.crop_box((800, 1200), -10, -10, 900, 1300) == (0, 0, 800, 1200)
+    assert imaging.crop_box((800, 1200), 800, 0, 900, 10) is None
@@ -0,0 +1,24 @@
+import os
+import pytest
+from sqlalchemy import select
+from app import crud
+from app.core import metadata
+from app.core.database import Image
+from app.schemas import ImageBase
+from app.tests.utils.image import create_test_image
+from app.settings import image_domain
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_valid_backfill_metadata(db):
+    image = await create_test_image(db=db)
+    # a file that is not an image and an image whose file is gone
+    with open(image_domain + "/test_species/notes.jpg", "wb") as out:
+        out.write(b"not an image")
+    unreadable = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=image.uploaded_user_id, path="/test_species/notes.jpg"))
+    missing = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=image.uploaded_user_id, path="/test_species/missing.jpg"))
+
+    assert await metadata.backfill(batch_size=2, workers=2) == {"read": 1, "missing": 1, "unreadable": 1}
+    rows = (await db.execute(select(Image.id, Image.width, Image.height, Image.channels, Image.format).order_by(Image.id))).all()
+    assert [tuple(i) for i in rows] == [(image.id, 800, 1200, 3, "JPEG"), (unreadable.id, None, None, None, None), (missing.id, None, None, None, None)]
@@ -0,0 +1,222 @@
+import pytest
+from datetime import datetime, timezone
+from httpx import AsyncClient
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app import crud
+from app.core import migrations
+from app.core.database import Base, TaskStatus, TaskType
+from app.core.geometry import unpack_vertices
+
+pytestmark = pytest.mark.anyio
+
+
+def indexes(conn, table:str) -> set[str]:
+    return {i["name"] for i in inspect(conn).get_indexes(table)}
+
+async def test_valid_upgrade_new_database(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/new.db")
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrations.upgrade) == migrations.LATEST_VERSION
+        assert await conn.run_sync(migrations.get_version) == migrations.LATEST_VERSION
+        assert "ix_task_status_task_type_priority_id" in await conn.run_sync(indexes, "task")
+    await engine.dispose()
+
+async def test_valid_upgrade_keeps_data(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/old.db")
+    # database created by create_all before migrations existed
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for index in ["ix_task_status_task_type_priority_id", "ix_task_image_id", "ix_image_species_id_id", "ix_bbox_annotation_task_id_id", "ix_poly_annotation_task_id_id", "ix_user_username"]:
+            await conn.execute(text(f"DROP INDEX {index}"))
+        await conn.execute(text("INSERT INTO species (name) VALUES ('gallus gallus')"))
+
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrations.get_version) is None
+        await conn.run_sync(migrations.upgrade)
+        assert await conn.run_sync(migrations.get_version) == migrations.LATEST_VERSION
+        assert {"ix_task_status_task_type_priority_id", "ix_task_image_id"} <= await conn.run_sync(indexes, "task")
+        assert "ix_bbox_annotation_task_id_id" in await conn.run_sync(indexes, "bbox_annotation")
+        assert (await conn.execute(text("SELECT name FROM species"))).scalar() == "gallus gallus"
+
+    # nothing to apply second time
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrations.upgrade) == migrations.LATEST_VERSION
+    await engine.dispose()
+
+async def test_hot_queries_use_indexes(client:AsyncClient, db:AsyncSession):
+    if db.bind.dialect.name != "sqlite":
+        pytest.skip("EXPLAIN QUERY PLAN is sqlite only")
+
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.bind.sync_engine, "before_cursor_execute", capture)
+    try:
+        await crud.get_tasks(db=db, task_status=TaskStatus.pending)
+        await crud.get_tasks(db=db, task_type=TaskType.bbox_annotation, after=(0, 100))
+        await crud.get_tasks(db=db, after=(5, 100))
+        await crud.get_tasks(db=db, task_status=TaskStatus.pending, task_type=TaskType.bbox_annotation, after=(5, 100))
+        await crud.claim_task(db=db, user_id=1, task_type=TaskType.bbox_annotation)
+        await crud.get_tasks(db=db, task_status=TaskStatus.pending, task_type=TaskType.bbox_annotation)
+        await crud.get_tasks_by_image(db=db, image_id=1)
+        await crud.get_images(db=db, species_id=1)
+        await crud.get_bboxes(db=db, task_id=1, after_id=100)
+        await crud.get_polygons(db=db, task_id=1)
+        await crud.get_user_by_username(db=db, username="test")
+        await crud.get_user_by_email(db=db, email="test@gmail.com")
+        await crud.get_bboxes_in_region(db=db, image_id=1, x_min=0, y_min=0, x_max=10, y_max=10, after_id=100)
+        await crud.get_polygons_in_region(db=db, image_id=1, x_min=0, y_min=0, x_max=10, y_max=10)
+        await crud.release_expired_tasks(db=db, now=datetime.now(timezone.utc))
+    finally:
+        event.remove(db.bind.sync_engine, "before_cursor_execute", capture)
+
+    conn = await db.connection()
+    for statement, parameters in statements:
+        plan = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)).all()
+        # keyset pages must also come out of the index already ordered
+        # R*Tree searches show up as "SCAN ... VIRTUAL TABLE INDEX 2:<constraints>"
+        scans = [row[-1] for row in plan if (row[-1].startswith("SCAN") and "VIRTUAL TABLE INDEX 2:" not in row[-1]) or "TEMP B-TREE" in row[-1]]
+        assert not scans, f"{statement} -> {scans}"
+
+async def test_valid_migrate_concurrent_workers(tmp_path):
+    import asyncio
+    engines = [create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/workers.db") for _ in range(4)]
+    versions = await asyncio.gather(*[migrations.migrate(engine) for engine in engines])
+    assert versions == [migrations.LATEST_VERSION]*4
+
+    async with engines[0].connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM schema_version"))).scalar() == 1
+    for engine in engines:
+        await engine.dispose()
+
+async def test_valid_migrate_current_schema_skips_ddl(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/current.db")
+    await migrations.migrate(engine)
+
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    assert await migrations.migrate(engine) == migrations.LATEST_VERSION
+    event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+    assert not [i for i in statements if not i.lstrip().upper().startswith(("SELECT", "PRAGMA"))]
+    await engine.dispose()
+
+async def test_valid_upgrade_converts_text_bboxes(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/bbox.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # bbox_annotation as it was at version 2
+        await conn.execute(text("DROP TABLE bbox_annotation"))
+        await conn.execute(text("CREATE TABLE bbox_annotation (id INTEGER PRIMARY KEY, bbox VARCHAR NOT NULL, task_id INTEGER NOT NULL REFERENCES task(id))"))
+        await conn.execute(text("INSERT INTO bbox_annotation (bbox, task_id) VALUES ('(12.3, 34.3), (23,56.3)', 1), ('(13,13),(0.5, 0.5)', 1)"))
+        await conn.execute(text("UPDATE schema_version SET version = 2"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        rows = (await conn.execute(text("SELECT x_min, y_min, x_max, y_max FROM bbox_annotation ORDER BY id"))).all()
+        assert [tuple(i) for i in rows] == [(12.3, 34.3, 23, 56.3), (0.5, 0.5, 13, 13)]
+        columns = await conn.run_sync(lambda conn: {i["name"] for i in inspect(conn).get_columns("bbox_annotation")})
+        assert "bbox" not in columns
+    await engine.dispose()
+
+async def test_valid_upgrade_converts_text_polygons(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/polygon.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # poly_annotation as it was at version 3
+        await conn.execute(text("DROP TABLE poly_annotation"))
+        await conn.execute(text("CREATE TABLE poly_annotation (id INTEGER PRIMARY KEY, polygon VARCHAR NOT NULL, task_id INTEGER NOT NULL REFERENCES task(id))"))
+        await conn.execute(text("INSERT INTO poly_annotation (polygon, task_id) VALUES ('(1,1),(2.5,2),(3,-3)', 1)"))
+        await conn.execute(text("UPDATE schema_version SET version = 3"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        row = (await conn.execute(text("SELECT vertices, vertex_count, x_min, y_min, x_max, y_max FROM poly_annotation"))).one()
+        assert unpack_vertices(row.vertices).tolist() == [[1, 1], [2.5, 2], [3, -3]]
+        assert (row.vertex_count, row.x_min, row.y_min, row.x_max, row.y_max) == (3, 1, -3, 3, 2)
+    await engine.dispose()
+
+async def test_valid_upgrade_builds_spatial_index(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/spatial.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # database at version 4, annotations without spatial index
+        for table in ["bbox_annotation", "poly_annotation"]:
+            await conn.execute(text(f"DROP TABLE {table}_rtree"))
+            for trigger in ["insert", "update", "delete"]:
+                await conn.execute(text(f"DROP TRIGGER {table}_rtree_{trigger}"))
+        await conn.execute(text("INSERT INTO task (id, task_type, status, image_id, created_user_id, created_at) VALUES (1, 'bbox_annotation', 'pending', 7, 1, '2024-01-01')"))
+        await conn.execute(text("INSERT INTO bbox_annotation (x_min, y_min, x_max, y_max, task_id) VALUES (1, 2, 3, 4, 1)"))
+        await conn.execute(text("UPDATE schema_version SET version = 4"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        row = (await conn.execute(text("SELECT image_min, x_min, y_min, x_max, y_max FROM bbox_annotation_rtree"))).one()
+        assert tuple(row) == (7, 1, 2, 3, 4)
+        # kept in sync from now on
+        await conn.execute(text("DELETE FROM bbox_annotation"))
+        assert (await conn.execute(text("SELECT count(*) FROM bbox_annotation_rtree"))).scalar() == 0
+    await engine.dispose()
+
+async def test_valid_upgrade_gives_accepted_tasks_a_lease(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/lease.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # task as it was at version 6
+        await conn.execute(text("DROP INDEX ix_task_status_expires_at"))
+        await conn.execute(text("ALTER TABLE task DROP COLUMN expires_at"))
+        await conn.execute(text("INSERT INTO task (task_type, status, image_id, created_user_id, created_at) VALUES ('bbox_annotation', 'accepted', 1, 1, '2024-01-01'), ('bbox_annotation', 'pending', 1, 1, '2024-01-01')"))
+        await conn.execute(text("UPDATE schema_version SET version = 6"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        assert "ix_task_status_expires_at" in await conn.run_sync(indexes, "task")
+        rows = (await conn.execute(text("SELECT status, expires_at IS NOT NULL FROM task ORDER BY id"))).all()
+        assert [tuple(i) for i in rows] == [("accepted", 1), ("pending", 0)]
+    await engine.dispose()
+
+async def test_valid_upgrade_adds_image_sha256(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/sha256.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # image as it was at version 9
+        await conn.execute(text("DROP INDEX ix_image_sha256"))
+        await conn.execute(text("ALTER TABLE image DROP COLUMN sha256"))
+        await conn.execute(text("UPDATE schema_version SET version = 9"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        unique = {i["name"]: i["unique"] for i in await conn.run_sync(lambda conn: inspect(conn).get_indexes("image"))}
+        assert unique["ix_image_sha256"]
+    await engine.dispose()
+
+async def test_valid_upgrade_adds_image_metadata(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/metadata.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        # image as it was at version 10
+        for column in ["width", "height", "channels", "format"]:
+            await conn.execute(text(f"ALTER TABLE image DROP COLUMN {column}"))
+        await conn.execute(text("UPDATE schema_version SET version = 10"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        columns = {i["name"] for i in await conn.run_sync(lambda conn: inspect(conn).get_columns("image"))}
+        assert {"width", "height", "channels", "format"} <= columns
+    await engine.dispose()
+
+async def test_valid_postgresql_region_query_uses_image_key():
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+    from app.core import spatial
+    from app.core.database import BboxAnnotation
+    stmt = spatial.intersecting(select(BboxAnnotation.id), BboxAnnotation, "postgresql", 0, 0, 10, 10, image_id=1)
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    # the image condition is on the indexed column, not a task subquery
+    assert "bbox_annotation.image_id = " in sql
+    assert "task" not in sql
+    assert any("gist (image_id, box(" in i for i in spatial._postgresql_ddl("bbox_annotation"))
@@ -0,0 +1,34 @@
+import hashlib
+import os
+import shutil
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crud
+from app.core import database, storage
+from app.schemas import ImageBase
+from app.settings import image_domain
+from app.tests.utils.image import create_test_image
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_valid_backfill(client:AsyncClient, db:AsyncSession):
+    # stored before hashing: an image, a copy of its file and one without a file
+    image = await create_test_image(db=db)
+    shutil.copy(image_domain + image.path, image_domain + image.path + ".copy")
+    copy = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=image.uploaded_user_id, path=image.path + ".copy"))
+    lost = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=image.uploaded_user_id, path=image.path + ".lost"))
+
+    assert await storage.backfill(batch_size=2, workers=2) == {"hashed": 1, "missing": 1, "duplicates": 1}
+
+    with open("app/tests/data/test_image.jpg", "rb") as file:
+        sha256 = hashlib.sha256(file.read()).hexdigest()
+    hashes = dict((await db.execute(select(database.Image.id, database.Image.sha256))).all())
+    assert hashes == {image.id: sha256, copy.id: None, lost.id: None}
+    # files stay where they are
+    assert os.path.exists(image_domain + image.path + ".copy")
+
+    # nothing left that can be hashed
+    assert await storage.backfill() == {"hashed": 0, "missing": 1, "duplicates": 1}
@@ -0,0 +1,24 @@
+import os
+import shutil
+import pytest
+from app import crud
+from app.core import thumbnails
+from app.schemas import ImageBase
+from app.tests.utils.image import create_test_image
+from app.settings import image_domain
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_valid_backfill_thumbnails(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "thumbnail_dir", str(tmp_path))
+    image = await create_test_image(db=db)
+    # a second image whose file is gone
+    shutil.copy(image_domain + image.path, image_domain + "/test_species/missing.jpg")
+    missing = await crud.create_image(db=db, image=ImageBase(species_id=image.species_id, uploaded_user_id=image.uploaded_user_id, path="/test_species/missing.jpg"))
+    os.remove(image_domain + missing.path)
+
+    assert await thumbnails.backfill(batch_size=1) == {"made": 1, "failed": 1}
+    assert os.listdir(tmp_path) == [f"image-{image.id}.jpg"]
+    # made once
+    assert await thumbnails.backfill() == {"made": 0, "failed": 1}
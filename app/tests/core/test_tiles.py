@@ -0,0 +1,49 @@
+import asyncio
+import os
+import pytest
+from app.core import tiles
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_valid_tile_cache_evicts_least_recently_used(tmp_path):
+    directory = str(tmp_path / "tiles")
+    source = "app/tests/data/test_image.jpg"
+    cache = tiles.TileCache(directory, 10 * 1024**2)
+
+    # concurrent requests share one build
+    paths = await asyncio.gather(cache.pyramid("a", source), cache.pyramid("a", source))
+    assert paths[0] == paths[1] == os.path.join(directory, "a")
+    await cache.pyramid("b", source)
+    size = cache._sizes["a"]
+    assert os.path.isfile(os.path.join(directory, "a", "11", "3_4.jpg"))
+
+    # room for two pyramids, a was used after b so b goes
+    await cache.pyramid("a", source)
+    cache.max_bytes = 2 * size
+    await cache.pyramid("c", source)
+    assert sorted(os.listdir(directory)) == ["a", "c"]
+
+    # the index and its order are read back from the directory
+    cache = tiles.TileCache(directory, 10 * 1024**2)
+    assert list(await cache._index()) == ["a", "c"]
+
+async def test_valid_tile_cache_takes_over_pyramids_of_other_workers(tmp_path, monkeypatch):
+    from app.core import workers
+    directory = str(tmp_path / "tiles")
+    source = "app/tests/data/test_image.jpg"
+    builds = []
+    run = workers.run
+    async def counted(function, *args):
+        builds.append(args)
+        return await run(function, *args)
+    monkeypatch.setattr(workers, "run", counted)
+
+    # two app workers on one directory, both indexed before the pyramid exists
+    first, second = tiles.TileCache(directory, 10 * 1024**2), tiles.TileCache(directory, 10 * 1024**2)
+    await first._index()
+    await second._index()
+    await first.pyramid("a", source)
+    assert await second.pyramid("a", source) == os.path.join(directory, "a")
+    assert len(builds) == 1
+    assert second._sizes["a"] == first._sizes["a"]
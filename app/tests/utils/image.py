@@ -1,14 +1,14 @@
 import os
 import uuid
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
-from app.schemas import UserCreate, SpeciesCreate, ImageBase, Image
+from app.schemas import UserCreate, SpeciesCreate, ImageBase, ImageFull
 
 from app.settings import image_domain
 
 
-def create_test_image(db:Session) -> Image:
-    user = crud.create_user(
+async def create_test_image(db:AsyncSession) -> ImageFull:
+    user = await crud.create_user(
         db=db,
         new_user=UserCreate(
             username="test",
@@ -16,7 +16,7 @@ def create_test_image(db:Session) -> Image:
             hashed_password="test"
         )
     )
-    species = crud.create_species(
+    species = await crud.create_species(
         new_species=SpeciesCreate(name="test_species"),
         db=db
     )
@@ -37,5 +37,6 @@ def create_test_image(db:Session) -> Image:
         image_path_with_domain+'/'+out_file_path
     )
 
-    image = crud.create_image(db=db,image=ImageBase(species_id=species.id, uploaded_user_id=user.id, path=image_path_without_domain+'/'+out_file_path))
-    return Image.model_validate(image)
\ No newline at end of file
+    image = await crud.create_image(db=db,image=ImageBase(species_id=species.id, uploaded_user_id=user.id, path=image_path_without_domain+'/'+out_file_path))
+    await db.refresh(image, attribute_names=["tasks"])
+    return ImageFull.model_validate(image)
\ No newline at end of file
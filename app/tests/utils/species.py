@@ -1,9 +1,9 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
 from app.schemas import Species, SpeciesCreate
 
-def create_test_species(db:Session) -> Species:
-    species = crud.create_species(
+async def create_test_species(db:AsyncSession) -> Species:
+    species = await crud.create_species(
         new_species=SpeciesCreate(name="test_species"),
         db=db
     )
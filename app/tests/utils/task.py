@@ -1,6 +1,6 @@
 import os
 import uuid
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
 from app.schemas import Task, TaskBase
 from app.core.database import TaskType
@@ -8,10 +8,10 @@ from app.core.database import TaskType
 from app.settings import image_domain
 from .image import create_test_image
 
-def create_test_task(db:Session, task_type=TaskType.bbox_annotation.value)->Task:
-    image = create_test_image(db=db)
+async def create_test_task(db:AsyncSession, task_type=TaskType.bbox_annotation.value)->Task:
+    image = await create_test_image(db=db)
     user = image.uploaded_user
-    task = crud.create_task(
+    task = await crud.create_task(
         db=db,
         new_task=TaskBase(
             created_user_id=user.id,
@@ -19,4 +19,6 @@ def create_test_task(db:Session, task_type=TaskType.bbox_annotation.value)->Task
             image_id=image.id
         )
     )
+    # tests read task.created_user, AsyncSession cannot lazy load it
+    await db.refresh(task, attribute_names=["created_user"])
     return task
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
 from app.schemas import UserCreate, User
 import random
@@ -13,8 +13,8 @@ def random_email():
     return f"{random_lower_string()}@{random_lower_string()}.com"
 
 
-def create_test_user(db:Session) -> User:
-    user = crud.create_user(
+async def create_test_user(db:AsyncSession) -> User:
+    user = await crud.create_user(
         db=db,
         new_user=UserCreate(
             username=random_lower_string(),